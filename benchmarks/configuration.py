@@ -0,0 +1,358 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks of the platform configuration phase.
+
+Every supported core is configured for the build, size, fuses, bootloader and
+upload targets with stub toolchain, AVRDUDE and framework packages. SCons runs
+in dry-run mode, so only the time spent in `platform.py` and the builder
+scripts is measured. The benchmark project times them with its own
+`extra_scripts`, the builder scripts don't know about the benchmark.
+
+Results are compared with `benchmarks/baseline.json`, the run fails if there
+is no baseline. Timings depend on the machine, save a baseline of your own
+before comparing local changes:
+
+    python benchmarks/configuration.py --save-baseline
+    python benchmarks/configuration.py
+
+The SCons package is taken from the PlatformIO core directory
+(`~/.platformio/packages/tool-scons` by default, see `--scons-dir`).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+PLATFORM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(PLATFORM_DIR, "benchmarks", "baseline.json")
+
+# Environment variable read by `REPORT_SCRIPT`
+REPORT_ENV_VAR = "PLATFORMIO_MEGAAVR_BENCHMARK_REPORT"
+
+# `extra_scripts` of the benchmark project, PlatformIO runs them right before
+# and after the platform builder script
+START_SCRIPT = """
+import time
+import tracemalloc
+
+Import("env")
+
+tracemalloc.start()
+env["BENCHMARK_START"] = time.perf_counter()
+"""
+
+REPORT_SCRIPT = """
+import json
+import os
+import time
+import tracemalloc
+
+Import("env")
+
+with open(os.environ["%s"], "w") as fp:
+    json.dump(dict(
+        time=time.perf_counter() - env["BENCHMARK_START"],
+        peak_memory=tracemalloc.get_traced_memory()[1],
+    ), fp)
+tracemalloc.stop()
+""" % REPORT_ENV_VAR
+
+STUB_TOOL = """#!%s
+import os
+import sys
+
+args = sys.argv[1:]
+name = os.path.basename(sys.argv[0])
+if "--version" in args:
+    print(name + " (GCC) 7.3.0")
+    sys.exit(0)
+out = None
+if "-o" in args:
+    out = args[args.index("-o") + 1]
+elif name in ("avr-gcc-ar", "avr-ar"):
+    out = args[1]
+elif name == "avr-objcopy":
+    out = args[-1]
+if out and out != "-":
+    open(out, "wb").close()
+"""
+
+TOOLCHAIN_BINS = (
+    "avr-gcc", "avr-g++", "avr-as", "avr-objcopy", "avr-size",
+    "avr-gcc-ar", "avr-gcc-ranlib", "avr-gdb",
+)
+
+FRAMEWORKS = (
+    ("framework-arduino-megaavr", "arduino", "1.8.8"),
+    ("framework-arduino-megaavr-megacorex", "MegaCoreX", "1.1.2"),
+    ("framework-arduino-megaavr-megatinycore", "megatinycore", "2.6.7"),
+    ("framework-arduino-megaavr-dxcore", "dxcore", "1.5.6"),
+)
+
+VARIANTS = ("uno2018", "nona4809", "48pin-standard", "txy4", "48pin-standard")
+
+# (environment, core, options, targets)
+SCENARIOS = (
+    ("arduino", "arduino", {
+        "board": "uno_wifi_rev2",
+        # the reference core doesn't generate fuses dynamically
+        "board_fuses.osccfg": "0x01",
+        "board_fuses.syscfg0": "0xC9",
+        "board_fuses.bootend": "0x00",
+    }, ("build", "size", "fuses", "bootloader", "upload")),
+    ("megacorex", "MegaCoreX", {
+        "board": "ATmega4809",
+        "board_hardware.uart": "uart0",
+    }, ("build", "size", "fuses", "bootloader", "upload")),
+    ("megatinycore", "megatinycore", {"board": "ATtiny1614"},
+     ("build", "size", "fuses", "upload")),
+    ("dxcore", "dxcore", {
+        "board": "AVR128DA48",
+        "board_hardware.uart": "uart0",
+        "board_bootloader.class": "optiboot_dx128",
+        "board_bootloader.port": "ser0",
+    }, ("build", "size", "fuses", "bootloader", "upload")),
+)
+
+
+def _write(path, content, executable=False):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fp:
+        fp.write(content)
+    if executable:
+        os.chmod(path, 0o755)
+
+
+def _make_package(packages_dir, dir_name, name, version, files):
+    package_dir = os.path.join(packages_dir, dir_name)
+    _write(
+        os.path.join(package_dir, "package.json"),
+        json.dumps(dict(name=name, version=version)),
+    )
+    _write(
+        os.path.join(package_dir, ".piopm"),
+        json.dumps(dict(
+            type="tool",
+            name=name,
+            version=version,
+            spec=dict(owner="platformio", id=None, name=name, requirements=None,
+                      uri=None),
+        )),
+    )
+    for path, content in files.items():
+        _write(
+            os.path.join(package_dir, path),
+            content,
+            executable=path.startswith("bin/"),
+        )
+
+
+def make_stub_packages(packages_dir, scons_dir):
+    stub = STUB_TOOL % sys.executable
+    toolchain = {"bin/%s" % name: stub for name in TOOLCHAIN_BINS}
+    _make_package(
+        packages_dir, "toolchain-atmelavr", "toolchain-atmelavr",
+        "1.70300.191015", toolchain)
+    _make_package(
+        packages_dir, "toolchain-atmelavr@3.70300.220127", "toolchain-atmelavr",
+        "3.70300.220127", toolchain)
+    for name, version in (
+        ("tool-avrdude", "1.70100.0"), ("tool-avrdude-megaavr", "1.60300.0")
+    ):
+        _make_package(packages_dir, name, name, version, {
+            "bin/avrdude": stub, "avrdude.conf": "",
+        })
+
+    bootloader = ":00000001FF\n"
+    for name, core, version in FRAMEWORKS:
+        files = {
+            "cores/%s/Arduino.h" % core: "",
+            "cores/%s/api/deprecated/.keep" % core: "",
+            "cores/%s/main.cpp" % core: "int main() { return 0; }\n",
+            "bootloaders/atmega4809_uart_bl.hex": bootloader,
+            "bootloaders/hex/optiboot_dx128_ser0.hex": bootloader,
+            "bootloaders/optiboot/bootloaders/mega0/115200/"
+            "Optiboot_mega0_UART0_DEF_115200_A7.hex": bootloader,
+        }
+        for variant in VARIANTS:
+            files["variants/%s/pins_arduino.h" % variant] = ""
+        _make_package(packages_dir, name, name, version, files)
+
+    os.symlink(scons_dir, os.path.join(packages_dir, "tool-scons"))
+
+
+def make_project(project_dir, packages_dir):
+    lines = [
+        "[platformio]",
+        "packages_dir = %s" % packages_dir,
+        "",
+        "[env]",
+        "platform = symlink://%s" % PLATFORM_DIR,
+        "framework = arduino",
+        "upload_port = %s" % os.devnull,
+        "extra_scripts =",
+        "    pre:benchmark_start.py",
+        "    post:benchmark_report.py",
+    ]
+    for name, _, options, _ in SCENARIOS:
+        lines.extend(["", "[env:%s]" % name])
+        lines.extend("%s = %s" % item for item in options.items())
+    _write(os.path.join(project_dir, "platformio.ini"), "\n".join(lines) + "\n")
+    _write(os.path.join(project_dir, "src", "main.cpp"), "void setup() {}\n")
+    _write(os.path.join(project_dir, "benchmark_start.py"), START_SCRIPT)
+    _write(os.path.join(project_dir, "benchmark_report.py"), REPORT_SCRIPT)
+
+
+def measure_default_packages(core, targets, repeat):
+    """Time and peak allocations of `configure_default_packages()`"""
+    from platformio.platform.factory import PlatformFactory  # noqa
+
+    best = None
+    for _ in range(repeat):
+        platform = PlatformFactory.new(PLATFORM_DIR)
+        board = dict(
+            (name, options["board"])
+            for name, scenario_core, options, _ in SCENARIOS
+            if scenario_core == core
+        ).popitem()[1]
+        tracemalloc.start()
+        start = time.perf_counter()
+        platform.configure_default_packages(
+            {"board": board, "pioframework": ["arduino"]}, targets)
+        result = dict(
+            time=time.perf_counter() - start,
+            peak_memory=tracemalloc.get_traced_memory()[1],
+        )
+        tracemalloc.stop()
+        if best is None or result["time"] < best["time"]:
+            best = result
+    return best
+
+
+def measure_target(project_dir, name, target, repeat):
+    """Best configuration time and peak allocations of the builder scripts"""
+    report_path = os.path.join(project_dir, "report.json")
+    best = None
+    for _ in range(repeat):
+        if os.path.isfile(report_path):
+            os.remove(report_path)
+        cmd = ["pio", "run", "-d", project_dir, "-e", name]
+        if target != "build":
+            cmd.extend(["-t", target])
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            env=dict(os.environ, SCONSFLAGS="--dry-run",
+                     **{REPORT_ENV_VAR: report_path}),
+        )
+        if result.returncode != 0 or not os.path.isfile(report_path):
+            sys.stderr.write(result.stdout)
+            raise RuntimeError("Couldn't configure `%s` for `%s`" % (name, target))
+        with open(report_path) as fp:
+            report = json.load(fp)
+        if best is None or report["time"] < best["time"]:
+            best = report
+    return best
+
+
+def run_benchmarks(scons_dir, repeat):
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="megaavr-bench-")
+    try:
+        packages_dir = os.path.join(work_dir, "packages")
+        project_dir = os.path.join(work_dir, "project")
+        make_stub_packages(packages_dir, scons_dir)
+        make_project(project_dir, packages_dir)
+        for name, core, _, targets in SCENARIOS:
+            measurements = [(
+                "configure_default_packages",
+                lambda: measure_default_packages(core, list(targets), repeat),
+            )]
+            measurements.extend(
+                (target, lambda target=target: measure_target(
+                    project_dir, name, target, repeat))
+                for target in targets
+            )
+            for title, measure in measurements:
+                key = "%s/%s" % (name, title)
+                results[key] = measure()
+                print("%-40s %8.2f ms %10d B" % (
+                    key, results[key]["time"] * 1000, results[key]["peak_memory"]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if not expected:
+            continue
+        for metric in ("time", "peak_memory"):
+            if result[metric] > expected[metric] * tolerance:
+                regressions.append("%s: %s %.4g exceeds baseline %.4g" % (
+                    key, metric, result[metric], expected[metric]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5,
+        help="allowed ratio to the baseline values (default: 1.5)")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="runs per measurement, the best one is used (default: 5)")
+    parser.add_argument(
+        "--scons-dir",
+        default=os.path.join(os.path.expanduser("~"), ".platformio", "packages",
+                             "tool-scons"))
+    args = parser.parse_args(argv)
+
+    if not args.save_baseline and not os.path.isfile(args.baseline):
+        sys.stderr.write(
+            "Error: No baseline %s, run with --save-baseline first\n" % args.baseline)
+        return 1
+
+    results = run_benchmarks(os.path.abspath(args.scons_dir), args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+
+    with open(args.baseline) as fp:
+        regressions = compare_with_baseline(results, json.load(fp), args.tolerance)
+    for line in regressions:
+        sys.stderr.write("Regression: %s\n" % line)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
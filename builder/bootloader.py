@@ -15,7 +15,9 @@
 import sys
 import os
 
-from SCons.Script import Import, Return
+from SCons.Script import COMMAND_LINE_TARGETS, Import, Return
+
+from megaavr.bootloader import BootloaderError, resolve_bootloader_path
 
 Import("env")
 
@@ -23,53 +25,6 @@ board = env.BoardConfig()
 platform = env.PioPlatform()
 core = board.get("build.core", "")
 
-
-def get_suitable_optiboot_binary(framework_dir, board_config):
-    uart = board_config.get("hardware.uart", "no_bootloader").lower()
-    if uart == "no_bootloader":
-        return ""
-    if not uart.endswith(("_alt", "_def")):
-        uart = uart + "_def"
-
-    bootloader_led = board_config.get("bootloader.led_pin", "A7").upper()
-    bootloader_speed = board_config.get("bootloader.speed", env.subst("$UPLOAD_SPEED"))
-    bootloader_file = "Optiboot_mega0_%s_%s_%s.hex" % (
-        uart.upper(), bootloader_speed, bootloader_led)
-
-    bootloader_path = os.path.join(
-        framework_dir, "bootloaders", "optiboot", "bootloaders", "mega0",
-        bootloader_speed, bootloader_file
-    )
-
-    return bootloader_path
-
-
-def get_bootloader_dxcore(framework_dir, board_config):
-    btld = board_config.get("bootloader.class", "")
-    port = board_config.get("bootloader.port", "")
-    entry = board_config.get("bootloader.entrycond", "")
-
-    if not btld:
-        sys.stderr.write("Error: invalid `bootloader.class` in board config!\n")
-        env.Exit(1)
-    if not port:
-        sys.stderr.write("Error: invalid `bootloader.port` in board config!\n")
-        env.Exit(1)
-
-    bootloader_file = f"{btld}_{port}_{entry}.hex" if entry else f"{btld}_{port}.hex"
-
-    bootloader_path = os.path.join(
-        framework_dir,
-        "bootloaders",
-        "hex",
-        bootloader_file,
-    )
-
-    print(f"Using bootloader `{bootloader_file}`.")
-
-    return bootloader_path
-
-
 framework_dir = ""
 if env.get("PIOFRAMEWORK", []):
     framework_dir = platform.get_package_dir(platform.frameworks[env.get(
@@ -79,29 +34,20 @@ if env.get("PIOFRAMEWORK", []):
 # Bootloader processing
 #
 
-bootloader_path = board.get("bootloader.file", "")
-if core == "MegaCoreX":
-    if not os.path.isfile(bootloader_path):
-        if board.get("hardware.uart", "no_bootloader").lower() == "no_bootloader":
-            sys.stderr.write("Error: `no bootloader` selected in board config!\n")
-            env.Exit(1)
-        bootloader_path = get_suitable_optiboot_binary(framework_dir, board)
-elif core == "dxcore":
-    if not os.path.isfile(bootloader_path):
-        bootloader_path = get_bootloader_dxcore(framework_dir, board)
-else:
-    if not os.path.isfile(bootloader_path):
-        bootloader_path = os.path.join(framework_dir, "bootloaders", bootloader_path)
-
-    if not board.get("bootloader", {}):
-        sys.stderr.write("Error: missing bootloader configuration!\n")
-        env.Exit(1)
-
-if not os.path.isfile(bootloader_path):
-    bootloader_path = os.path.join(framework_dir, "bootloaders", bootloader_path)
-
-if not os.path.isfile(bootloader_path) and "BOOTFLAGS" not in env:
-    sys.stderr.write("Error: Couldn't find bootloader image %s\n" % bootloader_path)
+try:
+    with env.TraceSpan("Bootloader resolution"):
+        if "BOOTFLAGS" in env:
+            # the image is specified by custom flags and may not exist
+            bootloader_path = resolve_bootloader_path(
+                framework_dir, board, env.subst("$UPLOAD_SPEED"))
+        else:
+            bootloader_path, image = env.GetBootloaderCatalog().find(
+                framework_dir, board, env.subst("$UPLOAD_SPEED"))
+            if core == "dxcore":
+                print("Using bootloader `%s` (%d bytes at 0x%X)." % (
+                    os.path.basename(bootloader_path), image["size"], image["start"]))
+except BootloaderError as exc:
+    sys.stderr.write("Error: %s\n" % exc)
     env.Exit(1)
 
 env.Append(
@@ -128,7 +74,9 @@ if env.subst("$UPLOAD_PROTOCOL") in (
     "jtag2updi",
     "serialupdi",
 ) or env.BoardConfig().get("upload", {}).get("require_upload_port", False):
-    env.AutodetectUploadPort()
+    if "uploadfleet" not in COMMAND_LINE_TARGETS:
+        # every fleet upload command gets its own port
+        env.FindUploadPort()
     env.Append(BOOTUPLOADERFLAGS=["-P", '"$UPLOAD_PORT"'])
 else:
     # upload methods via USB
@@ -0,0 +1,146 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+from os.path import join, relpath
+
+from SCons.CacheDir import CacheDir
+from SCons.Script import Import
+from SCons.Util import hash_collect
+
+from megaavr.bootloader import BootloaderCatalog
+from megaavr.cache import ArtifactCache
+from megaavr.elf import ElfError
+from megaavr.objcopy import (write_eeprom_hex, write_firmware_bin,
+                             write_firmware_hex)
+from megaavr.profiles import (DEFAULT_OPTIMIZATION, ProfileError,
+                              get_profile_options, update_flags)
+
+Import("env")
+
+
+class SharedObjectCacheDir(CacheDir):
+    """Build cache that keys object files without their build directory
+
+    SCons adds the target path to the cache signature, so identical objects
+    compiled by different environments never match. Objects only depend on
+    the compiler invocation, sources and headers, which lets a board matrix
+    share them between compatible environments.
+    """
+
+    def cachepath(self, node):
+        if not self.is_enabled() or node.get_suffix() != ".o":
+            return super().cachepath(node)
+        sigs = [child.get_cachedir_csig() for child in node.children()]
+        sigs.append(node.get_contents_sig())
+        # the path in the build directory tells apart objects with the same
+        # name from different libraries
+        sigs.append(relpath(
+            node.get_abspath(), node.get_build_env().subst("$BUILD_DIR")
+        ).replace(os.sep, "/"))
+        sig = hash_collect(sigs)
+        cachedir = join(self.path, sig[:self.config["prefix_len"]].upper())
+        return cachedir, join(cachedir, sig)
+
+
+def GetPlatformCacheDir(env, name):
+    return join(
+        env.GetProjectConfig().get("platformio", "cache_dir"), "atmelmegaavr", name
+    )
+
+
+def ApplyBuildProfile(env):
+    """Rewrite LTO and optimization flags, called after the framework flags
+    are configured"""
+    try:
+        lto_jobs, optimization = get_profile_options(env.BoardConfig())
+    except ProfileError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    if (lto_jobs, optimization) == (1, DEFAULT_OPTIMIZATION):
+        return
+    for name in ("CCFLAGS", "CFLAGS", "CXXFLAGS", "LINKFLAGS"):
+        env.Replace(**{name: update_flags(
+            env.get(name, []), lto_jobs, optimization, link=name == "LINKFLAGS")})
+
+
+def GetBootloaderCatalog(env):
+    return BootloaderCatalog(env.GetPlatformCacheDir("bootloaders"))
+
+
+def GetCoreCache(env):
+    return ArtifactCache(
+        env.GetPlatformCacheDir("core"),
+        env.BoardConfig().get("build.core_cache_size", "512MB"),
+    )
+
+
+def PrintCoreCacheStats(_, target, source, env):  # pylint: disable=W0613
+    print(env.GetCoreCache().format_stats())
+
+
+def GetCompileCache(env):
+    return ArtifactCache(
+        env.GetPlatformCacheDir("compile"),
+        env.BoardConfig().get("build.compile_cache_size", "1GB"),
+    )
+
+
+def PrintCompileCacheStats(_, target, source, env):  # pylint: disable=W0613
+    print(env.GetCompileCache().format_stats())
+
+
+def ReportCompileCache(_, target, source, env):  # pylint: disable=W0613
+    compile_cache = env.GetCompileCache()
+    hits, misses = compile_cache.count_events(env["COMPILECACHE_OFFSET"])
+    if hits + misses:
+        print("Compile cache: %d hits, %d misses (%.1f%% hit rate)" % (
+            hits, misses, 100.0 * hits / (hits + misses)))
+    compile_cache.evict()
+
+
+def ConvertElf(_, target, source, env):  # pylint: disable=W0613
+    writers = {
+        ".hex": write_firmware_hex,
+        ".bin": write_firmware_bin,
+        ".eep": write_eeprom_hex,
+    }
+    elf_path = source[0].get_abspath()
+    for node in target:
+        path = node.get_abspath()
+        try:
+            writers[os.path.splitext(path)[1].lower()](elf_path, path)
+        except (IOError, OSError, ElfError) as exc:
+            sys.stderr.write("Error: Could not convert %s: %s\n" % (elf_path, exc))
+            return 1
+    return None
+
+
+env.AddMethod(GetPlatformCacheDir)
+env.AddMethod(ApplyBuildProfile)
+env.AddMethod(GetBootloaderCatalog)
+env.AddMethod(GetCoreCache)
+env.AddMethod(PrintCoreCacheStats)
+env.AddMethod(GetCompileCache)
+env.AddMethod(PrintCompileCacheStats)
+env.AddMethod(ReportCompileCache)
+env.AddMethod(ConvertElf)
+
+# only the matrix builds share objects between environments, other users of
+# `build_cache_dir` keep the signatures of PlatformIO
+if env.subst("$BUILD_CACHE_DIR") and os.environ.get(
+    "PLATFORMIO_MEGAAVR_SHARED_OBJECTS"
+):
+    env.CacheDir("$BUILD_CACHE_DIR", SharedObjectCacheDir)
@@ -0,0 +1,131 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+from os.path import join
+
+from serial import SerialException
+
+from SCons.Script import Import
+
+from megaavr.avrdude import strip_memory_ops
+from megaavr.boards import get_eeprom_size
+from megaavr.eeprom import (format_changes, get_changed_bytes, get_image_bytes,
+                            group_runs, segments_to_bytes)
+from megaavr.ihex import HexError, read_hex, write_hex
+from megaavr.updi import UpdiError, UpdiProgrammer
+
+Import("env")
+
+
+def ReportEepromChanges(env, changes, current, total, verify_only):
+    """Print the differences, returns True if the changes should be written"""
+    if not changes:
+        print("EEPROM is up to date, %d bytes match" % total)
+        return False
+    print("%d of %d EEPROM bytes differ:\n%s" % (
+        len(changes), total, format_changes(changes, current)))
+    if verify_only:
+        sys.stderr.write("Error: EEPROM doesn't match the image\n")
+        env.Exit(1)
+    return True
+
+
+def ProvisionEeprom(env, source, verify_only):
+    mcu = env.subst("$BOARD_MCU").lower()
+    size = get_eeprom_size(mcu)
+    try:
+        desired = get_image_bytes(read_hex(source[0].get_abspath()))
+    except (IOError, HexError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    if not desired:
+        print("EEPROM image %s is empty, nothing to do" % source[0])
+        return
+    if size is None or max(desired) >= size:
+        sys.stderr.write(
+            "Error: EEPROM image %s doesn't fit %s bytes of %s EEPROM\n"
+            % (source[0], size or "unknown", mcu))
+        env.Exit(1)
+
+    if env.get("UPLOAD_NATIVE"):
+        return env.ProvisionEepromUpdi(desired, size, verify_only)
+
+    uploader_flags = [str(flag) for flag in env.subst_list("$UPLOADERFLAGS")[0]]
+    uploader_cmd = "$UPLOADER %s" % " ".join(strip_memory_ops(uploader_flags))
+    device_path = join(env.subst("$BUILD_DIR"), "eeprom.device.hex")
+    if env.Execute("%s -U eeprom:r:%s:i" % (uploader_cmd, device_path)):
+        env.Exit(1)
+    try:
+        current = segments_to_bytes(read_hex(device_path), size)
+    except (IOError, HexError) as exc:
+        sys.stderr.write("Error: Couldn't read the device EEPROM: %s\n" % exc)
+        env.Exit(1)
+    changes = get_changed_bytes(current, desired)
+    if not env.ReportEepromChanges(changes, current, len(desired), verify_only):
+        return
+
+    if env.BoardConfig().get("build.core", "") in ("MegaCoreX", "megatinycore", "dxcore"):
+        # AVRDUDE 7 writes only the addresses present in the file
+        segments = group_runs(changes)
+    else:
+        # older versions write everything up to the last address of the file
+        merged = bytearray(
+            desired.get(address, value) for address, value in enumerate(current))
+        segments = [(0, merged[:changes[-1][0] + 1])]
+    partial_path = join(env.subst("$BUILD_DIR"), "eeprom.changes.hex")
+    write_hex(partial_path, segments)
+    if env.Execute("%s -U eeprom:w:%s:i" % (uploader_cmd, partial_path)):
+        env.Exit(1)
+
+
+def ProvisionEepromUpdi(env, desired, size, verify_only):
+    try:
+        with UpdiProgrammer(
+            env.subst("$UPLOAD_PORT"), int(env.subst("$UPLOAD_SPEED") or 115200)
+        ) as programmer:
+            programmer.enter_progmode()
+            start = time.time()
+            current = programmer.read_eeprom(size)
+            changes = get_changed_bytes(current, desired)
+            if not env.ReportEepromChanges(
+                    changes, current, len(desired), verify_only):
+                return
+            programmer.write_eeprom(
+                group_runs(changes, programmer.nvm["eeprom_page_size"]))
+            mismatches = get_changed_bytes(programmer.read_eeprom(size), desired)
+    except (IOError, SerialException, UpdiError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    if mismatches:
+        sys.stderr.write(
+            "Error: EEPROM verification failed at 0x%04X\n" % mismatches[0][0])
+        env.Exit(1)
+    print("Wrote and verified %d bytes in %.2fs" % (len(changes), time.time() - start))
+
+
+def UploadEeprom(_, target, source, env):  # pylint: disable=W0613
+    env.ProvisionEeprom(source, verify_only=False)
+
+
+def VerifyEeprom(_, target, source, env):  # pylint: disable=W0613
+    env.ProvisionEeprom(source, verify_only=True)
+
+
+env.AddMethod(ReportEepromChanges)
+env.AddMethod(ProvisionEeprom)
+env.AddMethod(ProvisionEepromUpdi)
+env.AddMethod(UploadEeprom)
+env.AddMethod(VerifyEeprom)
@@ -0,0 +1,136 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+from os.path import isfile, join
+
+from SCons.Script import Import
+
+from megaavr.fleet import expand_ports, format_fleet_summary, run_fleet
+from megaavr.fuses import FuseError, compute_fuses, get_boot_size, get_family
+from megaavr.ihex import (HexError, get_bounds, get_checksum, merge_images,
+                          read_hex, write_hex)
+
+Import("env")
+
+
+def BuildMergedImage(_, target, source, env):  # pylint: disable=W0613
+    board_config = env.BoardConfig()
+    family_id = get_family(board_config)
+    try:
+        boot_size = get_boot_size(
+            family_id, compute_fuses(board_config, "bootloader"))
+    except FuseError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    text_start = int(
+        "0x200" if env.subst("$UPLOAD_PROTOCOL") == "arduino"
+        else board_config.get("build.text_section_start", "0x0"),
+        0,
+    )
+
+    try:
+        firmware = read_hex(source[0].get_abspath())
+        eeprom = read_hex(source[1].get_abspath())
+        bootloader = read_hex(source[2].get_abspath())
+    except (IOError, HexError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+
+    for name, image in (("Firmware", firmware), ("Bootloader", bootloader)):
+        if not image:
+            sys.stderr.write("Error: %s image is empty\n" % name)
+            env.Exit(1)
+    if not boot_size:
+        sys.stderr.write(
+            "Error: Boot section size is 0, check the `bootend`/`bootsize` fuse\n"
+        )
+        env.Exit(1)
+    if get_bounds(bootloader)[1] > boot_size:
+        sys.stderr.write(
+            "Error: Bootloader image ends at 0x%X beyond the boot section "
+            "(0x0-0x%X)\n" % (get_bounds(bootloader)[1], boot_size)
+        )
+        env.Exit(1)
+    if text_start < boot_size or get_bounds(firmware)[0] < boot_size:
+        sys.stderr.write(
+            "Error: Application starts at 0x%X inside the boot section "
+            "(0x0-0x%X), set `board_build.text_section_start = 0x%X`\n"
+            % (min(text_start, get_bounds(firmware)[0]), boot_size, boot_size)
+        )
+        env.Exit(1)
+
+    try:
+        merged = merge_images(dict(bootloader=bootloader, firmware=firmware))
+    except HexError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    write_hex(target[0].get_abspath(), merged)
+    print("Merged image %s, CRC32 0x%08X" % (target[0], get_checksum(merged)))
+
+    if eeprom:
+        write_hex(target[1].get_abspath(), eeprom)
+        print("EEPROM image %s, CRC32 0x%08X" % (target[1], get_checksum(eeprom)))
+    elif isfile(target[1].get_abspath()):
+        os.remove(target[1].get_abspath())
+
+
+def UploadFleet(_, target, source, env):  # pylint: disable=W0613
+    upload_options = env.BoardConfig().get("upload", {})
+    ports = expand_ports(upload_options.get("fleet_ports", ""))
+    if not ports:
+        sys.stderr.write(
+            "Error: Please specify a list or a glob pattern of ports using "
+            "the `board_upload.fleet_ports` option\n"
+        )
+        env.Exit(1)
+
+    if env.subst("$UPLOAD_PROTOCOL") != "custom":
+        if env.subst("$UPLOAD_SPEED"):
+            env.Append(UPLOADERFLAGS=["-b", "$UPLOAD_SPEED"])
+        if "extra_flags" in upload_options:
+            env.Append(UPLOADERFLAGS=upload_options.get("extra_flags"))
+        env.Append(UPLOADERFLAGS=["-P", '"$UPLOAD_PORT"'])
+
+    commands = {
+        port: env.Override({"UPLOAD_PORT": port}).subst(
+            "$UPLOADCMD", target=target, source=source
+        )
+        for port in ports
+    }
+    flashed_images = env.GetFlashedImages()
+    for port in ports:
+        flashed_images.forget(port)
+    jobs = int(upload_options.get("fleet_jobs", 0)) or min(len(ports), 8)
+    print("Uploading to %d ports, %d at a time..." % (len(ports), jobs))
+
+    results = run_fleet(
+        commands,
+        jobs,
+        env.subst(join("$BUILD_DIR", "fleet")),
+        sysenv={key: str(value) for key, value in env["ENV"].items()},
+        on_result=lambda item: print(
+            "%s: %s" % (item["port"], "SUCCESS" if item["returncode"] == 0 else "FAILED")
+        ),
+    )
+
+    print("")
+    print(format_fleet_summary(results))
+    if any(item["returncode"] != 0 for item in results):
+        env.Exit(1)
+
+
+env.AddMethod(BuildMergedImage)
+env.AddMethod(UploadFleet)
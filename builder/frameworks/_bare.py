@@ -70,3 +70,6 @@ env.Append(
 
     LIBS=["m"]
 )
+
+# "board_build.profile", "board_build.lto" and "board_build.optimization"
+env.ApplyBuildProfile()
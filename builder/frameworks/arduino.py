@@ -22,22 +22,26 @@ kinds of creative coding, interactive objects, spaces or physical experiences.
 http://arduino.cc/en/Reference/HomePage
 """
 
-from os.path import isdir, join
+import hashlib
+import re
+from os import makedirs
+from os.path import isdir, isfile, join, relpath
 
 from SCons.Script import DefaultEnvironment
 
 from platformio.package.version import pepver_to_semver
 
+from megaavr.cache import get_tree_digest, relativize_paths
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 build_core = board.get("build.core", "")
 
-FRAMEWORK_DIR = platform.get_package_dir("framework-arduino-megaavr")
+FRAMEWORK_PACKAGE = "framework-arduino-megaavr"
 if build_core != "arduino":
-    FRAMEWORK_DIR = platform.get_package_dir(
-        "framework-arduino-megaavr-%s" % build_core.lower()
-    )
+    FRAMEWORK_PACKAGE = "framework-arduino-megaavr-%s" % build_core.lower()
+FRAMEWORK_DIR = platform.get_package_dir(FRAMEWORK_PACKAGE)
 
 assert isdir(FRAMEWORK_DIR)
 
@@ -147,12 +151,58 @@ if build_core in ("dxcore", "megatinycore"):
             ],
         )
 
+    # the C++ flags above enable LTO again
+    env.ApplyBuildProfile()
+
 
 #
 # Target: Build Core Library
 #
 
+
+def get_core_cache_key(core_dir, variant_dir, digests_path):
+    hasher = hashlib.sha1()
+    hasher.update(("%s@%s" % (
+        FRAMEWORK_PACKAGE, platform.get_package_version(FRAMEWORK_PACKAGE))).encode())
+    # project headers may override the ones from the core
+    for path in (core_dir, variant_dir, env.subst("$PROJECT_INCLUDE_DIR")):
+        if path and isdir(path):
+            # the trees are read only when their files were touched
+            hasher.update(get_tree_digest(path, digests_path).encode())
+    # include paths are hashed relative to the project and packages, which
+    # lets projects and checkouts at other locations share the entries
+    hasher.update(
+        relativize_paths(
+            env.subst(
+                "$CC $CXX $CCFLAGS $CFLAGS $CXXFLAGS $ASFLAGS $ASPPFLAGS "
+                "$_CPPDEFFLAGS $_CPPINCFLAGS $BUILD_TYPE $BUILD_UNFLAGS"
+            ),
+            [
+                env.subst(path)
+                for path in ("$PROJECT_DIR", "$BUILD_DIR", "$PROJECT_PACKAGES_DIR")
+            ],
+        ).encode()
+    )
+    hasher.update(
+        str(platform.get_package_version("toolchain-atmelavr")).encode()
+    )
+    return hasher.hexdigest()
+
+
+def store_core_cache(target, source, env):  # pylint: disable=W0613
+    files = {"libFrameworkArduino.a": libs[0][0].get_abspath()}
+    variant_build_dir = env.subst(join("$BUILD_DIR", "FrameworkArduinoVariant"))
+    for node in env.Flatten(variant_objects):
+        files["variant/%s" % relpath(node.get_abspath(), variant_build_dir)] = (
+            node.get_abspath()
+        )
+    core_cache.store(cache_key, files)
+    core_cache.evict()
+
+
 libs = []
+core_dir = join(FRAMEWORK_DIR, "cores", build_core)
+variant_dir = ""
 
 if "build.variant" in board:
     variants_dir = (
@@ -160,17 +210,99 @@ if "build.variant" in board:
         if board.get("build.variants_dir", "")
         else join(FRAMEWORK_DIR, "variants")
     )
+    variant_dir = join(variants_dir, board.get("build.variant"))
+    env.Append(CPPPATH=[variant_dir])
 
-    env.Append(CPPPATH=[join(variants_dir, board.get("build.variant"))])
-    env.BuildSources(
-        join("$BUILD_DIR", "FrameworkArduinoVariant"),
-        join(variants_dir, board.get("build.variant")),
-    )
+if board.get("build.core_cache", "no").lower() != "yes":
+    if variant_dir:
+        env.BuildSources(join("$BUILD_DIR", "FrameworkArduinoVariant"), variant_dir)
 
-libs.append(
-    env.BuildLibrary(
-        join("$BUILD_DIR", "FrameworkArduino"), join(FRAMEWORK_DIR, "cores", build_core)
-    )
-)
+    libs.append(env.BuildLibrary(join("$BUILD_DIR", "FrameworkArduino"), core_dir))
+else:
+    core_cache = env.GetCoreCache()
+    cache_key = get_core_cache_key(
+        core_dir, env.subst(variant_dir), join(core_cache.root, "trees.json"))
+    cached_files = core_cache.lookup(cache_key)
+    if cached_files:
+        print("Using cached core libraries (%s)" % cache_key[:12])
+        env.Append(
+            PIOBUILDFILES=[
+                env.File(cached_files[name])
+                for name in sorted(cached_files)
+                if name.startswith("variant/")
+            ]
+        )
+        libs.append(env.File(cached_files["libFrameworkArduino.a"]))
+    else:
+        variant_objects = []
+        if variant_dir:
+            variant_objects = [
+                env.Object(node)
+                for node in env.CollectBuildFiles(
+                    join("$BUILD_DIR", "FrameworkArduinoVariant"), variant_dir
+                )
+            ]
+            env.Append(PIOBUILDFILES=variant_objects)
+
+        libs.append(
+            env.BuildLibrary(join("$BUILD_DIR", "FrameworkArduino"), core_dir)
+        )
+        env.AddPostAction(
+            env.subst("$PROGPATH"),
+            env.VerboseAction(store_core_cache, "Caching core libraries"),
+        )
 
 env.Prepend(LIBS=libs)
+
+
+#
+# Precompiled "Arduino.h" for sketch and library C++ sources
+#
+
+FIRST_DIRECTIVE_RE = re.compile(r"^[ \t]*#.*$", re.M)
+ARDUINO_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*[<"]Arduino\.h[>"]')
+
+
+def use_precompiled_header(env, node):
+    if node.get_suffix() not in (".cpp", ".cc", ".cxx"):
+        return node
+    # the header is forced in front of the source, which must not change
+    # anything, so only sources that start with including it are covered
+    match = FIRST_DIRECTIVE_RE.search(node.get_text_contents())
+    if not match or not ARDUINO_INCLUDE_RE.match(match.group(0)):
+        return node
+    obj = env.Object(node, PCHFLAGS=["-include", pch_header])
+    env.Depends(obj, pch_target)
+    return obj
+
+
+if board.get("build.pch", "no").lower() == "yes":
+    pch_header = env.subst(join("$BUILD_DIR", "pch", "Arduino.h"))
+    # the package version makes a new framework release rebuild the header
+    pch_contents = "// %s@%s\n#include <Arduino.h>\n" % (
+        FRAMEWORK_PACKAGE, platform.get_package_version(FRAMEWORK_PACKAGE))
+    current_contents = None
+    if isfile(pch_header):
+        with open(pch_header) as fp:
+            current_contents = fp.read()
+    if current_contents != pch_contents:
+        if not isdir(env.subst(join("$BUILD_DIR", "pch"))):
+            makedirs(env.subst(join("$BUILD_DIR", "pch")))
+        with open(pch_header, "w") as fp:
+            fp.write(pch_contents)
+
+    # GCC picks "Arduino.h.gch" next to the included header and silently
+    # falls back to the text header when the flags of a source don't match
+    pch_target = env.Command(
+        pch_header + ".gch",
+        pch_header,
+        env.VerboseAction(
+            "$CXX -o $TARGET -x c++-header -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+            "Precompiling $SOURCE",
+        ),
+    )
+    # $PCHFLAGS is set only on the objects created by the middleware. Core
+    # sources were collected above, before it is registered, so they are
+    # compiled without the header even if they include Arduino.h first
+    env.Replace(CXXCOM=env["CXXCOM"].replace("$CXXFLAGS", "$PCHFLAGS $CXXFLAGS", 1))
+    env.AddBuildMiddleware(use_precompiled_header)
@@ -13,44 +13,28 @@
 # limitations under the License.
 
 import sys
-from os.path import join
+from os.path import isfile, join
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
                           Builder, Default, DefaultEnvironment)
 
-from platformio.public import list_serial_ports
-
-
-def BeforeUpload(target, source, env):  # pylint: disable=W0613,W0621
-    upload_options = {}
-    if "BOARD" in env:
-        upload_options = env.BoardConfig().get("upload", {})
-
-    if env.subst("$UPLOAD_SPEED"):
-        env.Append(UPLOADERFLAGS=["-b", "$UPLOAD_SPEED"])
-
-    # extra upload flags
-    if "extra_flags" in upload_options:
-        env.Append(UPLOADERFLAGS=upload_options.get("extra_flags"))
-
-    if upload_options and not upload_options.get("require_upload_port", False):
-        # upload methods via USB
-        env.Append(UPLOADERFLAGS=["-P", "usb"])
-        return
-
-    env.AutodetectUploadPort()
-    env.Append(UPLOADERFLAGS=["-P", '"$UPLOAD_PORT"'])
-
-    before_ports = list_serial_ports()
-
-    if upload_options.get("use_1200bps_touch", False):
-        env.TouchSerialPort("$UPLOAD_PORT", 1200)
+env = DefaultEnvironment()
 
-    if upload_options.get("wait_for_upload_port", False):
-        env.Replace(UPLOAD_PORT=env.WaitForNewSerialPort(before_ports))
+# Helper modules shared by the builder scripts live in "builder/megaavr"
+sys.path.insert(0, join(env.PioPlatform().get_dir(), "builder"))
 
+# pylint: disable=wrong-import-position
+from megaavr.bootloader import BootloaderError  # noqa: E402
+from megaavr.verify import STRATEGIES as VERIFY_STRATEGIES  # noqa: E402
 
-env = DefaultEnvironment()
+# timing is set up first, the other scripts create traced actions
+env.SConscript("trace.py", exports="env")
+env.SConscript("build.py", exports="env")
+env.SConscript("size.py", exports="env")
+env.SConscript("upload.py", exports="env")
+env.SConscript("eeprom.py", exports="env")
+env.SConscript("personalize.py", exports="env")
+env.SConscript("fleet.py", exports="env")
 
 env.Replace(
     AR="avr-gcc-ar",
@@ -64,6 +48,7 @@ env.Replace(
 
     ARFLAGS=["rc"],
 
+    # the size is calculated in-process, these are kept for extra scripts
     SIZEPROGREGEXP=r"^(?:\.text|\.data|\.rodata|\.bootloader)\s+([0-9]+).*",
     SIZEDATAREGEXP=r"^(?:\.data|\.bss|\.noinit)\s+([0-9]+).* ",
     SIZEEEPROMREGEXP=r"^(?:\.eeprom)\s+([0-9]+).*",
@@ -89,53 +74,86 @@ env.Replace(
     PROGSUFFIX=".elf"
 )
 
+OBJCOPY_ACTIONS = dict(
+    ElfToBin=" ".join([
+        "$OBJCOPY",
+        "-O",
+        "binary",
+        "-R",
+        ".eeprom",
+        "$SOURCES",
+        "$TARGET"
+    ]),
+    ElfToEep=" ".join([
+        "$OBJCOPY",
+        "-O",
+        "ihex",
+        "-j",
+        ".eeprom",
+        '--set-section-flags=.eeprom="alloc,load"',
+        "--no-change-warnings",
+        "--change-section-lma",
+        ".eeprom=0",
+        "$SOURCES",
+        "$TARGET"
+    ]),
+    ElfToHex=" ".join([
+        "$OBJCOPY",
+        "-O",
+        "ihex",
+        "-R",
+        ".eeprom",
+        "$SOURCES",
+        "$TARGET"
+    ])
+)
+
+# The ELF file is converted in-process by default, every output reuses the
+# sections loaded for the first one. "external" falls back to avr-objcopy.
+if env.BoardConfig().get("build.objcopy", "internal").lower() != "external":
+    OBJCOPY_ACTIONS = {name: env.ConvertElf for name in OBJCOPY_ACTIONS}
+
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(OBJCOPY_ACTIONS["ElfToBin"], "Building $TARGET"),
             suffix=".bin"
         ),
 
         ElfToEep=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-j",
-                ".eeprom",
-                '--set-section-flags=.eeprom="alloc,load"',
-                "--no-change-warnings",
-                "--change-section-lma",
-                ".eeprom=0",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(OBJCOPY_ACTIONS["ElfToEep"], "Building $TARGET"),
             suffix=".eep"
         ),
 
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(OBJCOPY_ACTIONS["ElfToHex"], "Building $TARGET"),
             suffix=".hex"
         )
     )
 )
 
+if env.BoardConfig().get("build.compile_cache", "no").lower() == "yes":
+    env.Replace(
+        # objects of a build are counted from the current end of the stats log
+        COMPILECACHE_OFFSET=env.GetCompileCache().get_stats_offset(),
+        COMPILECACHE=" ".join([
+            '"$PYTHONEXE"',
+            '"%s"' % join(
+                env.PioPlatform().get_dir(), "builder", "megaavr", "compilecache.py"),
+            "--cache-dir",
+            '"%s"' % env.GetPlatformCacheDir("compile"),
+            "--toolchain",
+            str(env.PioPlatform().get_package_version("toolchain-atmelavr")),
+            "--base-dir",
+            '"$PROJECT_DIR"',
+            "--base-dir",
+            '"$PROJECT_PACKAGES_DIR"',
+            "--",
+        ])
+    )
+    for name in ("CCCOM", "CXXCOM", "ASPPCOM"):
+        env.Replace(**{name: "$COMPILECACHE " + env[name]})
+
 # Allow user to override via pre:script
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
@@ -151,8 +169,21 @@ target_elf = None
 if "nobuild" in COMMAND_LINE_TARGETS:
     target_elf = join("$BUILD_DIR", "${PROGNAME}.elf")
     target_firm = join("$BUILD_DIR", "${PROGNAME}.hex")
+    if isfile(env.subst(target_elf)):
+        # prebuilt artifacts are checked too, the cached usage makes it free
+        AlwaysBuild(env.Alias(
+            "checkprogsize",
+            target_elf,
+            env.VerboseAction(env.CheckUploadSize, "Checking size $SOURCE"),
+        ))
+        env.Depends(target_firm, "checkprogsize")
 else:
     target_elf = env.BuildProgram()
+    if "COMPILECACHE" in env:
+        env.AddPostAction(
+            target_elf,
+            env.VerboseAction(env.ReportCompileCache, "Updating compile cache"),
+        )
     target_firm = env.ElfToHex(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
     env.Depends(target_firm, "checkprogsize")
 
@@ -166,11 +197,69 @@ target_buildprog = env.Alias("buildprog", target_firm, target_firm)
 target_size = env.AddPlatformTarget(
     "size",
     target_elf,
-    env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"),
+    env.VerboseAction(env.PrintProgramSize, "Calculating size $SOURCE"),
     "Program Size",
     "Calculate program size",
 )
 
+#
+# Target: Compare per-symbol sizes with the previous build or a baseline
+#
+
+env.AddPlatformTarget(
+    "sizereport",
+    target_elf,
+    env.VerboseAction(env.ReportSizeChanges, "Comparing size of $SOURCE"),
+    "Size Report",
+    "Show per-symbol size changes against the previous build or a baseline",
+)
+
+env.AddPlatformTarget(
+    "sizebaseline",
+    target_elf,
+    env.VerboseAction(env.SaveSizeBaseline, "Saving size baseline of $SOURCE"),
+    "Save Size Baseline",
+    "Save per-symbol sizes as the `board_build.size_baseline` snapshot",
+)
+
+#
+# Target: Print statistics of the prebuilt core cache
+#
+
+env.AddPlatformTarget(
+    "corecache",
+    None,
+    env.VerboseAction(env.PrintCoreCacheStats, "Reading core cache statistics"),
+    "Core Cache Statistics",
+    "Show hit/miss statistics of the prebuilt Arduino core cache",
+)
+
+#
+# Target: Print statistics of the compile cache
+#
+
+env.AddPlatformTarget(
+    "compilecache",
+    None,
+    env.VerboseAction(env.PrintCompileCacheStats, "Reading compile cache statistics"),
+    "Compile Cache Statistics",
+    "Show hit/miss statistics of the compiler result cache",
+)
+
+upload_protocol = env.subst("$UPLOAD_PROTOCOL")
+if upload_protocol == "serialupdi_native":
+    # fuses and bootloaders are still written by AVRDUDE
+    env.Replace(UPLOAD_PROTOCOL="serialupdi", UPLOAD_NATIVE=True)
+
+env.Replace(
+    # an explicit `upload_speed` of the project always wins
+    UPLOAD_AUTOTUNE=(
+        upload_protocol in ("serialupdi", "serialupdi_native")
+        and env.BoardConfig().get("upload.autotune", "no").lower() == "yes"
+        and not env.GetProjectOption("upload_speed", None)
+    )
+)
+
 #
 # Target: Setup fuses
 #
@@ -178,7 +267,7 @@ target_size = env.AddPlatformTarget(
 fuses_actions = None
 if "fuses" in COMMAND_LINE_TARGETS:
     fuses_actions = [
-        env.VerboseAction(BeforeUpload, "Looking for port..."),
+        env.VerboseAction(env.BeforeUpload, "Looking for port..."),
         env.SConscript("fuses.py", exports="env")
     ]
 env.AddPlatformTarget("fuses", None, fuses_actions, "Set Fuses")
@@ -189,25 +278,25 @@ env.AddPlatformTarget("fuses", None, fuses_actions, "Set Fuses")
 
 bootloader_actions = None
 if "bootloader" in COMMAND_LINE_TARGETS:
-    bootloader_actions = env.SConscript("bootloader.py", exports="env")
+    bootloader_actions = env.SConscript("bootloader.py", exports="env") + [
+        env.Action(env.ForgetFlashedImages, None)
+    ]
 env.AddPlatformTarget("bootloader", None, bootloader_actions, "Burn Bootloader")
 
 #
 # Target: Upload by default .hex file
 #
 
-upload_protocol = env.subst("$UPLOAD_PROTOCOL")
-
 if upload_protocol == "custom":
     upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 else:
     upload_actions = [
-        env.VerboseAction(BeforeUpload, "Looking for upload port..."),
+        env.VerboseAction(env.BeforeUpload, "Looking for upload port..."),
         env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
     ]
 
     upload_options = env.BoardConfig().get("upload", {})
-    if upload_protocol in ("jtag2updi", "serialupdi"):
+    if upload_protocol in ("jtag2updi", "serialupdi", "serialupdi_native"):
         upload_options["require_upload_port"] = True
     elif upload_protocol == "arduino":
         upload_options["require_upload_port"] = True
@@ -216,22 +305,256 @@ else:
         env.Append(UPLOADERFLAGS=["-D"])
 
     board = env.subst("$BOARD")
-    if "upload" in COMMAND_LINE_TARGETS and "arduino" in env.subst("$PIOFRAMEWORK"):
+    if set(["upload", "uploadfleet"]) & set(COMMAND_LINE_TARGETS) and (
+        "arduino" in env.subst("$PIOFRAMEWORK")
+    ):
+        # fleet ports are programmed with the same flags, their fuses can't
+        # be compared one by one
+        skip_unchanged_fuses = env.BoardConfig().get(
+            "upload.skip_unchanged_fuses", "no"
+        ).lower() == "yes" and "uploadfleet" not in COMMAND_LINE_TARGETS
+        if board in ("uno_wifi_rev2", "nano_every") and skip_unchanged_fuses:
+            # fuses are compared with the device right before uploading
+            upload_actions.insert(
+                1, env.VerboseAction(env.PrependChangedFuses, "Reading fuses..."))
+
         if board == "uno_wifi_rev2":
             # uno_wifi_rev2 requires bootloader to be uploaded in any case
             env.SConscript("bootloader.py", exports="env")
-            env.Append(UPLOADERFLAGS=env["FUSESFLAGS"])
+            if not skip_unchanged_fuses:
+                env.Append(UPLOADERFLAGS=env["FUSESFLAGS"])
             env.Append(UPLOADERFLAGS=env["BOOTFLAGS"])
 
         elif board == "nano_every":
             env.SConscript("fuses.py", exports="env")
-            env.Append(UPLOADERFLAGS=env["FUSESFLAGS"])
+            if not skip_unchanged_fuses:
+                env.Append(UPLOADERFLAGS=env["FUSESFLAGS"])
+
+    if env["UPLOAD_AUTOTUNE"]:
+        # a failed upload is retried once at the manifest speed
+        upload_actions[-1] = env.VerboseAction(
+            env.UploadWithFallbackSpeed, "Uploading $SOURCE")
+
+    if env.BoardConfig().get("upload.incremental", "no").lower() == "yes":
+        for option, enabled in (
+            ("`board_upload.autotune`", env["UPLOAD_AUTOTUNE"]),
+            ("`upload_protocol = serialupdi_native`",
+             upload_protocol == "serialupdi_native"),
+        ):
+            if enabled:
+                sys.stderr.write(
+                    "Error: `board_upload.incremental` can't be combined "
+                    "with %s\n" % option
+                )
+                env.Exit(1)
+        upload_actions[-1] = env.VerboseAction(env.UploadIncremental, "Uploading $SOURCE")
+    else:
+        # the flash no longer holds the image remembered for incremental uploads
+        upload_actions.insert(-1, env.Action(env.ForgetFlashedImages, None))
+
+    verify = env.BoardConfig().get("upload.verify", "full").lower()
+    if verify not in VERIFY_STRATEGIES:
+        sys.stderr.write(
+            "Error: Unknown `board_upload.verify = %s`, use one of %s\n"
+            % (verify, ", ".join(VERIFY_STRATEGIES))
+        )
+        env.Exit(1)
+    if upload_protocol == "serialupdi_native":
+        upload_actions[-1] = env.VerboseAction(env.UploadSerialUpdi, "Uploading $SOURCE")
+    elif verify in ("sample", "crc") and "upload" in COMMAND_LINE_TARGETS:
+        sys.stderr.write(
+            "Error: `board_upload.verify = %s` requires "
+            "`upload_protocol = serialupdi_native`\n" % verify
+        )
+        env.Exit(1)
 
 if int(ARGUMENTS.get("PIOVERBOSE", 0)):
     env.Prepend(UPLOADERFLAGS=["-v"])
 
 env.AddPlatformTarget("upload", target_firm, upload_actions, "Upload")
 
+#
+# Target: Probe the fastest stable upload speed of a SerialUPDI adapter
+#
+
+env.AddPlatformTarget(
+    "autotune",
+    None,
+    env.VerboseAction(env.RetuneUploadSpeed, "Tuning upload speed..."),
+    "Autotune Upload Speed",
+    "Probe and remember the fastest upload speed of the adapter and MCU",
+)
+
+#
+# Target: Program fuses, bootloader, firmware and EEPROM in one session
+#
+
+programall_actions = None
+if "programall" in COMMAND_LINE_TARGETS:
+    if upload_protocol in ("custom", "arduino"):
+        sys.stderr.write(
+            "Error: `programall` target requires a programmer, the `%s` upload "
+            "protocol is not supported\n" % upload_protocol
+        )
+        env.Exit(1)
+
+    board_config = env.BoardConfig()
+    build_core = board_config.get("build.core", "")
+    if build_core in ("MegaCoreX", "dxcore"):
+        with_bootloader = board_config.get(
+            "hardware.uart", "no_bootloader").lower() != "no_bootloader"
+    else:
+        with_bootloader = bool(board_config.get("bootloader", {}))
+
+    if with_bootloader:
+        # the bootloader script configures fuses from the "bootloader" section
+        env.SConscript("bootloader.py", exports="env")
+    else:
+        env.SConscript("fuses.py", exports="env")
+
+    skip_unchanged_fuses = board_config.get(
+        "upload.skip_unchanged_fuses", "no").lower() == "yes"
+    env.Replace(
+        EEPROMFLAGS=[],
+        PROGRAMALLCMD=" ".join([
+            "$UPLOADER",
+            "$UPLOADERFLAGS",
+            "" if skip_unchanged_fuses else "$FUSESFLAGS",
+            "$BOOTFLAGS" if with_bootloader else "",
+            "-U flash:w:${SOURCES[0]}:i",
+            "$EEPROMFLAGS",
+        ]),
+    )
+
+    programall_actions = [
+        env.VerboseAction(env.BeforeUpload, "Looking for upload port..."),
+        env.VerboseAction(env.BeforeProgramAll, "Checking EEPROM image..."),
+    ]
+    if skip_unchanged_fuses:
+        programall_actions.append(
+            env.VerboseAction(env.PrependChangedFuses, "Reading fuses..."))
+    programall_actions.extend([
+        env.VerboseAction("$PROGRAMALLCMD", "Programming device..."),
+        env.Action(env.ForgetFlashedImages, None),
+    ])
+
+target_eep = join("$BUILD_DIR", "${PROGNAME}.eep")
+if (
+    set(["programall", "merged", "uploadeep", "verifyeep", "personalize",
+         "uploadpersonalized"]) & set(COMMAND_LINE_TARGETS)
+    and "nobuild" not in COMMAND_LINE_TARGETS
+):
+    target_eep = env.ElfToEep(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
+
+env.AddPlatformTarget(
+    "programall",
+    [target_firm, target_eep],
+    programall_actions,
+    "Program All",
+    "Write fuses, bootloader, firmware and EEPROM in a single programmer session",
+)
+
+#
+# Target: Write or verify EEPROM contents, only changed bytes are written
+#
+
+eeprom_actions = []
+if upload_protocol != "custom":
+    eeprom_actions.append(
+        env.VerboseAction(env.BeforeUpload, "Looking for upload port..."))
+
+env.AddPlatformTarget(
+    "uploadeep",
+    target_eep,
+    eeprom_actions + [env.VerboseAction(env.UploadEeprom, "Uploading $SOURCE")],
+    "Upload EEPROM",
+    "Write only the bytes of the .eep image that differ from the device EEPROM",
+)
+
+env.AddPlatformTarget(
+    "verifyeep",
+    target_eep,
+    eeprom_actions + [env.VerboseAction(env.VerifyEeprom, "Verifying $SOURCE")],
+    "Verify EEPROM",
+    "Compare the device EEPROM with the .eep image without writing",
+)
+
+#
+# Target: Per-device images patched from `board_upload.personalize_records`
+#
+
+env.AddPlatformTarget(
+    "personalize",
+    [target_firm, target_eep],
+    env.VerboseAction(env.BuildPersonalizedImages, "Personalizing $SOURCE"),
+    "Personalize",
+    "Generate a patched firmware/EEPROM/USERROW image for every record",
+)
+
+personalized_actions = [
+    env.VerboseAction(env.UploadPersonalized, "Uploading personalized $SOURCE")]
+if upload_protocol != "custom":
+    personalized_actions.insert(
+        0, env.VerboseAction(env.BeforeUpload, "Looking for upload port..."))
+if "uploadpersonalized" in COMMAND_LINE_TARGETS:
+    # report invalid fields before looking for the upload port
+    env.GetPersonalization()
+
+env.AddPlatformTarget(
+    "uploadpersonalized",
+    [target_firm, target_eep],
+    personalized_actions,
+    "Upload Personalized",
+    "Upload the firmware patched with the next unprogrammed record",
+)
+
+#
+# Target: Build a single image with the bootloader and the application
+#
+
+target_merged = None
+if "merged" in COMMAND_LINE_TARGETS:
+    framework_dir = ""
+    if env.get("PIOFRAMEWORK"):
+        platform = env.PioPlatform()
+        framework_dir = platform.get_package_dir(
+            platform.frameworks[env["PIOFRAMEWORK"][0]]["package"])
+    try:
+        merged_bootloader, _ = env.GetBootloaderCatalog().find(
+            framework_dir, env.BoardConfig(), env.subst("$UPLOAD_SPEED"))
+    except BootloaderError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+
+    target_merged = env.Command(
+        [
+            join("$BUILD_DIR", "${PROGNAME}.merged.hex"),
+            join("$BUILD_DIR", "${PROGNAME}.merged.eep"),
+        ],
+        [target_firm, target_eep, merged_bootloader],
+        env.VerboseAction(env.BuildMergedImage, "Building merged image $TARGET"),
+    )
+
+env.AddPlatformTarget(
+    "merged",
+    target_merged,
+    None,
+    "Merged Image",
+    "Combine the bootloader, firmware and EEPROM into production images",
+)
+
+#
+# Target: Upload the same .hex file to many programmers at once
+#
+
+env.AddPlatformTarget(
+    "uploadfleet",
+    target_firm,
+    env.VerboseAction(env.UploadFleet, "Uploading $SOURCE to fleet"),
+    "Upload Fleet",
+    "Upload firmware to all ports from `board_upload.fleet_ports` in parallel",
+)
+
 #
 # Deprecated target: Upload firmware using external programmer
 #
@@ -249,3 +572,6 @@ if "program" in COMMAND_LINE_TARGETS:
 #
 
 Default([target_buildprog, target_size])
+
+if env.get("TRACER"):
+    env["TRACER"].add("Configuration", "platform", 0, env["TRACER"].now())
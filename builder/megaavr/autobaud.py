@@ -0,0 +1,100 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Upload speed autotuning of SerialUPDI adapters.
+
+Candidate rates are probed in ascending order. Each probe is a short
+handshake that reads the SIB and the signature row several times and
+compares them with the values read at the base rate. The highest rate
+before the first failure is remembered per adapter serial number and MCU,
+and is checked with a single handshake before it's used again.
+"""
+
+import os
+import re
+
+from serial import SerialException
+
+from megaavr.ports import PortCache, get_port_usb_info
+from megaavr.updi import BASE_BAUDRATE, SIGROW, UpdiError, UpdiProgrammer
+
+CANDIDATE_BAUDRATES = (
+    230400, 345600, 460800, 500000, 691200, 921600, 1000000, 1500000, 2000000,
+)
+
+PROBE_ROUNDS = 4
+SIGROW_SIZE = 64
+
+
+def get_adapter_id(port, list_ports=None):
+    """USB serial number of the adapter, the port path if it's unknown"""
+    info = get_port_usb_info(port)
+    if info and info[2]:
+        return info[2]
+    for item in list_ports() if list_ports else []:
+        match = re.search(r"SER=(\S+)", item.get("hwid", ""))
+        if item["port"] == port and match:
+            return match.group(1)
+    return os.path.realpath(port)
+
+
+def _read_identity(programmer):
+    return programmer.link.read_sib() + bytes(programmer.link.read(SIGROW, SIGROW_SIZE))
+
+
+def read_reference(port):
+    """Return the identity of the target read at the base rate"""
+    with UpdiProgrammer(port) as programmer:
+        return _read_identity(programmer)
+
+
+def handshake(port, baudrate, reference, rounds=PROBE_ROUNDS):
+    try:
+        with UpdiProgrammer(port, baudrate) as programmer:
+            for _ in range(rounds):
+                if _read_identity(programmer) != reference:
+                    return False
+    except (IOError, SerialException, UpdiError):
+        return False
+    return True
+
+
+def probe_baudrate(port, base=BASE_BAUDRATE, candidates=CANDIDATE_BAUDRATES,
+                   progress=None):
+    """Return the highest rate that passes the handshake or `base`
+
+    Raises UpdiError if the target doesn't respond at the base rate.
+    """
+    reference = read_reference(port)
+    result = base
+    for baudrate in sorted(candidates):
+        if baudrate <= base:
+            continue
+        passed = handshake(port, baudrate, reference)
+        if progress:
+            progress(baudrate, passed)
+        if not passed:
+            break
+        result = baudrate
+    return result
+
+
+class BaudrateCache(PortCache):
+    """Tuned rates as `{"<adapter>:<mcu>": baudrate}`"""
+
+    def forget(self, key):
+        data = self._load()
+        if data.pop(key, None) is not None:
+            self._save(data)
@@ -0,0 +1,74 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for building and interpreting AVRDUDE command lines
+"""
+
+import re
+
+MEMORY_OP_RE = re.compile(r"^-U(?P<memory>[a-z0-9]+):(?P<op>[rwv]):(?P<value>.+):m$")
+NUMBER_RE = re.compile(r"^\s*(0x[0-9a-f]+|\d+)(\s*,\s*(0x[0-9a-f]+|\d+))*\s*$", re.I)
+
+
+def parse_immediate_writes(flags):
+    """Return `(memory, value)` pairs of `-Umemory:w:value:m` flags"""
+    result = []
+    for flag in flags:
+        match = MEMORY_OP_RE.match(str(flag))
+        if not match or match.group("op") != "w":
+            raise ValueError("Unsupported AVRDUDE memory operation `%s`" % flag)
+        result.append((match.group("memory"), int(match.group("value"), 0)))
+    return result
+
+
+def strip_memory_ops(flags):
+    """Drop chip erase and `-U` operations, keeping only connection options"""
+    result = []
+    skip_next = False
+    for flag in flags:
+        if skip_next:
+            skip_next = False
+            continue
+        flag = str(flag)
+        if flag == "-U":
+            skip_next = True
+            continue
+        if flag.startswith("-U") or flag == "-e":
+            continue
+        result.append(flag)
+    return result
+
+
+def build_read_flags(memories):
+    return ["-U%s:r:-:h" % memory for memory in memories]
+
+
+def parse_read_output(output, memories):
+    """Map values printed by `-Umemory:r:-:h` operations to `memories`
+
+    Multi-byte memories are printed as comma separated bytes and are
+    combined in little-endian order, the same way AVRDUDE treats immediate
+    values. Returns None if the output doesn't match the requested memories.
+    """
+    lines = [line for line in output.splitlines() if NUMBER_RE.match(line)]
+    if len(lines) != len(memories):
+        return None
+    result = {}
+    for memory, line in zip(memories, lines):
+        value = 0
+        for idx, item in enumerate(line.split(",")):
+            value |= int(item.strip(), 0) << (8 * idx)
+        result[memory] = value
+    return result
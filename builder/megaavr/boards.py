@@ -0,0 +1,219 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Index of all board manifests with derived capabilities.
+
+The index is generated once and stored as a single JSON file. It's rebuilt
+automatically when the index format version changes or any manifest in
+`boards/` is added, removed or modified. Boards can be selected with
+`query_boards()`, for example all AVR DB boards with at least 64 KB of flash:
+
+    query_boards(index, family="avr_db", min_flash_size=65536)
+
+Run `python builder/megaavr/boards.py [criteria ...]` to print matching
+boards, where criteria look like `family=avr_db min_flash_size=65536`.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from megaavr.fuses import (  # noqa: E402 pylint: disable=wrong-import-position
+    FAMILIES, FuseError, get_family, get_flash_page_size)
+
+INDEX_VERSION = 1
+
+BOARDS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "boards"
+)
+
+# tinyAVR package pin count by the last digit of the part number
+TINY_PIN_COUNTS = {"2": 8, "4": 14, "6": 20, "7": 24}
+
+
+def get_pin_count(mcu):
+    match = re.match(r"^attiny\d+([2467])$", mcu)
+    if match:
+        return TINY_PIN_COUNTS[match.group(1)]
+    match = re.match(r"^atmega\d+0([89])$", mcu)
+    if match:
+        return 32 if match.group(1) == "8" else 48
+    match = re.match(r"^avr\d+d[abd](\d+)$", mcu)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def get_physical_flash_size(mcu):
+    """Flash size from the part number, `upload.maximum_size` may be smaller"""
+    match = re.match(r"^at(?:tiny|mega)(\d+)\d\d$", mcu) or re.match(
+        r"^avr(\d+)d[abd]\d+$", mcu)
+    if match:
+        return int(match.group(1)) * 1024
+    return None
+
+
+def get_eeprom_size(mcu):
+    """EEPROM size from the part number"""
+    match = re.match(r"^avr\d+d([abd])\d+$", mcu)
+    if match:
+        return 256 if match.group(1) == "d" else 512
+    if re.match(r"^atmega\d+0[89]$", mcu):
+        return 256
+    match = re.match(r"^attiny(\d+)\d\d$", mcu)
+    if match:
+        flash_kb = int(match.group(1))
+        return 64 if flash_kb <= 2 else 128 if flash_kb <= 8 else 256
+    return None
+
+
+def describe_board(manifest):
+    """Board capabilities derived from a manifest"""
+    build = manifest.get("build", {})
+    upload = manifest.get("upload", {})
+    core = build.get("core", "arduino")
+    mcu = build.get("mcu", "").lower()
+    flash_size = int(upload.get("maximum_size", 0))
+    try:
+        family = get_family(manifest)
+    except FuseError:
+        family = None
+    return dict(
+        name=manifest.get("name", ""),
+        vendor=manifest.get("vendor", ""),
+        core=core,
+        mcu=mcu,
+        family=family,
+        pin_count=get_pin_count(mcu),
+        flash_size=flash_size,
+        ram_size=int(upload.get("maximum_ram_size", 0)),
+        flash_page_size=(
+            get_flash_page_size(family, flash_size) if family else None),
+        fuse_names=list(FAMILIES[family]["fuse_names"]) if family else [],
+        f_cpu=build.get("f_cpu", ""),
+        variant=build.get("variant", ""),
+        frameworks=manifest.get("frameworks", []),
+        hwids=build.get("hwids", []),
+        protocol=upload.get("protocol", ""),
+        speed=upload.get("speed"),
+        avrdude_part=mcu,
+        avrdude_package=(
+            "tool-avrdude"
+            if core in ("MegaCoreX", "megatinycore", "dxcore")
+            else "tool-avrdude-megaavr"
+        ),
+        hardware=manifest.get("hardware", {}),
+        has_bootloader_config="bootloader" in manifest,
+    )
+
+
+def get_fingerprint(boards_dir):
+    """Hash of manifest names, sizes and modification times"""
+    hasher = hashlib.sha1(str(INDEX_VERSION).encode())
+    for entry in sorted(os.scandir(boards_dir), key=lambda item: item.name):
+        if not entry.name.endswith(".json"):
+            continue
+        stat = entry.stat()
+        hasher.update(
+            ("%s:%d:%d;" % (entry.name, stat.st_size, stat.st_mtime_ns)).encode()
+        )
+    return hasher.hexdigest()
+
+
+def build_index(boards_dir=BOARDS_DIR):
+    boards = {}
+    for name in sorted(os.listdir(boards_dir)):
+        board_id, ext = os.path.splitext(name)
+        if ext != ".json":
+            continue
+        with open(os.path.join(boards_dir, name)) as fp:
+            boards[board_id] = describe_board(json.load(fp))
+    return dict(
+        version=INDEX_VERSION,
+        fingerprint=get_fingerprint(boards_dir),
+        boards=boards,
+    )
+
+
+def load_index(index_path, boards_dir=BOARDS_DIR):
+    """Read the index from `index_path`, regenerating it when it's stale"""
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+        if (
+            index.get("version") == INDEX_VERSION
+            and index.get("fingerprint") == get_fingerprint(boards_dir)
+        ):
+            return index
+    except (IOError, OSError, ValueError):
+        pass
+
+    index = build_index(boards_dir)
+    try:
+        if not os.path.isdir(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        with open(index_path + ".tmp", "w") as fp:
+            json.dump(index, fp)
+        os.replace(index_path + ".tmp", index_path)
+    except (IOError, OSError):
+        pass
+    return index
+
+
+def query_boards(index, **criteria):
+    """Return sorted IDs of boards matching all criteria
+
+    A criterion is either a field name compared for equality or a numeric
+    field prefixed with `min_`/`max_`, e.g. `min_flash_size=65536`.
+    """
+    result = []
+    for board_id, board in index["boards"].items():
+        matched = True
+        for key, expected in criteria.items():
+            if key.startswith(("min_", "max_")) and key[4:] in board:
+                value = board[key[4:]]
+                if value is None or (
+                    value < expected if key.startswith("min_") else value > expected
+                ):
+                    matched = False
+            elif board.get(key) != expected:
+                matched = False
+            if not matched:
+                break
+        if matched:
+            result.append(board_id)
+    return sorted(result)
+
+
+def main(argv):
+    criteria = {}
+    for item in argv:
+        key, _, value = item.partition("=")
+        criteria[key] = int(value, 0) if re.match(r"^(0x)?\d+$", value) else value
+    index = build_index()
+    for board_id in query_boards(index, **criteria):
+        board = index["boards"][board_id]
+        print("%-22s %-14s %-10s %7d %6d" % (
+            board_id, board["mcu"], board["family"], board["flash_size"],
+            board["ram_size"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
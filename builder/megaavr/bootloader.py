@@ -0,0 +1,321 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Resolution of the Optiboot/DxCore bootloader images shipped with frameworks.
+
+`BootloaderCatalog` indexes every `.hex` file in the "bootloaders" directory
+of a framework package and records the size, the load address and the
+checksum of each image. Files are parsed again only when their modification
+time or size change. Board options are turned into
+an image name, which is then looked up in the catalog; close names are
+suggested when the combination doesn't exist.
+
+Bootloaders of all environments of a project can be checked at once:
+
+    python builder/megaavr/bootloader.py [-d PROJECT_DIR] [-e ENV ...]
+"""
+
+import argparse
+import difflib
+import json
+import os
+import subprocess
+import sys
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from megaavr.boards import BOARDS_DIR  # noqa: E402
+from megaavr.fuses import get_board_value  # noqa: E402
+from megaavr.ihex import HexError, get_bounds, get_checksum, read_hex  # noqa: E402
+
+CATALOG_VERSION = 2
+
+
+class BootloaderError(Exception):
+    pass
+
+
+class NoBootloaderError(BootloaderError):
+    """The board options don't select any bootloader"""
+
+
+def get_optiboot_name(board_config, upload_speed):
+    uart = get_board_value(board_config, "hardware.uart", "no_bootloader").lower()
+    if uart == "no_bootloader":
+        return ""
+    if not uart.endswith(("_alt", "_def")):
+        uart = uart + "_def"
+
+    bootloader_led = get_board_value(board_config, "bootloader.led_pin", "A7").upper()
+    bootloader_speed = get_board_value(board_config, "bootloader.speed", upload_speed)
+    bootloader_file = "Optiboot_mega0_%s_%s_%s.hex" % (
+        uart.upper(), bootloader_speed, bootloader_led)
+
+    return "/".join(
+        ["optiboot", "bootloaders", "mega0", str(bootloader_speed), bootloader_file])
+
+
+def get_dxcore_name(board_config):
+    btld = get_board_value(board_config, "bootloader.class", "")
+    port = get_board_value(board_config, "bootloader.port", "")
+    entry = get_board_value(board_config, "bootloader.entrycond", "")
+
+    if not btld:
+        raise NoBootloaderError("invalid `bootloader.class` in board config!")
+    if not port:
+        raise BootloaderError("invalid `bootloader.port` in board config!")
+
+    bootloader_file = f"{btld}_{port}_{entry}.hex" if entry else f"{btld}_{port}.hex"
+
+    return "hex/" + bootloader_file
+
+
+def get_bootloader_name(board_config, upload_speed=""):
+    """Return the image selected by the board options
+
+    The result is either a path relative to the "bootloaders" directory of
+    the framework or an existing file specified with `bootloader.file`.
+    """
+    core = get_board_value(board_config, "build.core", "")
+    bootloader_file = get_board_value(board_config, "bootloader.file", "")
+    if os.path.isfile(bootloader_file):
+        return bootloader_file
+    if core == "MegaCoreX":
+        if (
+            get_board_value(board_config, "hardware.uart", "no_bootloader").lower()
+            == "no_bootloader"
+        ):
+            raise NoBootloaderError("`no bootloader` selected in board config!")
+        return get_optiboot_name(board_config, upload_speed)
+    if core == "dxcore":
+        return get_dxcore_name(board_config)
+    if not get_board_value(board_config, "bootloader", {}):
+        raise NoBootloaderError("missing bootloader configuration!")
+    return bootloader_file
+
+
+def resolve_bootloader_path(framework_dir, board_config, upload_speed=""):
+    """Return the path of the bootloader image selected by the board options
+
+    The returned file isn't guaranteed to exist, the caller decides how to
+    report a missing image.
+    """
+    name = get_bootloader_name(board_config, upload_speed)
+    if os.path.isfile(name):
+        return name
+    return os.path.join(framework_dir, "bootloaders", name)
+
+
+def describe_image(path):
+    segments = read_hex(path)
+    bounds = get_bounds(segments) or (0, 0)
+    return dict(
+        size=sum(len(chunk) for _, chunk in segments),
+        start=bounds[0],
+        end=bounds[1],
+        checksum="%08X" % get_checksum(segments),
+    )
+
+
+def get_package_id(framework_dir):
+    try:
+        with open(os.path.join(framework_dir, "package.json")) as fp:
+            manifest = json.load(fp)
+        return "%s@%s" % (manifest["name"], manifest["version"])
+    except (IOError, OSError, ValueError, KeyError):
+        return os.path.basename(os.path.normpath(framework_dir))
+
+
+def build_catalog(framework_dir, previous=None):
+    """Return `{name: image}` of all images, names use "/" separators
+
+    Images of `previous` are reused for files that haven't changed.
+    """
+    previous = previous or {}
+    images = {}
+    root = os.path.join(framework_dir, "bootloaders")
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.lower().endswith(".hex"):
+                continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            stat = os.stat(path)
+            image = previous.get(name)
+            if (
+                image
+                and image.get("mtime") == stat.st_mtime_ns
+                and image.get("file_size") == stat.st_size
+            ):
+                images[name] = image
+                continue
+            try:
+                image = describe_image(path)
+            except (IOError, OSError, HexError) as exc:
+                image = dict(error=str(exc))
+            image.update(mtime=stat.st_mtime_ns, file_size=stat.st_size)
+            images[name] = image
+    return images
+
+
+class BootloaderCatalog(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._catalogs = {}
+
+    def get_images(self, framework_dir):
+        package_id = get_package_id(framework_dir)
+        if package_id in self._catalogs:
+            return self._catalogs[package_id]
+
+        path = os.path.join(self.cache_dir, package_id + ".json")
+        previous = None
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+            if data.get("version") == CATALOG_VERSION:
+                previous = data["images"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        images = build_catalog(framework_dir, previous)
+        if images != previous:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                with open(path + ".tmp", "w") as fp:
+                    json.dump(dict(version=CATALOG_VERSION, images=images), fp)
+                os.replace(path + ".tmp", path)
+            except (IOError, OSError):
+                pass
+        self._catalogs[package_id] = images
+        return images
+
+    def lookup(self, framework_dir, name):
+        """Return `(path, image)`, the image is None if it doesn't exist"""
+        if os.path.isfile(name):
+            try:
+                return name, describe_image(name)
+            except (IOError, OSError, HexError) as exc:
+                raise BootloaderError(
+                    "Invalid bootloader image %s: %s" % (name, exc))
+        image = self.get_images(framework_dir).get(name)
+        if image and "error" in image:
+            raise BootloaderError("Invalid bootloader image %s: %s" % (
+                name, image["error"]))
+        return os.path.join(framework_dir, "bootloaders", name), image
+
+    def suggest(self, framework_dir, name, limit=3):
+        return difflib.get_close_matches(
+            name, list(self.get_images(framework_dir)), n=limit, cutoff=0.5)
+
+    def format_missing(self, framework_dir, name):
+        message = "Couldn't find bootloader image %s" % os.path.join(
+            framework_dir, "bootloaders", name)
+        suggestions = self.suggest(framework_dir, name)
+        if suggestions:
+            message += ". Similar images: %s" % ", ".join(suggestions)
+        return message
+
+    def find(self, framework_dir, board_config, upload_speed=""):
+        """Resolve the board options to `(path, image)` or raise BootloaderError"""
+        name = get_bootloader_name(board_config, upload_speed)
+        path, image = self.lookup(framework_dir, name)
+        if image is None:
+            raise BootloaderError(self.format_missing(framework_dir, name))
+        return path, image
+
+
+def get_framework_package(core):
+    if core == "arduino":
+        return "framework-arduino-megaavr"
+    return "framework-arduino-megaavr-%s" % core.lower()
+
+
+def get_project_config(project_dir):
+    output = subprocess.check_output(
+        ["pio", "project", "config", "-d", project_dir, "--json-output"],
+        universal_newlines=True,
+    )
+    return {section: dict(options) for section, options in json.loads(output)}
+
+
+def get_project_board_configs(config, envs=None):
+    """Return `{env: (board_config, upload_speed)}` with `board_*` overrides"""
+    result = {}
+    for section, options in config.items():
+        if not section.startswith("env:") or (envs and section[4:] not in envs):
+            continue
+        if not options.get("board"):
+            continue
+        with open(os.path.join(BOARDS_DIR, "%s.json" % options["board"])) as fp:
+            board_config = json.load(fp)
+        for key, value in options.items():
+            if key.startswith("board_") and "." in key:
+                group, _, name = key[6:].partition(".")
+                board_config.setdefault(group, {})[name] = value
+        result[section[4:]] = (board_config, str(options.get("upload_speed", "")))
+    return result
+
+
+def check_bootloaders(catalog, packages_dir, board_configs):
+    """Return `{env: (ok, message)}` for boards that select a bootloader"""
+    result = {}
+    for name, (board_config, upload_speed) in sorted(board_configs.items()):
+        core = get_board_value(board_config, "build.core", "arduino")
+        framework_dir = os.path.join(packages_dir, get_framework_package(core))
+        try:
+            path, image = catalog.find(
+                framework_dir,
+                board_config,
+                upload_speed or get_board_value(board_config, "upload.speed", ""),
+            )
+            result[name] = (True, "%s (%d bytes at 0x%X, CRC32 %s)" % (
+                os.path.basename(path), image["size"], image["start"],
+                image["checksum"]))
+        except NoBootloaderError:
+            continue
+        except BootloaderError as exc:
+            result[name] = (False, str(exc))
+    return result
+
+
+def main(argv):
+    core_dir = os.environ.get(
+        "PLATFORMIO_CORE_DIR", os.path.join(os.path.expanduser("~"), ".platformio"))
+    parser = argparse.ArgumentParser(description="Check bootloader images")
+    parser.add_argument("-d", "--project-dir", default=os.getcwd())
+    parser.add_argument("-e", "--environment", action="append", dest="envs")
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(core_dir, ".cache", "atmelmegaavr", "bootloaders"))
+    args = parser.parse_args(argv)
+
+    config = get_project_config(args.project_dir)
+    packages_dir = config.get("platformio", {}).get(
+        "packages_dir", os.path.join(core_dir, "packages"))
+    board_configs = get_project_board_configs(config, args.envs)
+    result = check_bootloaders(
+        BootloaderCatalog(args.cache_dir), packages_dir, board_configs)
+    for name, (ok, message) in sorted(result.items()):
+        print("%-24s %-7s %s" % (name, "OK" if ok else "MISSING", message))
+    return 0 if all(ok for ok, _ in result.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
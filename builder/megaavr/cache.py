@@ -0,0 +1,266 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-addressed storage for build artifacts shared between build
+directories, environments and projects.
+
+Every entry is a directory named after its key with a `manifest.json` that
+lists the stored files. Entries are published atomically, so concurrent
+builds either see a complete entry or none at all.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+MANIFEST_NAME = "manifest.json"
+STATS_NAME = "stats.log"
+
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(value):
+    """Convert values like `512MB`, `2G` or `1048576` to a number of bytes"""
+    if isinstance(value, int):
+        return value
+    match = re.match(r"^\s*(\d+)\s*([KMG]?)I?B?\s*$", str(value).upper())
+    if not match:
+        raise ValueError("Invalid size value `%s`" % value)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def hash_tree(path, hasher, extensions=None):
+    """Feed relative paths and contents of all files under `path` to `hasher`"""
+    path = os.path.abspath(path)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if extensions and not name.endswith(extensions):
+                continue
+            file_path = os.path.join(root, name)
+            hasher.update(
+                os.path.relpath(file_path, path).replace(os.sep, "/").encode()
+            )
+            with open(file_path, "rb") as fp:
+                hasher.update(hashlib.sha1(fp.read()).digest())
+    return hasher
+
+
+def get_tree_stamp(path):
+    """Cheap fingerprint of a tree from relative paths, sizes and mtimes"""
+    path = os.path.abspath(path)
+    hasher = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            hasher.update(("%s:%d:%d\n" % (
+                os.path.relpath(file_path, path).replace(os.sep, "/"),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )).encode())
+    return hasher.hexdigest()
+
+
+def get_tree_digest(path, digests_path):
+    """Content hash of a tree, read again only when its stamp changes
+
+    Digests are kept in `digests_path` by the absolute path of the tree.
+    """
+    path = os.path.abspath(path)
+    stamp = get_tree_stamp(path)
+    try:
+        with open(digests_path) as fp:
+            digests = json.load(fp)
+    except (IOError, OSError, ValueError):
+        digests = {}
+    if digests.get(path, [None])[0] == stamp:
+        return digests[path][1]
+
+    digests[path] = [stamp, hash_tree(path, hashlib.sha1()).hexdigest()]
+    if not os.path.isdir(os.path.dirname(digests_path)):
+        os.makedirs(os.path.dirname(digests_path))
+    # parallel builds may race here, the last complete file wins
+    tmp_path = "%s.%d.tmp" % (digests_path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump(digests, fp, indent=2)
+    os.replace(tmp_path, digests_path)
+    return digests[path][1]
+
+
+def relativize_paths(value, base_dirs):
+    """Replace the base directories in `value` with their indices"""
+    is_bytes = isinstance(value, bytes)
+    for idx, base_dir in sorted(
+        enumerate(base_dirs), key=lambda item: len(item[1]), reverse=True
+    ):
+        base_dir = os.path.abspath(base_dir)
+        placeholder = "<base%d>" % idx
+        if is_bytes:
+            value = value.replace(os.fsencode(base_dir), placeholder.encode())
+        else:
+            value = value.replace(base_dir, placeholder)
+    return value
+
+
+def format_size(value):
+    if value < 1024:
+        return "%d B" % value
+    for unit in ("KB", "MB", "GB"):
+        value /= 1024.0
+        if value < 1024 or unit == "GB":
+            return "%.1f %s" % (value, unit)
+
+
+class ArtifactCache(object):
+
+    def __init__(self, root, max_size="512MB"):
+        self.root = root
+        self.max_size = parse_size(max_size)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def record(self, event):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, STATS_NAME), "a") as fp:
+            fp.write("%s\n" % event)
+
+    def lookup(self, key):
+        """Return a `{name: path}` dictionary of stored files or None"""
+        entry_dir = self._entry_dir(key)
+        manifest_path = os.path.join(entry_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as fp:
+                names = json.load(fp)["files"]
+        except (IOError, OSError, ValueError, KeyError):
+            self.record("miss")
+            return None
+
+        files = {name: os.path.join(entry_dir, name) for name in names}
+        if not all(os.path.isfile(path) for path in files.values()):
+            self.record("miss")
+            return None
+
+        # the manifest modification time is used as "last used" mark
+        os.utime(manifest_path, None)
+        self.record("hit")
+        return files
+
+    def store(self, key, files):
+        """Publish `{name: source_path}` files under `key`"""
+        entry_dir = self._entry_dir(key)
+        if os.path.isfile(os.path.join(entry_dir, MANIFEST_NAME)):
+            return entry_dir
+
+        if not os.path.isdir(os.path.dirname(entry_dir)):
+            os.makedirs(os.path.dirname(entry_dir))
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry_dir))
+        try:
+            for name, src in files.items():
+                dst = os.path.join(tmp_dir, name)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.copyfile(src, dst)
+            with open(os.path.join(tmp_dir, MANIFEST_NAME), "w") as fp:
+                json.dump({"files": sorted(files), "created": time.time()}, fp)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another build has published the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return entry_dir
+
+    def _iter_entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                manifest_path = os.path.join(entry_dir, MANIFEST_NAME)
+                if not os.path.isfile(manifest_path):
+                    continue
+                size = 0
+                for root, _, files in os.walk(entry_dir):
+                    size += sum(
+                        os.path.getsize(os.path.join(root, name)) for name in files
+                    )
+                yield entry_dir, os.path.getmtime(manifest_path), size
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits `max_size`"""
+        entries = sorted(self._iter_entries(), key=lambda item: item[1])
+        total = sum(item[2] for item in entries)
+        removed = 0
+        for entry_dir, _, size in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def get_stats_offset(self):
+        try:
+            return os.path.getsize(os.path.join(self.root, STATS_NAME))
+        except OSError:
+            return 0
+
+    def count_events(self, offset=0):
+        """Return `(hits, misses)` recorded after `offset` of the stats log"""
+        hits = misses = 0
+        try:
+            with open(os.path.join(self.root, STATS_NAME)) as fp:
+                fp.seek(offset)
+                for line in fp:
+                    if line.startswith("hit"):
+                        hits += 1
+                    elif line.startswith("miss"):
+                        misses += 1
+        except (IOError, OSError):
+            pass
+        return hits, misses
+
+    def get_stats(self):
+        hits, misses = self.count_events()
+        entries = list(self._iter_entries())
+        return dict(
+            hits=hits,
+            misses=misses,
+            entries=len(entries),
+            size=sum(item[2] for item in entries),
+            max_size=self.max_size,
+        )
+
+    def format_stats(self):
+        stats = self.get_stats()
+        lookups = stats["hits"] + stats["misses"]
+        return "\n".join([
+            "Cache directory: %s" % self.root,
+            "Hits:    %d" % stats["hits"],
+            "Misses:  %d" % stats["misses"],
+            "Hit rate: %.1f%%" % (100.0 * stats["hits"] / lookups if lookups else 0),
+            "Entries: %d" % stats["entries"],
+            "Size:    %s of %s" % (
+                format_size(stats["size"]), format_size(stats["max_size"])),
+        ])
@@ -0,0 +1,237 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiler result cache wrapped around `avr-gcc`/`avr-g++` invocations.
+
+    python compilecache.py --cache-dir DIR --toolchain VERSION \
+        [--base-dir DIR ...] -- avr-gcc -o x.o -c ...
+
+An object is keyed by the preprocessed source, the compiler flags that affect
+code generation, the toolchain version and a hash of the compiler. Include paths and macros only
+change the preprocessed source, so they are left out of the key, which lets
+environments with different search paths share objects.
+
+Line markers are left out as well unless the object records source locations:
+debug information (`-g`) and LTO bytecode (`-flto`), which keeps the file and
+line of every statement for the link-time diagnostics. Paths under the base
+directories (`--base-dir`, the project and the packages) are made relative in
+the markers and in the key, so checkouts at different locations share objects.
+Objects restored that way keep the locations of the checkout that stored them.
+
+Entries are stored in an `ArtifactCache` together with the compiler warnings,
+which are printed again on a hit.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from megaavr.cache import ArtifactCache, relativize_paths  # noqa: E402
+
+CACHE_VERSION = 1
+
+OBJECT_NAME = "object.o"
+STDERR_NAME = "stderr.txt"
+COMPILER_IDS_NAME = "compilers.json"
+
+# preprocessor options, their effect is part of the preprocessed source
+PREPROCESSOR_OPTIONS = ("-I", "-D", "-U", "-iquote", "-isystem", "-include")
+
+LINE_MARKER_RE = re.compile(rb"^# \d+ .*$\n?", re.M)
+
+
+def parse_command(cmd):
+    """Return `(output, source, args)` of a `-c` compiler command or None"""
+    if "-c" not in cmd or "-o" not in cmd:
+        return None
+    args = list(cmd[1:])
+    output_idx = args.index("-o")
+    if output_idx + 1 >= len(args):
+        return None
+    output = args[output_idx + 1]
+    del args[output_idx:output_idx + 2]
+    sources = [
+        arg for arg in args
+        if not arg.startswith("-") and os.path.isfile(arg)
+        and arg.lower().endswith((".c", ".cpp", ".cc", ".cxx", ".s", ".ino"))
+    ]
+    if len(sources) != 1:
+        return None
+    return output, sources[0], args
+
+
+def get_key_args(args, source):
+    result = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+            continue
+        if arg == source:
+            continue
+        if arg in PREPROCESSOR_OPTIONS:
+            skip_next = True
+            continue
+        if arg.startswith(PREPROCESSOR_OPTIONS):
+            continue
+        result.append(arg)
+    return result
+
+
+def get_compiler_id(compiler, cache_dir=None):
+    """Return a content hash of the compiler executable
+
+    Reinstalling the same toolchain gives the same hash. Hashes are kept in
+    `cache_dir` by path, size and modification time, so every installation
+    is read once.
+    """
+    path = os.path.realpath(shutil.which(compiler) or compiler)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.basename(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    ids_path = os.path.join(cache_dir, COMPILER_IDS_NAME) if cache_dir else None
+    ids = {}
+    if ids_path:
+        try:
+            with open(ids_path) as fp:
+                ids = json.load(fp)
+        except (IOError, OSError, ValueError):
+            pass
+    if ids.get(path, [None])[:2] == stamp:
+        return ids[path][2]
+
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    ids[path] = stamp + [hasher.hexdigest()]
+    if ids_path and os.path.isdir(cache_dir):
+        # parallel compilers may race here, the last complete file wins
+        tmp_path = "%s.%d.tmp" % (ids_path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(ids, fp, indent=2)
+        os.replace(tmp_path, ids_path)
+    return ids[path][2]
+
+
+def preprocess(cmd, args):
+    """Return the preprocessed source or None if the preprocessor fails"""
+    pp_args = [arg for arg in args if arg != "-c"]
+    result = subprocess.run(
+        [cmd[0], "-E"] + pp_args + ["-o", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+
+def get_cache_key(cmd, toolchain_version, base_dirs=None, cache_dir=None):
+    """Return `(key, output)` of a compiler command or None if it isn't cacheable"""
+    parsed = parse_command(cmd)
+    if not parsed:
+        return None
+    output, source, args = parsed
+    source_text = preprocess(cmd, args)
+    if source_text is None:
+        return None
+
+    key_args = get_key_args(args, source)
+    records_locations = any(
+        arg.startswith(("-g", "-flto")) and arg != "-g0" for arg in key_args)
+    if records_locations:
+        # paths of the sources are part of the object
+        base_dirs = base_dirs or []
+        key_args.extend([
+            "cwd=%s" % relativize_paths(os.getcwd(), base_dirs),
+            "source=%s" % relativize_paths(source, base_dirs),
+        ])
+        source_text = LINE_MARKER_RE.sub(
+            lambda match: relativize_paths(match.group(0), base_dirs), source_text)
+    else:
+        source_text = LINE_MARKER_RE.sub(b"", source_text)
+
+    hasher = hashlib.sha256()
+    for item in [str(CACHE_VERSION), toolchain_version, get_compiler_id(cmd[0], cache_dir)]:
+        hasher.update(item.encode() + b"\0")
+    for arg in key_args:
+        hasher.update(arg.encode() + b"\0")
+    hasher.update(source_text)
+    return hasher.hexdigest(), output
+
+
+def run_cached(cache, cmd, toolchain_version, base_dirs=None):
+    """Run a compiler command through the cache, return the exit code"""
+    key = get_cache_key(cmd, toolchain_version, base_dirs, cache.root)
+    if not key:
+        return subprocess.call(cmd)
+    key, output = key
+
+    files = cache.lookup(key)
+    if files:
+        output_dir = os.path.dirname(output)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        shutil.copyfile(files[OBJECT_NAME], output)
+        with open(files[STDERR_NAME], "rb") as fp:
+            sys.stderr.buffer.write(fp.read())
+        return 0
+
+    result = subprocess.run(cmd, stderr=subprocess.PIPE)
+    sys.stderr.buffer.write(result.stderr)
+    if result.returncode != 0 or not os.path.isfile(output):
+        return result.returncode
+
+    stderr_path = output + ".stderr"
+    with open(stderr_path, "wb") as fp:
+        fp.write(result.stderr)
+    try:
+        cache.store(key, {OBJECT_NAME: output, STDERR_NAME: stderr_path})
+    finally:
+        os.remove(stderr_path)
+    return 0
+
+
+def main(argv):
+    if "--" not in argv:
+        sys.stderr.write("Usage: compilecache.py --cache-dir DIR "
+                         "--toolchain VERSION [--base-dir DIR ...] -- COMMAND\n")
+        return 2
+    separator = argv.index("--")
+    options, cmd = argv[:separator], argv[separator + 1:]
+    pairs = list(zip(options[::2], options[1::2]))
+    values = dict(pairs)
+    cache = ArtifactCache(values["--cache-dir"])
+    return run_cached(
+        cache,
+        cmd,
+        values.get("--toolchain", ""),
+        [value for option, value in pairs if option == "--base-dir"],
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
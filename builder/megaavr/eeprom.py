@@ -0,0 +1,74 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Differences between the device EEPROM and the desired `.eep` image.
+
+The whole EEPROM is read in one pass and only the bytes that differ are
+written. Bytes not covered by the image are left untouched.
+"""
+
+
+def get_image_bytes(segments):
+    """Return `{address: value}` of all bytes defined by an image"""
+    result = {}
+    for address, chunk in segments:
+        for offset, value in enumerate(chunk):
+            result[address + offset] = value
+    return result
+
+
+def segments_to_bytes(segments, size, fill=0xFF):
+    data = bytearray([fill] * size)
+    for address, chunk in segments:
+        data[address:address + len(chunk)] = chunk[:max(0, size - address)]
+    return data
+
+
+def get_changed_bytes(current, desired):
+    """Return sorted `(address, value)` pairs that differ from the device"""
+    return [
+        (address, value)
+        for address, value in sorted(desired.items())
+        if current[address] != value
+    ]
+
+
+def group_runs(changes, boundary=None):
+    """Join consecutive changes into `(address, data)` runs
+
+    Runs never cross a multiple of `boundary`, so each of them fits one
+    EEPROM page buffer.
+    """
+    runs = []
+    for address, value in changes:
+        if runs:
+            start, data = runs[-1]
+            if start + len(data) == address and not (
+                boundary and address % boundary == 0
+            ):
+                data.append(value)
+                continue
+        runs.append((address, bytearray([value])))
+    return runs
+
+
+def format_changes(changes, current, limit=8):
+    lines = [
+        "  0x%04X: 0x%02X -> 0x%02X" % (address, current[address], value)
+        for address, value in changes[:limit]
+    ]
+    if len(changes) > limit:
+        lines.append("  ... and %d more" % (len(changes) - limit))
+    return "\n".join(lines)
@@ -0,0 +1,265 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minimal reader of 32-bit little-endian AVR ELF files.
+
+Section headers and the symbol table are enough to calculate memory usage
+without spawning `avr-size`. Program headers give the load addresses of the
+sections, which are needed to convert the file the way `avr-objcopy` does.
+
+The usage of a file is stored next to it and reused until its contents
+change, so repeated uploads of the same artifact skip the calculation.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+
+PT_LOAD = 1
+
+STT_OBJECT = 1
+STT_FUNC = 2
+
+PROGRAM_SECTIONS_RE = re.compile(
+    r"^(\.text|\.data|\.rodata|\.bootloader|\.FLMAP_SECTION\d+)$")
+DATA_SECTIONS_RE = re.compile(r"^(\.data|\.bss|\.noinit)$")
+EEPROM_SECTIONS_RE = re.compile(r"^\.eeprom$")
+
+USAGE_CACHE_VERSION = 1
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        self.data = None
+
+    def __enter__(self):
+        self._fp = open(self.path, "rb")
+        try:
+            self.data = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fp.close()
+            raise ElfError("%s is empty" % self.path)
+        if self.data[:4] != b"\x7fELF" or self.data[4:6] != b"\x01\x01":
+            self.close()
+            raise ElfError("%s isn't a 32-bit little-endian ELF file" % self.path)
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def _get_string(self, offset):
+        end = self.data.find(b"\x00", offset)
+        return self.data[offset:end].decode("latin-1")
+
+    def get_sections(self):
+        shoff, = struct.unpack_from("<I", self.data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from("<HHH", self.data, 0x2E)
+        headers = [
+            struct.unpack_from("<10I", self.data, shoff + idx * shentsize)
+            for idx in range(shnum)
+        ]
+        strtab_offset = headers[shstrndx][4] if shstrndx < shnum else 0
+        sections = []
+        for header in headers:
+            sections.append(dict(
+                name=self._get_string(strtab_offset + header[0]),
+                type=header[1],
+                flags=header[2],
+                addr=header[3],
+                offset=header[4],
+                size=header[5],
+                link=header[6],
+                entsize=header[9],
+            ))
+        return sections
+
+    def get_entry(self):
+        return struct.unpack_from("<I", self.data, 0x18)[0]
+
+    def get_program_headers(self):
+        phoff, = struct.unpack_from("<I", self.data, 0x1C)
+        phentsize, phnum = struct.unpack_from("<HH", self.data, 0x2A)
+        headers = []
+        for idx in range(phnum):
+            ptype, offset, vaddr, paddr, filesz, memsz = struct.unpack_from(
+                "<6I", self.data, phoff + idx * phentsize)
+            headers.append(dict(
+                type=ptype, offset=offset, vaddr=vaddr, paddr=paddr,
+                filesz=filesz, memsz=memsz,
+            ))
+        return headers
+
+    def get_load_sections(self, sections=None):
+        """Allocated sections with contents as `(name, lma, data)`
+
+        The load address is derived from the containing PT_LOAD segment the
+        same way as BFD does, sections outside of segments load at their
+        virtual address.
+        """
+        sections = sections or self.get_sections()
+        segments = [
+            item for item in self.get_program_headers() if item["type"] == PT_LOAD
+        ]
+        result = []
+        for section in sections:
+            if (
+                not section["flags"] & SHF_ALLOC
+                or section["type"] == SHT_NOBITS
+                or not section["size"]
+            ):
+                continue
+            lma = section["addr"]
+            for segment in segments:
+                if (
+                    segment["offset"] <= section["offset"]
+                    and section["offset"] + section["size"]
+                    <= segment["offset"] + segment["filesz"]
+                    and segment["vaddr"] <= section["addr"]
+                    and section["addr"] + section["size"]
+                    <= segment["vaddr"] + segment["memsz"]
+                ):
+                    lma = segment["paddr"] + section["offset"] - segment["offset"]
+                    break
+            result.append((
+                section["name"],
+                lma,
+                bytes(self.data[section["offset"]:section["offset"] + section["size"]]),
+            ))
+        return result
+
+    def get_symbols(self, sections=None):
+        """Sized function and object symbols as `(name, section, size)`"""
+        sections = sections or self.get_sections()
+        result = []
+        for symtab in sections:
+            if symtab["type"] != SHT_SYMTAB or not symtab["entsize"]:
+                continue
+            strtab_offset = sections[symtab["link"]]["offset"]
+            for offset in range(
+                symtab["offset"],
+                symtab["offset"] + symtab["size"],
+                symtab["entsize"],
+            ):
+                name, _, size, info, _, shndx = struct.unpack_from(
+                    "<IIIBBH", self.data, offset)
+                if info & 0xF not in (STT_OBJECT, STT_FUNC) or not size:
+                    continue
+                if shndx >= len(sections):
+                    continue
+                result.append((
+                    self._get_string(strtab_offset + name),
+                    sections[shndx]["name"],
+                    size,
+                ))
+        return result
+
+
+def get_memory_usage(path, with_symbols=False):
+    """Calculate program, data and EEPROM usage from the section headers"""
+    with ElfFile(path) as elf:
+        sections = elf.get_sections()
+        usage = dict(program=0, data=0, eeprom=0, sections={}, symbols=[])
+        for section in sections:
+            if not section["flags"] & SHF_ALLOC or not section["size"]:
+                continue
+            name = section["name"]
+            usage["sections"][name] = section["size"]
+            if PROGRAM_SECTIONS_RE.match(name):
+                usage["program"] += section["size"]
+            if DATA_SECTIONS_RE.match(name):
+                usage["data"] += section["size"]
+            if EEPROM_SECTIONS_RE.match(name):
+                usage["eeprom"] += section["size"]
+        if with_symbols:
+            usage["symbols"] = sorted(
+                elf.get_symbols(sections), key=lambda item: (-item[2], item[0]))
+    return usage
+
+
+def get_file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_usage_cache_path(path):
+    return os.path.splitext(path)[0] + ".size.json"
+
+
+def get_cached_memory_usage(path, with_symbols=False):
+    """get_memory_usage() keyed by the content hash of the file"""
+    digest = get_file_hash(path)
+    cache_path = get_usage_cache_path(path)
+    try:
+        with open(cache_path) as fp:
+            cached = json.load(fp)
+        if (
+            cached["version"] == USAGE_CACHE_VERSION
+            and cached["hash"] == digest
+            and (cached["with_symbols"] or not with_symbols)
+        ):
+            usage = cached["usage"]
+            usage["symbols"] = [tuple(item) for item in usage["symbols"]]
+            return usage
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    usage = get_memory_usage(path, with_symbols)
+    try:
+        with open(cache_path + ".tmp", "w") as fp:
+            json.dump(dict(
+                version=USAGE_CACHE_VERSION,
+                hash=digest,
+                with_symbols=with_symbols,
+                usage=usage,
+            ), fp)
+        os.replace(cache_path + ".tmp", cache_path)
+    except (IOError, OSError):
+        # a read-only artifact directory only disables the cache
+        pass
+    return usage
+
+
+def format_usage(value, total):
+    """Same progress bar format as the PlatformIO size checker"""
+    percent_raw = float(value) / float(total)
+    used_blocks = min(int(round(10 * percent_raw)), 10)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * used_blocks, 10, percent_raw, value, total
+    )
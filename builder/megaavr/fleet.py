@@ -0,0 +1,110 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Concurrent upload of the same image to many programmers ("fleet upload").
+
+Every port gets its own uploader process and log file. A failing port never
+stops the uploads that are still running on the other ports.
+"""
+
+import glob
+import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def expand_ports(spec):
+    """Turn a list, a comma/space separated string or glob patterns into ports"""
+    if isinstance(spec, str):
+        spec = re.split(r"[\s,]+", spec)
+    ports = []
+    for item in spec or []:
+        item = item.strip()
+        if not item:
+            continue
+        matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+def get_log_name(port):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", port).strip("_") + ".log"
+
+
+def _upload(port, cmd, log_dir, sysenv):
+    log_path = os.path.join(log_dir, get_log_name(port))
+    start = time.time()
+    with open(log_path, "w") as fp:
+        fp.write("%s\n\n" % cmd)
+        fp.flush()
+        try:
+            returncode = subprocess.call(
+                cmd, shell=True, stdout=fp, stderr=subprocess.STDOUT, env=sysenv
+            )
+        except OSError as exc:
+            fp.write("%s\n" % exc)
+            returncode = -1
+    return dict(
+        port=port,
+        returncode=returncode,
+        duration=time.time() - start,
+        log=log_path,
+    )
+
+
+def run_fleet(commands, jobs, log_dir, sysenv=None, on_result=None):
+    """Run `{port: command}` with at most `jobs` uploads at the same time"""
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            executor.submit(_upload, port, cmd, log_dir, sysenv)
+            for port, cmd in commands.items()
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            if on_result:
+                on_result(result)
+            results.append(result)
+    ports = list(commands)
+    return sorted(results, key=lambda item: ports.index(item["port"]))
+
+
+def format_fleet_summary(results):
+    width = max([len("Port")] + [len(item["port"]) for item in results])
+    lines = [
+        "%-*s  %-7s  %9s  %s" % (width, "Port", "Status", "Duration", "Log"),
+        "%s  %s  %s  %s" % ("-" * width, "-" * 7, "-" * 9, "-" * 3),
+    ]
+    for item in results:
+        lines.append(
+            "%-*s  %-7s  %8.2fs  %s" % (
+                width,
+                item["port"],
+                "SUCCESS" if item["returncode"] == 0 else "FAILED",
+                item["duration"],
+                item["log"],
+            )
+        )
+    failed = len([item for item in results if item["returncode"] != 0])
+    lines.append(
+        "%d succeeded, %d failed" % (len(results) - failed, failed)
+    )
+    return "\n".join(lines)
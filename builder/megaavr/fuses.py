@@ -0,0 +1,308 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Table-driven fuse calculation for megaAVR 0, tinyAVR 0/1/2 and AVR Dx parts.
+
+`compute_fuses()` works on a `PlatformBoardConfig` as well as on a plain
+board manifest dictionary, so fuse sets can be generated without SCons:
+
+    python builder/megaavr/fuses.py [boards_dir] [board_id ...]
+"""
+
+import json
+import os
+import re
+import sys
+
+# Note: the index represents the fuse number
+MEGA_TINY_FUSE_NAMES = (
+    "wdtcfg",
+    "bodcfg",
+    "osccfg",
+    "",  # reserved
+    "tcd0cfg",
+    "syscfg0",
+    "syscfg1",
+    "append",
+    "bootend",
+)
+
+DX_FUSE_NAMES = (
+    "wdtcfg",
+    "bodcfg",
+    "osccfg",
+    "",  # reserved
+    "tcd0cfg",
+    "syscfg0",
+    "syscfg1",
+    "codesize",
+    "bootsize",
+)
+
+MEGA_TINY_BOD_LEVELS = {"4.3v": 0xF4, "2.6v": 0x54, "1.8v": 0x14}
+DX_BOD_LEVELS = {"2.85v": 0x74, "2.7v": 0x54, "2.45v": 0x34, "1.9v": 0x14}
+
+_MEGA_TINY = dict(
+    fuse_names=MEGA_TINY_FUSE_NAMES,
+    bod_levels=MEGA_TINY_BOD_LEVELS,
+    # OSCCFG.FREQSEL selects the 20MHz oscillator for these clock speeds
+    osc20m_clocks=("20000000L", "10000000L", "5000000L"),
+    mvio=False,
+    bootend=0x02,
+    # BOOTEND is specified in 256-byte blocks
+    boot_block_size=256,
+    lockbit=0xC5,
+)
+
+_DX = dict(
+    fuse_names=DX_FUSE_NAMES,
+    bod_levels=DX_BOD_LEVELS,
+    osc20m_clocks=None,
+    mvio=False,
+    bootend=0x01,
+    # BOOTSIZE is specified in 512-byte pages
+    boot_block_size=512,
+    lockbit=0x5CC5C55C,
+)
+
+FAMILIES = {
+    "megaavr0": dict(
+        _MEGA_TINY,
+        title="megaAVR 0-series",
+        core="MegaCoreX",
+        pin_option="rstpin",
+    ),
+    "tinyavr0": dict(
+        _MEGA_TINY,
+        title="tinyAVR 0-series",
+        core="megatinycore",
+        pin_option="updipin",
+    ),
+    "tinyavr1": dict(
+        _MEGA_TINY,
+        title="tinyAVR 1-series",
+        core="megatinycore",
+        pin_option="updipin",
+    ),
+    "tinyavr2": dict(
+        _MEGA_TINY,
+        title="tinyAVR 2-series",
+        core="megatinycore",
+        pin_option="updipin",
+    ),
+    "avr_da": dict(_DX, title="AVR DA", core="dxcore", pin_option="rstpin"),
+    "avr_db": dict(_DX, title="AVR DB", core="dxcore", pin_option="rstpin", mvio=True),
+    "avr_dd": dict(_DX, title="AVR DD", core="dxcore", pin_option="rstpin"),
+}
+
+# Cores that calculate fuses from the "hardware" board options
+DYNAMIC_FUSES_CORES = ("MegaCoreX", "megatinycore", "dxcore")
+
+# Used for MCUs that aren't recognized by name
+CORE_DEFAULT_FAMILIES = {
+    "MegaCoreX": "megaavr0",
+    "megatinycore": "tinyavr1",
+    "dxcore": "avr_da",
+}
+
+
+class FuseError(Exception):
+    pass
+
+
+def get_board_value(board_config, path, default=None):
+    if not isinstance(board_config, dict):
+        # PlatformBoardConfig resolves dotted paths on its own
+        return board_config.get(path, default)
+    value = board_config
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def get_family(board_config):
+    mcu = get_board_value(board_config, "build.mcu", "").lower()
+    if re.match(r"^atmega\d+0[89]$", mcu):
+        return "megaavr0"
+    match = re.match(r"^attiny\d*([012])\d$", mcu)
+    if match:
+        return "tinyavr%s" % match.group(1)
+    match = re.match(r"^avr\d+d([abd])\d+$", mcu)
+    if match:
+        return "avr_d%s" % match.group(1)
+    core = get_board_value(board_config, "build.core", "")
+    if core in CORE_DEFAULT_FAMILIES:
+        return CORE_DEFAULT_FAMILIES[core]
+    raise FuseError("Unknown MCU family for `%s`" % (mcu or core))
+
+
+def get_fuse_names(board_config):
+    return FAMILIES[get_family(board_config)]["fuse_names"]
+
+
+def get_options(board_config):
+    """Normalized "hardware" options the fuses are calculated from"""
+    family = FAMILIES[get_family(board_config)]
+    uart = get_board_value(board_config, "hardware.uart", "no_bootloader").lower()
+    if family["pin_option"] == "rstpin":
+        pin = get_board_value(board_config, "hardware.rstpin", "reset").lower()
+        # Guard that prevents the user from turning the reset pin
+        # into a GPIO while using a bootloader
+        if uart != "no_bootloader":
+            pin = "reset"
+    else:
+        pin = get_board_value(board_config, "hardware.updipin", "updi").lower()
+    return dict(
+        f_cpu=get_board_value(board_config, "build.f_cpu", "16000000L").upper(),
+        oscillator=get_board_value(board_config, "hardware.oscillator", "internal").lower(),
+        bod=get_board_value(board_config, "hardware.bod", "2.6v").lower(),
+        uart=uart,
+        eesave=get_board_value(board_config, "hardware.eesave", "yes").lower(),
+        mvio=get_board_value(board_config, "hardware.mvio_enable", "no").lower(),
+        pin=pin,
+    )
+
+
+def calculate_fuses(family_id, options):
+    """Return `{fuse_name: value}` calculated from normalized options"""
+    family = FAMILIES[family_id]
+    fuse_names = family["fuse_names"]
+
+    if family["osc20m_clocks"] is None:
+        osccfg = 0x00
+    elif (
+        options["f_cpu"] in family["osc20m_clocks"]
+        and options["oscillator"] == "internal"
+    ):
+        osccfg = 0x02
+    else:
+        osccfg = 0x01
+
+    eesave_bit = 1 if options["eesave"] == "yes" else 0
+    if family["pin_option"] == "rstpin":
+        rstpin_bit = 0 if options["pin"] == "gpio" else 1
+        syscfg0 = 0xC0 | rstpin_bit << 3 | eesave_bit
+    else:
+        updipin_bits = {"gpio": 0, "updi": 1}.get(options["pin"], 2)
+        syscfg0 = 0xC0 | updipin_bits << 2 | eesave_bit
+
+    if family["mvio"]:
+        syscfg1 = 0x0E if options["mvio"] == "yes" else 0x16
+    else:
+        syscfg1 = 0x06
+
+    values = (
+        0x00,  # wdtcfg
+        # BOD is disabled for unknown levels
+        family["bod_levels"].get(options["bod"], 0x00),
+        osccfg,
+        None,  # reserved
+        0x00,  # tcd0cfg
+        syscfg0,
+        syscfg1,
+        0x00,  # append / codesize
+        0x00 if options["uart"] == "no_bootloader" else family["bootend"],
+    )
+    return {
+        name: value for name, value in zip(fuse_names, values) if name
+    }
+
+
+def compute_fuses(board_config, section="fuses"):
+    """Return the ordered `{fuse_name: "0x.."}` set including "lockbit"
+
+    Values specified in the `section` of the board configuration take
+    precedence over the calculated ones.
+    """
+    family_id = get_family(board_config)
+    family = FAMILIES[family_id]
+    core = get_board_value(board_config, "build.core", "")
+    predefined = get_board_value(board_config, section, {}) or {}
+
+    calculated = {}
+    if core in DYNAMIC_FUSES_CORES:
+        calculated = {
+            name: "0x%.2X" % value
+            for name, value in calculate_fuses(family_id, get_options(board_config)).items()
+        }
+    elif not predefined:
+        raise FuseError(
+            "Dynamic fuses generation for %s / %s is not supported"
+            % (core, get_board_value(board_config, "build.mcu", ""))
+        )
+
+    result = {}
+    for name in family["fuse_names"]:
+        if name and (predefined.get(name) or calculated.get(name)):
+            result[name] = predefined.get(name) or calculated[name]
+    result["lockbit"] = predefined.get("lockbit", "0x%.2X" % family["lockbit"])
+    return result
+
+
+def get_boot_size(family_id, fuses):
+    """Size in bytes of the boot section described by computed `fuses`"""
+    family = FAMILIES[family_id]
+    boot_fuse = family["fuse_names"][8]
+    return int(fuses.get(boot_fuse, "0"), 0) * family["boot_block_size"]
+
+
+def get_flash_page_size(family_id, flash_size):
+    if family_id.startswith("avr_d"):
+        return 512
+    # megaAVR 0 and tinyAVR parts with 32 KB and more use 128-byte pages
+    return 128 if flash_size >= 32768 else 64
+
+
+def get_userrow_size(family_id):
+    # megaAVR 0 parts have a 64-byte USERROW, the other families 32 bytes
+    return 64 if family_id == "megaavr0" else 32
+
+
+def compute_all_fuses(boards_dir, board_ids=None):
+    """Calculate fuses of every board manifest from `boards_dir` in one pass"""
+    result = {}
+    for name in sorted(os.listdir(boards_dir)):
+        board_id, ext = os.path.splitext(name)
+        if ext != ".json" or (board_ids and board_id not in board_ids):
+            continue
+        with open(os.path.join(boards_dir, name)) as fp:
+            manifest = json.load(fp)
+        # boards with static fuses may only define them for the bootloader
+        section = "fuses"
+        if "fuses" not in manifest and "bootloader" in manifest:
+            section = "bootloader"
+        try:
+            result[board_id] = dict(
+                family=get_family(manifest), fuses=compute_fuses(manifest, section)
+            )
+        except FuseError as exc:
+            result[board_id] = dict(error=str(exc))
+    return result
+
+
+def main(argv):
+    boards_dir = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "boards"
+    )
+    if argv and os.path.isdir(argv[0]):
+        boards_dir = argv.pop(0)
+    json.dump(compute_all_fuses(boards_dir, argv), sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
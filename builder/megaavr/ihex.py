@@ -0,0 +1,161 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Intel HEX reading, merging and writing.
+
+An image is a list of `(address, bytearray)` segments sorted by address.
+Records are written the same way as the BFD `ihex` target of `avr-objcopy`:
+16 data bytes per record, CRLF line endings and extended segment/linear
+address records for data above 64 KB.
+"""
+
+import zlib
+
+RECORD_SIZE = 16
+
+
+class HexError(Exception):
+    pass
+
+
+def parse_hex(lines, name="<hex>"):
+    """Return the image described by Intel HEX `lines`"""
+    data = {}
+    base = 0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise HexError("%s:%d: invalid record" % (name, lineno))
+        try:
+            record = bytearray.fromhex(line[1:])
+        except ValueError:
+            raise HexError("%s:%d: invalid record" % (name, lineno))
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise HexError("%s:%d: invalid record length" % (name, lineno))
+        if sum(record) & 0xFF:
+            raise HexError("%s:%d: checksum mismatch" % (name, lineno))
+        rtype = record[3]
+        payload = record[4:-1]
+        if rtype == 0x00:
+            address = base + (record[1] << 8 | record[2])
+            for offset, value in enumerate(payload):
+                data[address + offset] = value
+        elif rtype == 0x01:
+            break
+        elif rtype == 0x02:
+            base = (payload[0] << 8 | payload[1]) << 4
+        elif rtype == 0x04:
+            base = (payload[0] << 8 | payload[1]) << 16
+        elif rtype not in (0x03, 0x05):
+            raise HexError("%s:%d: unknown record type %d" % (name, lineno, rtype))
+    return to_segments(data)
+
+
+def read_hex(path):
+    with open(path) as fp:
+        return parse_hex(fp, path)
+
+
+def to_segments(data):
+    """Turn an `{address: byte}` dictionary into sorted contiguous segments"""
+    segments = []
+    for address in sorted(data):
+        if segments and segments[-1][0] + len(segments[-1][1]) == address:
+            segments[-1][1].append(data[address])
+        else:
+            segments.append((address, bytearray([data[address]])))
+    return segments
+
+
+def get_bounds(segments):
+    if not segments:
+        return None
+    return segments[0][0], segments[-1][0] + len(segments[-1][1])
+
+
+def merge_images(images):
+    """Combine `{name: segments}` images, raising HexError on any overlap"""
+    owners = {}
+    data = {}
+    for name, segments in images.items():
+        for address, chunk in segments:
+            for offset, value in enumerate(chunk):
+                if address + offset in owners:
+                    raise HexError(
+                        "`%s` overlaps `%s` at 0x%X"
+                        % (name, owners[address + offset], address + offset)
+                    )
+                owners[address + offset] = name
+                data[address + offset] = value
+    return to_segments(data)
+
+
+def get_checksum(segments):
+    """CRC32 over all data bytes, used to identify an image"""
+    crc = 0
+    for address, chunk in segments:
+        crc = zlib.crc32(address.to_bytes(4, "little"), crc)
+        crc = zlib.crc32(bytes(chunk), crc)
+    return crc & 0xFFFFFFFF
+
+
+def format_record(rtype, address, payload=b""):
+    record = bytearray([len(payload), (address >> 8) & 0xFF, address & 0xFF, rtype])
+    record.extend(payload)
+    record.append(-sum(record) & 0xFF)
+    return ":%s\r\n" % record.hex().upper()
+
+
+def iter_records(segments, start_address=0):
+    segbase = extbase = 0
+    for address, chunk in segments:
+        offset = 0
+        while offset < len(chunk):
+            where = address + offset
+            size = min(len(chunk) - offset, RECORD_SIZE)
+            if where > segbase + extbase + 0xFFFF:
+                if extbase == 0 and where <= 0xFFFFF:
+                    segbase = where & 0xF0000
+                    yield format_record(0x02, 0, (segbase >> 4).to_bytes(2, "big"))
+                else:
+                    if segbase:
+                        yield format_record(0x02, 0, b"\x00\x00")
+                        segbase = 0
+                    extbase = where & 0xFFFF0000
+                    yield format_record(0x04, 0, (extbase >> 16).to_bytes(2, "big"))
+            rec_address = where - (extbase + segbase)
+            # records never cross 64 KB boundaries
+            size = min(size, 0x10000 - rec_address)
+            yield format_record(
+                0x00, rec_address, bytes(chunk[offset:offset + size])
+            )
+            offset += size
+    if start_address:
+        if start_address <= 0xFFFFF:
+            yield format_record(0x03, 0, bytes([
+                (start_address & 0xF0000) >> 12, 0,
+                (start_address >> 8) & 0xFF, start_address & 0xFF,
+            ]))
+        else:
+            yield format_record(0x05, 0, start_address.to_bytes(4, "big"))
+    yield format_record(0x01, 0)
+
+
+def write_hex(path, segments, start_address=0):
+    with open(path, "w", newline="") as fp:
+        for record in iter_records(segments, start_address):
+            fp.write(record)
@@ -0,0 +1,126 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental flash programming.
+
+The image last written to a device is remembered per port and device identity
+(signature and serial number). A new image is compared with it page by page
+and only the pages that differ are written, without a chip erase.
+
+The device may have been programmed by other means since, so the pages about
+to be written and a sample of the rest are read back first, and the whole
+image is uploaded if they don't match the remembered one.
+"""
+
+import os
+import re
+
+from megaavr.ihex import HexError, read_hex, to_segments, write_hex
+
+SAMPLE_PAGES = 8
+
+
+def get_pages(segments, page_size):
+    """Split an image into `{page_address: bytearray}` padded with 0xFF"""
+    pages = {}
+    for address, chunk in segments:
+        for offset, value in enumerate(chunk):
+            page_address = (address + offset) - (address + offset) % page_size
+            if page_address not in pages:
+                pages[page_address] = bytearray(b"\xff" * page_size)
+            pages[page_address][(address + offset) % page_size] = value
+    return pages
+
+
+def get_changed_pages(device_pages, pages):
+    """Addresses of `pages` whose content isn't known to be on the device"""
+    return sorted(
+        address for address, page in pages.items()
+        if device_pages.get(address) != page
+    )
+
+
+def get_sample_pages(pages, count=SAMPLE_PAGES):
+    """Addresses of the first, the last and evenly spaced pages in between"""
+    addresses = sorted(pages)
+    if len(addresses) <= count:
+        return addresses
+    step = (len(addresses) - 1) / float(count - 1)
+    return sorted(set(addresses[round(idx * step)] for idx in range(count)))
+
+
+def get_check_pages(device_pages, changed, page_size):
+    """Pages to compare with the device before a partial write, `{address:
+    page}` with the content the device is expected to have"""
+    addresses = set(changed) | set(get_sample_pages(device_pages))
+    return {
+        address: device_pages.get(address, bytearray(b"\xff" * page_size))
+        for address in addresses
+    }
+
+
+def pages_to_segments(pages):
+    data = {}
+    for address, page in pages.items():
+        for offset, value in enumerate(page):
+            data[address + offset] = value
+    return to_segments(data)
+
+
+class FlashedImages(object):
+    """Storage of the last image programmed to each device"""
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def _slug(value):
+        return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value)).strip("_")
+
+    def _path(self, port, mcu, device_ids):
+        return os.path.join(
+            self.root,
+            "%s-%s-%s.hex" % (
+                self._slug(port),
+                self._slug(mcu),
+                "-".join("%X" % value for value in device_ids),
+            ),
+        )
+
+    def load(self, port, mcu, device_ids, page_size):
+        path = self._path(port, mcu, device_ids)
+        if not os.path.isfile(path):
+            return None
+        try:
+            return get_pages(read_hex(path), page_size)
+        except HexError:
+            # a damaged record is as good as a missing one
+            return None
+
+    def save(self, port, mcu, device_ids, pages):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        path = self._path(port, mcu, device_ids)
+        write_hex(path + ".tmp", pages_to_segments(pages))
+        os.replace(path + ".tmp", path)
+
+    def forget(self, port):
+        """Drop every image programmed via `port`, e.g. after a chip erase"""
+        if not os.path.isdir(self.root):
+            return
+        prefix = self._slug(port) + "-"
+        for name in os.listdir(self.root):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.root, name))
@@ -0,0 +1,239 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Board matrix builds with object files shared between compatible environments.
+
+Environments are grouped by their effective compiler invocation (compiler,
+flags including `-mmcu`, defines such as `F_CPU`, `CLOCK_SOURCE` or
+`MILLIS_USE_TIMER*`, and include paths). All builds share one SCons cache
+directory. The first environments of all groups are built first, side by side
+with the jobs split between them, and fill the cache, so the other
+environments of the groups only fetch the objects and link. These remaining
+builds run in parallel, one per CPU core.
+
+    python builder/megaavr/matrix.py [-d PROJECT_DIR] [-e ENV ...] [-j JOBS]
+
+With `--check-bootloaders` the bootloader images selected by the board
+options of all environments are looked up first and nothing is built if one
+of them is missing.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from megaavr.bootloader import (BootloaderCatalog,  # noqa: E402
+                                check_bootloaders, get_project_board_configs,
+                                get_project_config)
+
+
+# Environment variable read by "builder/main.py"
+SHARED_OBJECTS_ENV_VAR = "PLATFORMIO_MEGAAVR_SHARED_OBJECTS"
+
+
+def parse_json_output(output):
+    """Return the JSON document printed by `pio` after the build output"""
+    for line in reversed(output.splitlines()):
+        if not line.startswith(("{", "[")):
+            continue
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    raise ValueError("No JSON document in the output of `pio`")
+
+
+def get_project_envs(project_dir):
+    output = subprocess.check_output(
+        ["pio", "project", "config", "-d", project_dir, "--json-output"],
+        universal_newlines=True,
+    )
+    return [
+        section[4:]
+        for section, _ in parse_json_output(output)
+        if section.startswith("env:")
+    ]
+
+
+def get_metadata(project_dir, envs):
+    cmd = ["pio", "project", "metadata", "-d", project_dir, "--json-output"]
+    for name in envs:
+        cmd.extend(["-e", name])
+    output = subprocess.check_output(cmd, universal_newlines=True)
+    return parse_json_output(output)
+
+
+def get_group_key(name, metadata):
+    """Hash of everything that affects the produced object files"""
+
+    def _normalize(path):
+        # per-environment directories don't affect the objects
+        return re.sub(
+            r"([\\/]\.pio[\\/](?:build|libdeps)[\\/])%s([\\/]|$)" % re.escape(name),
+            r"\1$PIOENV\2",
+            path,
+        )
+
+    includes = []
+    for group in sorted(metadata.get("includes", {})):
+        includes.extend(_normalize(path) for path in metadata["includes"][group])
+    return hashlib.sha1(json.dumps([
+        metadata.get("cc_path"),
+        metadata.get("cxx_path"),
+        metadata.get("cc_flags"),
+        metadata.get("cxx_flags"),
+        sorted(metadata.get("defines", [])),
+        includes,
+    ]).encode()).hexdigest()[:12]
+
+
+def group_envs(metadata):
+    """Return `{group_key: [env, ...]}` preserving the environment order"""
+    groups = {}
+    for name, data in metadata.items():
+        groups.setdefault(get_group_key(name, data), []).append(name)
+    return groups
+
+
+def build_env(project_dir, name, jobs, log_dir, sysenv):
+    log_path = os.path.join(log_dir, "%s.log" % name)
+    start = time.time()
+    with open(log_path, "w") as fp:
+        returncode = subprocess.call(
+            ["pio", "run", "-d", project_dir, "-e", name, "-j", str(jobs)],
+            stdout=fp,
+            stderr=subprocess.STDOUT,
+            env=sysenv,
+        )
+    return dict(
+        env=name, returncode=returncode, duration=time.time() - start, log=log_path
+    )
+
+
+def split_jobs(jobs, count):
+    """Spread `jobs` over `count` builds, every build gets at least one"""
+    return [
+        max(1, jobs // count + (1 if idx < jobs % count else 0))
+        for idx in range(count)
+    ]
+
+
+def find_missing_bootloaders(project_dir, envs, cache_dir):
+    config = get_project_config(project_dir)
+    core_dir = os.environ.get(
+        "PLATFORMIO_CORE_DIR", os.path.join(os.path.expanduser("~"), ".platformio"))
+    packages_dir = config.get("platformio", {}).get(
+        "packages_dir", os.path.join(core_dir, "packages"))
+    result = check_bootloaders(
+        BootloaderCatalog(os.path.join(cache_dir, "bootloaders")),
+        packages_dir,
+        get_project_board_configs(config, envs),
+    )
+    return {name: message for name, (ok, message) in result.items() if not ok}
+
+
+def run_matrix(project_dir, envs=None, jobs=None, cache_dir=None,
+               check_bootloader_images=False):
+    project_dir = os.path.abspath(project_dir)
+    jobs = jobs or os.cpu_count() or 1
+    workspace_dir = os.path.join(project_dir, ".pio")
+    cache_dir = cache_dir or os.path.join(workspace_dir, "matrix", "cache")
+    log_dir = os.path.join(workspace_dir, "matrix", "logs")
+    for path in (cache_dir, log_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    envs = envs or get_project_envs(project_dir)
+    if check_bootloader_images:
+        missing = find_missing_bootloaders(project_dir, envs, cache_dir)
+        for name, message in sorted(missing.items()):
+            print("%-24s %s" % (name, message))
+        if missing:
+            print("Bootloader check failed, nothing was built")
+            return False
+
+    groups = group_envs(get_metadata(project_dir, envs))
+    for key, names in groups.items():
+        print("Group %s: %s" % (key, ", ".join(names)))
+
+    # SCons sets up a missing cache directory atomically, but the leaders
+    # running side by side would race on adding the config to an empty one
+    sysenv = dict(
+        os.environ, PLATFORMIO_BUILD_CACHE_DIR=os.path.join(cache_dir, "objects"),
+        **{SHARED_OBJECTS_ENV_VAR: "1"})
+    results = []
+
+    def _report(result):
+        results.append(result)
+        print("%-24s %-7s %8.2fs" % (
+            result["env"],
+            "SUCCESS" if result["returncode"] == 0 else "FAILED",
+            result["duration"],
+        ))
+
+    # group leaders compile every translation unit once, together they use
+    # all cores
+    leaders = [names[0] for names in groups.values()]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(leaders), jobs))) as executor:
+        futures = [
+            executor.submit(build_env, project_dir, name, leader_jobs, log_dir, sysenv)
+            for name, leader_jobs in zip(leaders, split_jobs(jobs, len(leaders)))
+        ]
+        for future in futures:
+            _report(future.result())
+
+    # the rest mostly fetch cached objects and link, one build per core
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(build_env, project_dir, name, 1, log_dir, sysenv)
+            for names in groups.values()
+            for name in names[1:]
+        ]
+        for future in futures:
+            _report(future.result())
+
+    failed = [item for item in results if item["returncode"] != 0]
+    print("%d succeeded, %d failed, logs in %s" % (
+        len(results) - len(failed), len(failed), log_dir))
+    return not failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build a board matrix")
+    parser.add_argument("-d", "--project-dir", default=os.getcwd())
+    parser.add_argument("-e", "--environment", action="append", dest="envs")
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("--cache-dir")
+    parser.add_argument(
+        "--check-bootloaders", action="store_true",
+        help="abort if a bootloader image of an environment is missing")
+    args = parser.parse_args(argv)
+    return 0 if run_matrix(
+        args.project_dir, args.envs, args.jobs, args.cache_dir,
+        args.check_bootloaders) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
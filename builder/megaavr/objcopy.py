@@ -0,0 +1,80 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process replacement of the `avr-objcopy` conversions used by the builder.
+
+An ELF file is read once and the loaded sections are shared by all outputs:
+
+* `.hex`: `-O ihex -R .eeprom`
+* `.bin`: `-O binary -R .eeprom`
+* `.eep`: `-O ihex -j .eeprom --change-section-lma .eeprom=0`
+
+Every section is written as its own chunk in load address order, and the
+entry point is kept as a start address record, which makes the output
+byte-identical to the BFD backends.
+"""
+
+import os
+
+from megaavr.elf import ElfFile
+from megaavr.ihex import write_hex
+
+EEPROM_SECTION = ".eeprom"
+
+_images = {}
+
+
+def load_images(path):
+    """Return `(firmware, eeprom, entry)`, images are `(lma, data)` lists"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _images:
+        with ElfFile(path) as elf:
+            sections = elf.get_load_sections()
+            entry = elf.get_entry()
+        firmware = sorted(
+            ((lma, data) for name, lma, data in sections if name != EEPROM_SECTION),
+            key=lambda item: item[0],
+        )
+        eeprom = [(0, data) for name, _, data in sections if name == EEPROM_SECTION]
+        # only the latest revision of a file is kept
+        _images.clear()
+        _images[key] = (firmware, eeprom, entry)
+    return _images[key]
+
+
+def write_firmware_hex(elf_path, hex_path):
+    firmware, _, entry = load_images(elf_path)
+    write_hex(hex_path, firmware, entry)
+
+
+def write_eeprom_hex(elf_path, eep_path):
+    _, eeprom, entry = load_images(elf_path)
+    write_hex(eep_path, eeprom, entry)
+
+
+def write_firmware_bin(elf_path, bin_path):
+    """Raw image from the lowest load address, gaps are filled with zeros"""
+    firmware, _, _ = load_images(elf_path)
+    data = bytearray()
+    if firmware:
+        low = firmware[0][0]
+        for lma, chunk in firmware:
+            end = lma - low + len(chunk)
+            if end > len(data):
+                data.extend(bytes(end - len(data)))
+            data[lma - low:end] = chunk
+    with open(bin_path, "wb") as fp:
+        fp.write(data)
@@ -0,0 +1,171 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-device personalization of already built images.
+
+Fields are described as `name=memory:address:type`, for example
+
+    serial=flash:0x7F00:u32, cal=eeprom:0x10:u16, key=userrow:0x0:hex16
+
+where `memory` is `flash`, `eeprom` or `userrow` and `type` is one of
+`u8`, `u16`, `u32`, `u64` (little-endian integers), `hexN` (N bytes given as
+a hex string) or `strN` (ASCII text padded with zeros to N bytes).
+
+Records come from a CSV file with a header row or from a JSON lines file,
+one object per unit, and are read one at a time. Base images are loaded
+once, a patched image copies only the segments that contain a field.
+"""
+
+import csv
+import json
+import re
+
+from megaavr.ihex import to_segments
+
+MEMORIES = ("flash", "eeprom", "userrow")
+
+FIELD_RE = re.compile(
+    r"^(?P<name>[\w.-]+)\s*=\s*(?P<memory>[a-z]+):(?P<address>0x[0-9a-f]+|\d+)"
+    r":(?P<type>u8|u16|u32|u64|hex\d+|str\d+)$",
+    re.I,
+)
+
+
+class PersonalizeError(Exception):
+    pass
+
+
+def get_field_size(field_type):
+    if field_type.startswith("u"):
+        return int(field_type[1:]) // 8
+    return int(field_type[3:])
+
+
+def parse_fields(value):
+    """Return `(name, memory, address, type)` tuples of a fields option"""
+    fields = []
+    items = value if isinstance(value, list) else value.split(",")
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+        match = FIELD_RE.match(item)
+        if not match or match.group("memory").lower() not in MEMORIES:
+            raise PersonalizeError("Invalid personalization field `%s`" % item)
+        fields.append((
+            match.group("name"),
+            match.group("memory").lower(),
+            int(match.group("address"), 0),
+            match.group("type").lower(),
+        ))
+    if not fields:
+        raise PersonalizeError("No personalization fields are specified")
+    return fields
+
+
+def check_fields(fields, memory_sizes):
+    """Raise PersonalizeError if a field is out of its memory or overlaps another"""
+    used = {}
+    for name, memory, address, field_type in fields:
+        end = address + get_field_size(field_type)
+        size = memory_sizes.get(memory)
+        if size is not None and end > size:
+            raise PersonalizeError(
+                "Field `%s` (0x%X-0x%X) doesn't fit %d bytes of %s" % (
+                    name, address, end - 1, size, memory))
+        for offset in range(address, end):
+            owner = used.setdefault((memory, offset), name)
+            if owner != name:
+                raise PersonalizeError(
+                    "Field `%s` overlaps `%s` in %s at 0x%X" % (
+                        name, owner, memory, offset))
+
+
+def encode_value(value, field_type):
+    size = get_field_size(field_type)
+    text = str(value).strip()
+    try:
+        if field_type.startswith("u"):
+            number = value if isinstance(value, int) else int(
+                text, 16 if text.lower().startswith("0x") else 10)
+            return number.to_bytes(size, "little")
+        if field_type.startswith("hex"):
+            data = bytes.fromhex(text.replace(":", "").replace(" ", ""))
+        else:
+            data = text.encode("ascii")
+    except (ValueError, OverflowError, UnicodeEncodeError):
+        raise PersonalizeError("Invalid %s value `%s`" % (field_type, value))
+    if len(data) > size or (field_type.startswith("hex") and len(data) != size):
+        raise PersonalizeError(
+            "Value `%s` doesn't match %d bytes of %s" % (value, size, field_type))
+    return data.ljust(size, b"\x00")
+
+
+def iter_records(path):
+    """Yield `(index, record)` pairs from a CSV or a JSON lines file"""
+    with open(path, newline="") as fp:
+        if path.lower().endswith((".jsonl", ".json", ".ndjson")):
+            for index, line in enumerate(fp):
+                if line.strip():
+                    try:
+                        yield index, json.loads(line)
+                    except ValueError as exc:
+                        raise PersonalizeError("%s:%d: %s" % (path, index + 1, exc))
+        else:
+            for index, row in enumerate(csv.DictReader(fp)):
+                yield index, row
+
+
+def get_patches(fields, record):
+    """Return `{memory: {address: value}}` bytes of a record"""
+    patches = {}
+    for name, memory, address, field_type in fields:
+        if name not in record or record[name] in (None, ""):
+            raise PersonalizeError("Record doesn't define field `%s`" % name)
+        data = encode_value(record[name], field_type)
+        memory_patches = patches.setdefault(memory, {})
+        for offset, value in enumerate(data):
+            memory_patches[address + offset] = value
+    return patches
+
+
+def patch_image(segments, patches):
+    """Return a copy of `segments` with `{address: value}` applied
+
+    Segments without patched bytes are shared with the base image, bytes
+    outside of all segments are added as new segments.
+    """
+    result = []
+    remaining = dict(patches)
+    for address, chunk in segments:
+        inside = [
+            item for item in remaining if address <= item < address + len(chunk)
+        ]
+        if inside:
+            chunk = bytearray(chunk)
+            for item in inside:
+                chunk[item - address] = remaining.pop(item)
+        result.append((address, chunk))
+    if remaining:
+        result = sorted(result + to_segments(remaining), key=lambda item: item[0])
+    return result
+
+
+def personalize(images, fields, record):
+    """Return `{memory: segments}` of a record, `images` holds base images"""
+    result = dict(images)
+    for memory, memory_patches in get_patches(fields, record).items():
+        result[memory] = patch_image(images.get(memory, []), memory_patches)
+    return result
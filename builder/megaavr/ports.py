@@ -0,0 +1,163 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Upload port lookup without enumerating every attached serial adapter.
+
+The last port found for a board VID/PID (and optionally the adapter serial
+number) is remembered and revalidated with a single sysfs check on Linux.
+Other hosts don't expose the USB identity of a single port, so the ports are
+listed once with pyserial instead. On Linux, re-enumerated ports are awaited
+with inotify events on /dev.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import sys
+import time
+
+from serial.tools import list_ports
+
+SYSFS_TTY_DIR = "/sys/class/tty"
+
+IN_CREATE = 0x00000100
+IN_ATTRIB = 0x00000004
+
+
+def parse_hwids(hwids):
+    """Convert `build.hwids` into a set of `(vid, pid)` integer pairs"""
+    return set((int(vid, 16), int(pid, 16)) for vid, pid in hwids or [])
+
+
+def get_port_usb_info(port):
+    """Return `(vid, pid, serial)` of a USB serial port or None"""
+    if not sys.platform.startswith("linux"):
+        for info in list_ports.comports():
+            if info.device == port and info.vid is not None:
+                return info.vid, info.pid, info.serial_number or ""
+        return None
+    name = os.path.basename(os.path.realpath(port))
+    device = os.path.realpath(os.path.join(SYSFS_TTY_DIR, name, "device"))
+    while device.startswith("/sys/devices/"):
+        if os.path.isfile(os.path.join(device, "idVendor")):
+            values = []
+            for item in ("idVendor", "idProduct", "serial"):
+                try:
+                    with open(os.path.join(device, item)) as fp:
+                        values.append(fp.read().strip())
+                except (IOError, OSError):
+                    values.append("")
+            return int(values[0], 16), int(values[1], 16), values[2]
+        device = os.path.dirname(device)
+    return None
+
+
+def is_valid_port(port, hwids, serial=""):
+    """Cheap check that `port` still belongs to the same adapter"""
+    if not port:
+        return False
+    # Windows COM ports aren't files
+    if os.name != "nt" and not os.path.exists(port):
+        return False
+    info = get_port_usb_info(port)
+    if info is None:
+        # another device may have taken over the path of a known adapter
+        return not hwids and not serial
+    if hwids and info[:2] not in hwids:
+        return False
+    return not serial or info[2] == serial
+
+
+def get_cache_key(board, hwids, serial=""):
+    return "%s:%s:%s" % (
+        board,
+        ",".join("%04X:%04X" % item for item in sorted(hwids)),
+        serial,
+    )
+
+
+class PortCache(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        return self._load().get(key)
+
+    def set(self, key, port):
+        data = self._load()
+        if data.get(key) == port:
+            return
+        data[key] = port
+        self._save(data)
+
+    def _save(self, data):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".tmp", "w") as fp:
+            json.dump(data, fp, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def _inotify_watch(path, mask):
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_new_port(before, list_ports, timeout=5):
+    """Wait for a port missing from `before` to appear
+
+    Returns `(new_port, ports)`, `new_port` is None on timeout. Returns None
+    if events aren't available on this host and the caller should poll.
+    """
+    fd = _inotify_watch("/dev", IN_CREATE | IN_ATTRIB)
+    if fd is None:
+        return None
+    try:
+        deadline = time.time() + timeout
+        ports = list_ports()
+        while True:
+            for port in ports:
+                if port not in before:
+                    return port, ports
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, ports
+            if select.select([fd], [], [], remaining)[0]:
+                os.read(fd, 4096)
+                # a port that was removed and created again counts as new
+                before, ports = ports, list_ports()
+    finally:
+        os.close(fd)
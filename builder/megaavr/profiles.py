@@ -0,0 +1,96 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build profiles selected with `board_build.profile`.
+
+* `release` (default) keeps the serial LTO and `-Os` of the framework scripts.
+* `fast` disables LTO, the slowest step of small edit-compile-flash loops.
+
+Both defaults can be overridden:
+
+* `board_build.lto`: `yes` (serial), `no`, `parallel` (one LTRANS job per
+  CPU core) or the number of parallel jobs.
+* `board_build.optimization`: the optimization flag, e.g. `-O1` or `-Og`.
+
+Only the LTO and optimization flags added by the framework scripts are
+rewritten, so release builds keep their exact command lines. Garbage
+collection of sections and section placement are left untouched.
+"""
+
+import os
+import re
+
+DEFAULT_OPTIMIZATION = "-Os"
+
+PROFILES = dict(
+    release=dict(lto="yes", optimization=DEFAULT_OPTIMIZATION),
+    fast=dict(lto="no", optimization=DEFAULT_OPTIMIZATION),
+)
+
+LTO_FLAGS = ("-fno-fat-lto-objects", "-fuse-linker-plugin")
+
+
+class ProfileError(Exception):
+    pass
+
+
+def get_profile_options(board_config):
+    """Return `(lto_jobs, optimization)`, `lto_jobs` is None without LTO
+    and 1 for the serial mode"""
+    name = board_config.get("build.profile", "release").lower()
+    if name not in PROFILES:
+        raise ProfileError(
+            "Unknown build profile `%s`, use one of: %s" % (
+                name, ", ".join(sorted(PROFILES))))
+    profile = PROFILES[name]
+
+    lto = str(board_config.get("build.lto", profile["lto"])).lower()
+    if lto == "yes":
+        lto_jobs = 1
+    elif lto == "no":
+        lto_jobs = None
+    elif lto == "parallel":
+        lto_jobs = os.cpu_count() or 1
+    elif lto.isdigit() and int(lto) > 0:
+        lto_jobs = int(lto)
+    else:
+        raise ProfileError(
+            "Invalid `board_build.lto = %s`, use yes, no, parallel "
+            "or the number of jobs" % lto)
+
+    optimization = board_config.get("build.optimization", profile["optimization"])
+    if not re.match(r"^-O(\d|s|g|z|fast)?$", optimization):
+        raise ProfileError(
+            "Invalid `board_build.optimization = %s`, expected a flag like -Os "
+            "or -O1" % optimization)
+    return lto_jobs, optimization
+
+
+def update_flags(flags, lto_jobs, optimization, link=False):
+    """Rewrite the LTO and optimization flags added by the framework scripts"""
+    result = []
+    for flag in flags:
+        if flag == DEFAULT_OPTIMIZATION:
+            result.append(optimization)
+        elif flag == "-flto":
+            if lto_jobs is None:
+                continue
+            # only the link step runs LTRANS jobs
+            result.append("-flto=%d" % lto_jobs if link and lto_jobs > 1 else flag)
+        elif flag in LTO_FLAGS and lto_jobs is None:
+            continue
+        else:
+            result.append(flag)
+    return result
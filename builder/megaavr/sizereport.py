@@ -0,0 +1,80 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-symbol size snapshots and the differences between them
+"""
+
+import json
+import os
+
+TOTALS = ("program", "data", "eeprom")
+TOTAL_TITLES = dict(program="Program", data="Data", eeprom="EEPROM")
+
+
+def make_snapshot(usage):
+    symbols = {}
+    for name, section, size in usage["symbols"]:
+        key = "%s:%s" % (section, name)
+        symbols[key] = symbols.get(key, 0) + size
+    snapshot = {key: usage[key] for key in TOTALS}
+    snapshot["sections"] = dict(usage["sections"])
+    snapshot["symbols"] = symbols
+    return snapshot
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_snapshot(path, snapshot):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "w") as fp:
+        json.dump(snapshot, fp, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def diff_symbols(old, new):
+    """Changed symbols as `(key, old_size, new_size)`, largest change first"""
+    result = []
+    for key in set(old["symbols"]) | set(new["symbols"]):
+        old_size = old["symbols"].get(key, 0)
+        new_size = new["symbols"].get(key, 0)
+        if old_size != new_size:
+            result.append((key, old_size, new_size))
+    return sorted(result, key=lambda item: (-abs(item[2] - item[1]), item[0]))
+
+
+def format_report(old, new, old_title, limit=None):
+    lines = ["Size changes against %s:" % old_title]
+    for key in TOTALS:
+        lines.append("  %-8s %8d -> %8d  %+d" % (
+            TOTAL_TITLES[key] + ":", old.get(key, 0), new[key], new[key] - old.get(key, 0)
+        ))
+    changes = diff_symbols(old, new)
+    if not changes:
+        lines.append("No symbol size changes")
+        return "\n".join(lines)
+    lines.append("")
+    lines.append("  %-48s %8s %8s %8s" % ("Symbol", "Old", "New", "Delta"))
+    for key, old_size, new_size in changes[:limit]:
+        lines.append("  %-48s %8d %8d %+8d" % (key, old_size, new_size, new_size - old_size))
+    if limit and len(changes) > limit:
+        lines.append("  ... %d more changed symbols" % (len(changes) - limit))
+    return "\n".join(lines)
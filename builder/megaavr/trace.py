@@ -0,0 +1,107 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timing trace of build and upload phases.
+
+Events are stored in the Chrome trace event format, which can be opened
+with `chrome://tracing`, Perfetto (https://ui.perfetto.dev) or Speedscope.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._origin = time.perf_counter()
+
+    def now(self):
+        return time.perf_counter() - self._origin
+
+    def _get_thread_id(self):
+        ident = threading.get_ident()
+        with self._lock:
+            return self._threads.setdefault(ident, len(self._threads) + 1)
+
+    def add(self, name, category, start, duration, args=None):
+        event = dict(
+            name=name,
+            cat=category,
+            ph="X",
+            ts=round(start * 1e6, 1),
+            dur=round(duration * 1e6, 1),
+            pid=os.getpid(),
+            tid=self._get_thread_id(),
+        )
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category="platform", **args):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, self.now() - start, args)
+
+    def wrap_spawn(self, spawn):
+        """Trace every external command, named after the executable"""
+
+        def _traced(sh, escape, cmd, args, env):
+            name = os.path.basename(args[0].strip('"'))
+            with self.span(name, "command", command=" ".join(args)):
+                return spawn(sh, escape, cmd, args, env)
+
+        return _traced
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with self._lock:
+            events = sorted(self.events, key=lambda item: item["ts"])
+        with open(self.path, "w") as fp:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fp)
+
+    def get_summary(self):
+        """Totals per event name as `(name, count, total, maximum)` in seconds"""
+        totals = {}
+        with self._lock:
+            for event in self.events:
+                count, total, maximum = totals.get(event["name"], (0, 0, 0))
+                totals[event["name"]] = (
+                    count + 1, total + event["dur"], max(maximum, event["dur"]))
+        return sorted(
+            (
+                (name, count, total / 1e6, maximum / 1e6)
+                for name, (count, total, maximum) in totals.items()
+            ),
+            key=lambda item: (-item[2], item[0]),
+        )
+
+    def format_summary(self):
+        lines = ["%-32s %6s %10s %10s" % ("Phase", "Count", "Total, s", "Max, s")]
+        for name, count, total, maximum in self.get_summary():
+            lines.append("%-32s %6d %10.3f %10.3f" % (name[:32], count, total, maximum))
+        return "\n".join(lines)
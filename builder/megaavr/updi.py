@@ -0,0 +1,437 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SerialUPDI programmer using a plain USB-serial adapter.
+
+TX and RX of the adapter are joined through a resistor, so every byte sent
+is echoed back before the target answers. Flash pages are written as blocks
+of 16-bit words with response signatures disabled, which removes one
+round trip per word. Above 225000 baud the UPDI clock of the target is raised
+to 16 MHz ("turbo") before the adapter switches to the requested speed.
+"""
+
+import time
+
+from serial import PARITY_EVEN, STOPBITS_TWO, Serial
+
+from megaavr.incremental import get_pages
+
+SYNC = 0x55
+ACK = 0x40
+
+# Instructions
+LDS = 0x00
+STS = 0x40
+LD = 0x20
+ST = 0x60
+LDCS = 0x80
+STCS = 0xC0
+REPEAT = 0xA0
+KEY = 0xE0
+
+PTR = 0x00
+PTR_INC = 0x04
+PTR_ADDRESS = 0x08
+
+DATA_8 = 0x00
+DATA_16 = 0x01
+DATA_24 = 0x02
+
+KEY_SIB = 0x04
+KEY_64 = 0x00
+SIB_16 = 0x01
+
+# Control/status registers
+CS_STATUSA = 0x00
+CS_CTRLA = 0x02
+CS_CTRLB = 0x03
+ASI_KEY_STATUS = 0x07
+ASI_RESET_REQ = 0x08
+ASI_CTRLA = 0x09
+ASI_SYS_STATUS = 0x0B
+
+CTRLA_IBDLY = 1 << 7
+CTRLA_RSD = 1 << 3
+# the shortest guard time of 2 UPDI clock cycles
+CTRLA_GTVAL_2 = 0x06
+CTRLB_UPDIDIS = 1 << 2
+CTRLB_CCDETDIS = 1 << 3
+
+KEY_STATUS_CHIPERASE = 1 << 3
+KEY_STATUS_NVMPROG = 1 << 4
+SYS_STATUS_LOCKSTATUS = 1 << 0
+SYS_STATUS_NVMPROG = 1 << 3
+
+RESET_SIGNATURE = 0x59
+UPDI_CLOCK_16MHZ = 0x01
+
+KEY_NVMPROG = b"NVMProg "
+KEY_CHIPERASE = b"NVMErase"
+
+BASE_BAUDRATE = 115200
+TURBO_BAUDRATE = 225000
+
+NVMCTRL_CTRLA = 0x1000
+NVMCTRL_STATUS = 0x1002
+SIGROW = 0x1100
+EEPROM_START = 0x1400
+
+CRCSCAN_CTRLA = 0x0120
+CRCSCAN_CTRLB = 0x0121
+CRCSCAN_STATUS = 0x0122
+CRCSCAN_ENABLE = 0x01
+CRCSCAN_SRC_FLASH = 0x00
+CRCSCAN_BUSY = 0x01
+CRCSCAN_OK = 0x02
+
+# NVM controller differences between tinyAVR/megaAVR 0 (P:0) and AVR Dx (P:2)
+NVM_VERSIONS = {
+    0: dict(
+        address_size=2,
+        cmd_write_page=0x01,
+        cmd_clear_buffer=0x04,
+        cmd_flash_write=None,
+        # erases and writes the loaded bytes of the page buffer
+        cmd_eeprom_write=0x03,
+        eeprom_page_size=32,
+        cmd_none=0x00,
+        error_mask=0x04,
+    ),
+    2: dict(
+        address_size=3,
+        cmd_write_page=None,
+        cmd_clear_buffer=None,
+        cmd_flash_write=0x02,
+        # every written byte is erased and written on its own
+        cmd_eeprom_write=0x13,
+        eeprom_page_size=None,
+        cmd_none=0x00,
+        error_mask=0x70,
+    ),
+}
+
+# Flash is mapped into the data space at a different address per family,
+# which is identified by the SIB. megaAVR 0 shares NVM P:0 with tinyAVR.
+FLASH_OFFSETS = {
+    "tinyAVR": 0x8000,
+    "megaAVR": 0x4000,
+    "AVR": 0x800000,
+}
+
+# the REPEAT counter is 8-bit
+MAX_BLOCK_WORDS = 256
+
+
+class UpdiError(Exception):
+    pass
+
+
+class UpdiLink(object):
+    """Physical and data link layer"""
+
+    def __init__(self, port, timeout=1):
+        self.port = port
+        self.timeout = timeout
+        self.address_size = 2
+        self.serial = None
+
+    def open(self):
+        self.serial = Serial(
+            self.port,
+            BASE_BAUDRATE,
+            parity=PARITY_EVEN,
+            stopbits=STOPBITS_TWO,
+            timeout=self.timeout,
+        )
+        self.serial.reset_input_buffer()
+
+    def close(self):
+        if self.serial:
+            self.serial.close()
+            self.serial = None
+
+    def set_baudrate(self, baudrate):
+        self.serial.baudrate = baudrate
+
+    def send_double_break(self):
+        """Reset the UPDI of the target with two long low pulses"""
+        baudrate = self.serial.baudrate
+        self.serial.baudrate = 300
+        for _ in range(2):
+            self.serial.write(b"\x00")
+            self.serial.read(1)
+        self.serial.baudrate = baudrate
+        self.serial.reset_input_buffer()
+
+    def send(self, data):
+        data = bytes(data)
+        self.serial.write(data)
+        echo = self.serial.read(len(data))
+        if echo != data:
+            raise UpdiError(
+                "No echo from the UPDI line, check the adapter wiring"
+                if not echo else "Corrupted echo from the UPDI line"
+            )
+
+    def receive(self, size):
+        data = self.serial.read(size)
+        if len(data) != size:
+            raise UpdiError("Timeout waiting for %d bytes from the target" % size)
+        return bytearray(data)
+
+    def _expect_ack(self):
+        if self.receive(1)[0] != ACK:
+            raise UpdiError("The target didn't acknowledge the instruction")
+
+    def _encode_address(self, address):
+        return address.to_bytes(self.address_size, "little")
+
+    @property
+    def _address_flag(self):
+        return (self.address_size - 1) << 2
+
+    def init(self):
+        for attempt in range(2):
+            if attempt:
+                self.send_double_break()
+            try:
+                self.stcs(CS_CTRLB, CTRLB_CCDETDIS)
+                self.stcs(CS_CTRLA, CTRLA_IBDLY | CTRLA_GTVAL_2)
+                if self.ldcs(CS_STATUSA):
+                    return
+            except UpdiError:
+                pass
+        raise UpdiError("Couldn't initialize the UPDI link on %s" % self.port)
+
+    def ldcs(self, address):
+        self.send([SYNC, LDCS | address])
+        return self.receive(1)[0]
+
+    def stcs(self, address, value):
+        self.send([SYNC, STCS | address, value])
+
+    def lds(self, address):
+        self.send([SYNC, LDS | self._address_flag | DATA_8])
+        self.send(self._encode_address(address))
+        return self.receive(1)[0]
+
+    def sts(self, address, value):
+        self.send([SYNC, STS | self._address_flag | DATA_8])
+        self.send(self._encode_address(address))
+        self._expect_ack()
+        self.send([value])
+        self._expect_ack()
+
+    def set_pointer(self, address):
+        self.send([SYNC, ST | PTR_ADDRESS | (self.address_size - 1)])
+        self.send(self._encode_address(address))
+        self._expect_ack()
+
+    def repeat(self, count):
+        self.send([SYNC, REPEAT, count - 1])
+
+    def read(self, address, size):
+        self.set_pointer(address)
+        if size > 1:
+            self.repeat(size)
+        self.send([SYNC, LD | PTR_INC | DATA_8])
+        return self.receive(size)
+
+    def write_words(self, address, data):
+        """Block write with response signatures disabled"""
+        self.set_pointer(address)
+        self.stcs(CS_CTRLA, CTRLA_IBDLY | CTRLA_GTVAL_2 | CTRLA_RSD)
+        self.repeat(len(data) // 2)
+        self.send([SYNC, ST | PTR_INC | DATA_16])
+        self.send(data)
+        self.stcs(CS_CTRLA, CTRLA_IBDLY | CTRLA_GTVAL_2)
+
+    def key(self, key):
+        self.send([SYNC, KEY | KEY_64])
+        self.send(reversed(key))
+
+    def read_sib(self):
+        self.send([SYNC, KEY | KEY_SIB | SIB_16])
+        return bytes(self.receive(16))
+
+
+class UpdiProgrammer(object):
+
+    def __init__(self, port, baudrate=BASE_BAUDRATE, timeout=1):
+        self.baudrate = baudrate
+        self.link = UpdiLink(port, timeout)
+        self.sib = b""
+        self.nvm_version = None
+        self.nvm = None
+        self.flash_offset = None
+
+    def __enter__(self):
+        self.link.open()
+        try:
+            self.link.init()
+            self.sib = self.link.read_sib()
+            try:
+                self.nvm_version = int(self.sib[10:11])
+                self.nvm = NVM_VERSIONS[self.nvm_version]
+                self.flash_offset = FLASH_OFFSETS[self.get_family()]
+            except (KeyError, ValueError):
+                raise UpdiError("Unsupported target, SIB `%s`" % self.get_family())
+            self.link.address_size = self.nvm["address_size"]
+            if self.baudrate > TURBO_BAUDRATE:
+                self.link.stcs(ASI_CTRLA, UPDI_CLOCK_16MHZ)
+            if self.baudrate != BASE_BAUDRATE:
+                self.link.set_baudrate(self.baudrate)
+                if not self.link.ldcs(CS_STATUSA):
+                    raise UpdiError("The target doesn't respond at %d baud" % self.baudrate)
+        except Exception:
+            self.link.close()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            self.leave_progmode()
+        finally:
+            self.link.close()
+
+    def get_family(self):
+        return self.sib[:7].decode("latin-1").strip()
+
+    def _wait_sys_status(self, mask, expected, timeout=1):
+        end = time.time() + timeout
+        while time.time() < end:
+            if (self.link.ldcs(ASI_SYS_STATUS) & mask) == expected:
+                return True
+        return False
+
+    def reset(self):
+        self.link.stcs(ASI_RESET_REQ, RESET_SIGNATURE)
+        self.link.stcs(ASI_RESET_REQ, 0x00)
+
+    def chip_erase(self):
+        """Erase flash and EEPROM (unless EESAVE is set), unlocks the device"""
+        self.link.key(KEY_CHIPERASE)
+        if not self.link.ldcs(ASI_KEY_STATUS) & KEY_STATUS_CHIPERASE:
+            raise UpdiError("The chip erase key wasn't accepted")
+        self.reset()
+        if not self._wait_sys_status(SYS_STATUS_LOCKSTATUS, 0):
+            raise UpdiError("Chip erase timed out")
+
+    def enter_progmode(self):
+        if self.link.ldcs(ASI_SYS_STATUS) & SYS_STATUS_NVMPROG:
+            return
+        self.link.key(KEY_NVMPROG)
+        if not self.link.ldcs(ASI_KEY_STATUS) & KEY_STATUS_NVMPROG:
+            raise UpdiError("The NVM programming key wasn't accepted")
+        self.reset()
+        if not self._wait_sys_status(SYS_STATUS_NVMPROG, SYS_STATUS_NVMPROG):
+            raise UpdiError("Couldn't enter NVM programming mode")
+
+    def leave_progmode(self):
+        if self.link.serial is None:
+            return
+        self.reset()
+        self.link.stcs(CS_CTRLB, CTRLB_UPDIDIS | CTRLB_CCDETDIS)
+
+    def read_signature(self):
+        return bytes(self.link.read(SIGROW, 3))
+
+    def _wait_nvm_ready(self, timeout=1):
+        end = time.time() + timeout
+        while time.time() < end:
+            status = self.link.lds(NVMCTRL_STATUS)
+            if status & self.nvm["error_mask"]:
+                raise UpdiError("NVM controller error, status 0x%02X" % status)
+            if not status & 0x03:
+                return
+        raise UpdiError("NVM controller timed out")
+
+    def _execute(self, command, timeout=1):
+        self.link.sts(NVMCTRL_CTRLA, command)
+        self._wait_nvm_ready(timeout)
+
+    def write_flash(self, segments, page_size, progress=None):
+        """Write an already erased flash, returns the number of written pages"""
+        pages = get_pages(segments, page_size)
+        for idx, address in enumerate(sorted(pages)):
+            page = pages[address]
+            if self.nvm["cmd_clear_buffer"] is not None:
+                self._execute(self.nvm["cmd_clear_buffer"])
+            else:
+                self._execute(self.nvm["cmd_flash_write"])
+            for offset in range(0, page_size, MAX_BLOCK_WORDS * 2):
+                self.link.write_words(
+                    self.flash_offset + address + offset,
+                    page[offset:offset + MAX_BLOCK_WORDS * 2],
+                )
+            if self.nvm["cmd_write_page"] is not None:
+                self._execute(self.nvm["cmd_write_page"])
+            else:
+                self._execute(self.nvm["cmd_none"])
+            if progress:
+                progress(idx + 1, len(pages))
+        return len(pages)
+
+    def read_flash(self, address, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = min(size - len(data), MAX_BLOCK_WORDS)
+            data.extend(self.link.read(
+                self.flash_offset + address + len(data), chunk))
+        return data
+
+    def verify_flash(self, segments):
+        """Return the address of the first mismatch or None"""
+        for address, chunk in segments:
+            data = self.read_flash(address, len(chunk))
+            if data != chunk:
+                offset = next(
+                    idx for idx, value in enumerate(chunk) if data[idx] != value)
+                return address + offset
+        return None
+
+    def read_eeprom(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = min(size - len(data), MAX_BLOCK_WORDS)
+            data.extend(self.link.read(EEPROM_START + len(data), chunk))
+        return data
+
+    def write_eeprom(self, runs):
+        """Write `(address, data)` runs, each within one EEPROM page"""
+        if self.nvm["cmd_clear_buffer"] is None:
+            self._execute(self.nvm["cmd_eeprom_write"])
+        for address, data in runs:
+            if self.nvm["cmd_clear_buffer"] is not None:
+                self._execute(self.nvm["cmd_clear_buffer"])
+            for offset, value in enumerate(data):
+                self.link.sts(EEPROM_START + address + offset, value)
+                if self.nvm["cmd_clear_buffer"] is None:
+                    self._wait_nvm_ready()
+            if self.nvm["cmd_clear_buffer"] is not None:
+                self._execute(self.nvm["cmd_eeprom_write"])
+        if self.nvm["cmd_clear_buffer"] is None:
+            self._execute(self.nvm["cmd_none"])
+
+    def run_crcscan(self, timeout=2):
+        """Check the whole flash with CRCSCAN, None if the scan doesn't finish"""
+        self.link.sts(CRCSCAN_CTRLB, CRCSCAN_SRC_FLASH)
+        self.link.sts(CRCSCAN_CTRLA, CRCSCAN_ENABLE)
+        end = time.time() + timeout
+        while time.time() < end:
+            status = self.link.lds(CRCSCAN_STATUS)
+            if not status & CRCSCAN_BUSY:
+                return bool(status & CRCSCAN_OK)
+        return None
@@ -0,0 +1,402 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Simulated UPDI target on a pseudo-terminal.
+
+The simulator echoes every received byte like the single-wire UPDI line and
+implements the instructions, keys, NVM controller commands and the CRCSCAN
+check used by the native SerialUPDI uploader. Use the printed port as
+`upload_port`:
+
+    python builder/megaavr/updisim.py [--board AVR128DA48] [--dump flash.hex]
+
+The flash contents are written to the `--dump` file on exit (Ctrl+C or SIGTERM),
+the EEPROM contents to the `--eeprom-dump` file. With `--max-baudrate` the
+echo is corrupted while the port runs faster, like an adapter past its limit.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import pty
+import signal
+import struct
+import sys
+import termios
+import threading
+import tty
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from megaavr.boards import (BOARDS_DIR, get_eeprom_size,  # noqa: E402
+                            get_physical_flash_size)
+from megaavr.fuses import get_family, get_flash_page_size  # noqa: E402
+from megaavr.ihex import to_segments, write_hex  # noqa: E402
+from megaavr.verify import get_crc16  # noqa: E402
+from megaavr.updi import (ACK, ASI_KEY_STATUS, ASI_RESET_REQ,  # noqa: E402
+                          ASI_SYS_STATUS, CRCSCAN_CTRLA, CRCSCAN_ENABLE,
+                          CRCSCAN_OK, CRCSCAN_STATUS, CS_CTRLA, CTRLA_RSD,
+                          KEY, KEY_CHIPERASE, KEY_NVMPROG, KEY_SIB,
+                          KEY_STATUS_CHIPERASE, KEY_STATUS_NVMPROG, LD, LDCS,
+                          LDS, NVM_VERSIONS, NVMCTRL_CTRLA, NVMCTRL_STATUS,
+                          PTR_ADDRESS, PTR_INC, REPEAT, RESET_SIGNATURE, SIGROW,
+                          ST, STCS, STS, SYNC, SYS_STATUS_NVMPROG)
+
+SIGNATURES = {
+    "atmega808": "1e9326",
+    "atmega809": "1e932a",
+    "atmega1608": "1e9427",
+    "atmega1609": "1e9426",
+    "atmega3208": "1e9530",
+    "atmega3209": "1e9531",
+    "atmega4808": "1e9650",
+    "atmega4809": "1e9651",
+    "attiny1614": "1e9422",
+    "attiny3216": "1e9521",
+    "avr128da48": "1e9708",
+    "avr128db48": "1e970b",
+}
+
+# Data space addresses of the simulated memories by family. They are kept
+# apart from the uploader on purpose, a wrong mapping there must fail here.
+MEMORY_MAPS = {
+    "tinyavr": dict(flash=0x8000, eeprom=0x1400),
+    "megaavr0": dict(flash=0x4000, eeprom=0x1400),
+    "avr_d": dict(flash=0x800000, eeprom=0x1400),
+}
+
+# struct termios2 of Linux, the output speed is the last field
+TCGETS2 = 0x802C542A
+TERMIOS2_SIZE = 44
+
+
+def get_memory_map(family_id):
+    for prefix, memory_map in MEMORY_MAPS.items():
+        if family_id.startswith(prefix):
+            return memory_map
+    raise ValueError("No memory map of `%s`" % family_id)
+
+
+class SimulatedTarget(object):
+
+    def __init__(self, family_id, flash_size, signature, eeprom_size=256):
+        self.nvm_version = 2 if family_id.startswith("avr_d") else 0
+        self.nvm = NVM_VERSIONS[self.nvm_version]
+        self.memory_map = get_memory_map(family_id)
+        self.page_size = get_flash_page_size(family_id, flash_size)
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.page_buffer = {}
+        self.eeprom = bytearray(b"\xff" * eeprom_size)
+        self.eeprom_buffer = {}
+        self.signature = bytes.fromhex(signature)
+        self.sib = (
+            "AVR     " if self.nvm_version == 2
+            else "tinyAVR " if family_id.startswith("tiny") else "megaAVR "
+        ).encode() + b"P:%dD:1-3" % self.nvm_version
+        self.cs = bytearray(16)
+        # UPDI revision in STATUSA
+        self.cs[0] = 0x30 if self.nvm_version == 2 else 0x10
+        self.nvm_command = 0
+        self.ram = {}
+        self.pointer = 0
+        self.repeat = 0
+        self.key = b""
+        self.fd = None
+        self.max_baudrate = None
+        self.on_sync = None
+
+    # Transport
+
+    def _get_baudrate(self):
+        data = fcntl.ioctl(self.fd, TCGETS2, bytes(TERMIOS2_SIZE))
+        return struct.unpack_from("<I", data, TERMIOS2_SIZE - 4)[0]
+
+    def _next(self):
+        data = os.read(self.fd, 1)
+        if not data:
+            raise EOFError
+        if self.max_baudrate and self._get_baudrate() > self.max_baudrate:
+            data = bytes([data[0] ^ 0x10])
+        # the adapter hears its own transmission
+        os.write(self.fd, data)
+        return data[0]
+
+    def _read(self, size):
+        return bytearray(self._next() for _ in range(size))
+
+    def _respond(self, data):
+        os.write(self.fd, bytes(data))
+
+    # Memory
+
+    def _flash_address(self, address):
+        offset = address - self.memory_map["flash"]
+        if 0 <= offset < len(self.flash):
+            return offset
+        return None
+
+    def _eeprom_address(self, address):
+        offset = address - self.memory_map["eeprom"]
+        if 0 <= offset < len(self.eeprom):
+            return offset
+        return None
+
+    def read_byte(self, address):
+        offset = self._flash_address(address)
+        if offset is not None:
+            return self.flash[offset]
+        offset = self._eeprom_address(address)
+        if offset is not None:
+            return self.eeprom[offset]
+        if SIGROW <= address < SIGROW + len(self.signature):
+            return self.signature[address - SIGROW]
+        if address == NVMCTRL_CTRLA:
+            return self.nvm_command
+        if address == NVMCTRL_STATUS:
+            return 0
+        return self.ram.get(address, 0)
+
+    def write_byte(self, address, value):
+        offset = self._flash_address(address)
+        if offset is not None:
+            if self.nvm_version == 0:
+                self.page_buffer[offset] = value
+            elif self.nvm_command == self.nvm["cmd_flash_write"]:
+                self.flash[offset] &= value
+        elif self._eeprom_address(address) is not None:
+            offset = self._eeprom_address(address)
+            if self.nvm_version == 0:
+                self.eeprom_buffer[offset] = value
+            elif self.nvm_command == self.nvm["cmd_eeprom_write"]:
+                self.eeprom[offset] = value
+        elif address == NVMCTRL_CTRLA:
+            self.execute(value)
+        elif address == CRCSCAN_CTRLA and value & CRCSCAN_ENABLE:
+            # the stored checksum makes the CRC of the whole flash zero
+            self.ram[CRCSCAN_STATUS] = 0 if get_crc16(self.flash) else CRCSCAN_OK
+        else:
+            self.ram[address] = value
+
+    def execute(self, command):
+        if self.nvm_version == 2:
+            self.nvm_command = command
+        elif command == self.nvm["cmd_clear_buffer"]:
+            self.page_buffer = {}
+            self.eeprom_buffer = {}
+        elif command == self.nvm["cmd_eeprom_write"]:
+            for offset, value in self.eeprom_buffer.items():
+                self.eeprom[offset] = value
+            self.eeprom_buffer = {}
+        elif command == self.nvm["cmd_write_page"]:
+            for offset, value in self.page_buffer.items():
+                self.flash[offset] &= value
+            self.page_buffer = {}
+
+    def reset(self):
+        if self.key == KEY_CHIPERASE:
+            self.flash[:] = b"\xff" * len(self.flash)
+            self.eeprom[:] = b"\xff" * len(self.eeprom)
+        elif self.key == KEY_NVMPROG:
+            self.cs[ASI_SYS_STATUS] |= SYS_STATUS_NVMPROG
+        self.key = b""
+        self.cs[ASI_KEY_STATUS] = 0
+
+    # Instructions
+
+    def _address_size(self, opcode):
+        return ((opcode >> 2) & 0x03) + 1
+
+    def handle(self):
+        if self._next() != SYNC:
+            # a BREAK or line noise
+            return
+        if self.on_sync:
+            self.on_sync()
+        opcode = self._next()
+        rsd = self.cs[CS_CTRLA] & CTRLA_RSD
+        instruction = opcode & 0xE0
+        data_size = (opcode & 0x03) + 1
+        if instruction == LDCS:
+            self._respond([self.cs[opcode & 0x0F]])
+        elif instruction == STCS:
+            self.write_cs(opcode & 0x0F, self._next())
+        elif instruction == LDS:
+            address = int.from_bytes(self._read(self._address_size(opcode)), "little")
+            self._respond(self.read_byte(address + idx) for idx in range(data_size))
+        elif instruction == STS:
+            address = int.from_bytes(self._read(self._address_size(opcode)), "little")
+            if not rsd:
+                self._respond([ACK])
+            for idx, value in enumerate(self._read(data_size)):
+                self.write_byte(address + idx, value)
+            if not rsd:
+                self._respond([ACK])
+        elif instruction in (LD, ST):
+            self._handle_pointer(instruction, opcode, data_size, rsd)
+        elif instruction == REPEAT:
+            self.repeat = int.from_bytes(self._read(data_size), "little")
+        elif instruction == KEY:
+            if opcode & KEY_SIB:
+                self._respond(self.sib)
+            else:
+                self.key = bytes(reversed(self._read(8)))
+                if self.key == KEY_CHIPERASE:
+                    self.cs[ASI_KEY_STATUS] |= KEY_STATUS_CHIPERASE
+                elif self.key == KEY_NVMPROG:
+                    self.cs[ASI_KEY_STATUS] |= KEY_STATUS_NVMPROG
+
+    def _handle_pointer(self, instruction, opcode, data_size, rsd):
+        mode = opcode & 0x0C
+        if mode == PTR_ADDRESS:
+            if instruction == ST:
+                self.pointer = int.from_bytes(self._read(data_size), "little")
+                if not rsd:
+                    self._respond([ACK])
+            else:
+                self._respond(self.pointer.to_bytes(data_size, "little"))
+            return
+        count, self.repeat = self.repeat + 1, 0
+        for _ in range(count):
+            if instruction == LD:
+                self._respond(
+                    self.read_byte(self.pointer + idx) for idx in range(data_size))
+            else:
+                for idx, value in enumerate(self._read(data_size)):
+                    self.write_byte(self.pointer + idx, value)
+                if not rsd:
+                    self._respond([ACK])
+            if mode == PTR_INC:
+                self.pointer += data_size
+
+    def write_cs(self, address, value):
+        if address == ASI_RESET_REQ:
+            if value == RESET_SIGNATURE:
+                self.cs[ASI_SYS_STATUS] &= ~SYS_STATUS_NVMPROG & 0xFF
+            else:
+                self.reset()
+        else:
+            self.cs[address] = value
+
+    def serve(self, fd, on_sync=None):
+        self.fd = fd
+        self.on_sync = on_sync
+        while True:
+            try:
+                self.handle()
+            except (EOFError, OSError):
+                return
+
+    def get_segments(self, memory=None):
+        memory = self.flash if memory is None else memory
+        data = {
+            offset: value for offset, value in enumerate(memory) if value != 0xFF
+        }
+        return to_segments(data)
+
+
+def open_pty():
+    """Return `(master_fd, slave_fd)` of a raw pseudo-terminal"""
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(master_fd)
+    return master_fd, slave_fd
+
+
+def reset_line(slave_fd):
+    """Make the settings of the next session differ from the current ones
+
+    The pty driver ignores the parity and rejects a request that changes
+    nothing else, which is what reopening the port with the same settings
+    does. Called for every instruction, before the response is sent.
+    """
+    attrs = termios.tcgetattr(slave_fd)
+    if attrs[2] & termios.CLOCAL:
+        attrs[2] &= ~termios.CLOCAL
+        termios.tcsetattr(slave_fd, termios.TCSANOW, attrs)
+
+
+def create_target(board):
+    """Return `(mcu, target)` simulating the MCU of a board manifest"""
+    with open(os.path.join(BOARDS_DIR, "%s.json" % board)) as fp:
+        manifest = json.load(fp)
+    mcu = manifest["build"]["mcu"].lower()
+    target = SimulatedTarget(
+        get_family(manifest),
+        get_physical_flash_size(mcu) or int(manifest["upload"]["maximum_size"]),
+        SIGNATURES.get(mcu, "1e0000"),
+        get_eeprom_size(mcu) or 256,
+    )
+    return mcu, target
+
+
+def start_target(target):
+    """Serve `target` from a background thread
+
+    Returns `(port, thread, stop)`, `stop()` closes the pseudo-terminal and
+    waits for the thread.
+    """
+    master_fd, slave_fd = open_pty()
+    port = os.ttyname(slave_fd)
+    thread = threading.Thread(
+        target=target.serve,
+        args=(master_fd, lambda: reset_line(slave_fd)),
+        daemon=True,
+    )
+    thread.start()
+
+    def stop():
+        # reading the master fails once the last slave is closed
+        os.close(slave_fd)
+        thread.join(1)
+        os.close(master_fd)
+
+    return port, thread, stop
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Simulated UPDI target")
+    parser.add_argument("--board", default="AVR128DA48")
+    parser.add_argument("--dump", help="write the flash contents to an Intel HEX file")
+    parser.add_argument(
+        "--eeprom-dump", help="write the EEPROM contents to an Intel HEX file")
+    parser.add_argument(
+        "--max-baudrate", type=int, help="corrupt the data above this rate")
+    args = parser.parse_args(argv)
+
+    mcu, target = create_target(args.board)
+    target.max_baudrate = args.max_baudrate
+
+    # background jobs of non-interactive shells ignore SIGINT
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    port, thread, _ = start_target(target)
+    print("Simulating %s (NVM P:%d) on %s" % (mcu, target.nvm_version, port))
+    sys.stdout.flush()
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        pass
+    if args.dump:
+        write_hex(args.dump, target.get_segments())
+        print("Flash contents saved to %s" % args.dump)
+    if args.eeprom_dump:
+        write_hex(args.eeprom_dump, target.get_segments(target.eeprom))
+        print("EEPROM contents saved to %s" % args.eeprom_dump)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,104 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Flash verification strategies of the native uploader.
+
+* `full` reads back every written byte.
+* `sample` reads the first and the last page of the image and a few evenly
+  spaced pages in between, and compares their CRC32 with the host one.
+* `crc` stores the CRC16-CCITT of the whole flash in its last two bytes, as
+  expected by the CRCSCAN peripheral, and lets the device check it. A full
+  read-back is used if the scan doesn't finish. The image must leave these
+  bytes free, and data the application writes there later (for example with
+  a flash storage library) invalidates the checksum.
+* `none` skips verification.
+"""
+
+import zlib
+
+from megaavr.ihex import HexError, get_bounds, merge_images
+from megaavr.incremental import get_pages, get_sample_pages
+
+STRATEGIES = ("full", "sample", "crc", "none")
+
+
+class VerifyError(Exception):
+    pass
+
+
+def _make_crc16_table():
+    table = []
+    for idx in range(256):
+        crc = idx << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _make_crc16_table()
+
+
+def get_crc16(data, crc=0xFFFF):
+    """CRC16-CCITT as calculated by CRCSCAN"""
+    for value in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ value]
+    return crc
+
+
+def add_crcscan_checksum(segments, flash_size):
+    """Return the image with the checksum in the last two bytes of flash"""
+    bounds = get_bounds(segments)
+    if bounds and bounds[1] > flash_size - 2:
+        raise VerifyError(
+            "The image ends at 0x%X, the CRCSCAN checksum needs 0x%X-0x%X free"
+            % (bounds[1] - 1, flash_size - 2, flash_size - 1))
+    flash = bytearray(b"\xff" * (flash_size - 2))
+    for address, chunk in segments:
+        flash[address:address + len(chunk)] = chunk
+    checksum = get_crc16(flash).to_bytes(2, "big")
+    try:
+        return merge_images(dict(
+            firmware=segments, checksum=[(flash_size - 2, bytearray(checksum))]
+        ))
+    except HexError as exc:
+        raise VerifyError(str(exc))
+
+
+def verify_flash(programmer, segments, page_size, strategy):
+    """Return `(ok, description)`, `segments` must be written to erased flash"""
+    if strategy == "none":
+        return True, "skipped"
+
+    if strategy == "crc":
+        result = programmer.run_crcscan()
+        if result is not None:
+            return result, "device CRCSCAN"
+        strategy = "full"
+
+    if strategy == "sample":
+        pages = get_pages(segments, page_size)
+        addresses = get_sample_pages(pages)
+        expected = device = 0
+        for address in addresses:
+            expected = zlib.crc32(bytes(pages[address]), expected)
+            device = zlib.crc32(bytes(programmer.read_flash(address, page_size)), device)
+        return expected == device, "CRC32 of %d of %d pages" % (
+            len(addresses), len(pages))
+
+    mismatch = programmer.verify_flash(segments)
+    if mismatch is not None:
+        return False, "full read-back, first mismatch at 0x%X" % mismatch
+    return True, "full read-back"
@@ -0,0 +1,147 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import time
+from os.path import isfile, join
+
+from SCons.Script import Import
+
+from megaavr.boards import get_eeprom_size
+from megaavr.fuses import get_family, get_userrow_size
+from megaavr.ihex import (HexError, iter_records as iter_hex_records, read_hex,
+                          write_hex)
+from megaavr.personalize import (PersonalizeError, check_fields, iter_records,
+                                 parse_fields, personalize)
+
+Import("env")
+
+
+def GetPersonalization(env):
+    """Return `(fields, records_path)` from `board_upload.personalize_*`"""
+    board_config = env.BoardConfig()
+    records_path = board_config.get("upload.personalize_records", "")
+    try:
+        if not records_path:
+            raise PersonalizeError("`board_upload.personalize_records` is not set")
+        fields = parse_fields(board_config.get("upload.personalize_fields", ""))
+        check_fields(fields, dict(
+            flash=int(board_config.get("upload.maximum_size", 0)) or None,
+            eeprom=get_eeprom_size(env.subst("$BOARD_MCU").lower()),
+            userrow=get_userrow_size(get_family(board_config)),
+        ))
+        if env.get("UPLOAD_NATIVE") and any(
+            memory == "userrow" for _, memory, _, _ in fields
+        ):
+            raise PersonalizeError(
+                "USERROW fields require AVRDUDE, the native uploader writes "
+                "flash and EEPROM only")
+    except PersonalizeError as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    return fields, join(env.subst("$PROJECT_DIR"), records_path)
+
+
+def LoadBaseImages(source):
+    images = dict(flash=read_hex(source[0].get_abspath()))
+    if len(source) > 1 and isfile(source[1].get_abspath()):
+        images["eeprom"] = read_hex(source[1].get_abspath())
+    return images
+
+
+def BuildPersonalizedImages(_, target, source, env):  # pylint: disable=W0613
+    fields, records_path = env.GetPersonalization()
+    output_dir = env.subst(join("$BUILD_DIR", "personalized"))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    count = 0
+    try:
+        base = LoadBaseImages(source)
+        for index, record in iter_records(records_path):
+            images = personalize(base, fields, record)
+            name = join(output_dir, "unit-%06d" % index)
+            write_hex(name + ".hex", images["flash"])
+            if images.get("eeprom"):
+                write_hex(name + ".eep", images["eeprom"])
+            if images.get("userrow"):
+                write_hex(name + ".userrow.hex", images["userrow"])
+            count += 1
+    except (IOError, HexError, PersonalizeError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    print("Generated %d personalized images in %s" % (count, output_dir))
+
+
+def UploadPersonalized(_, target, source, env):  # pylint: disable=W0613
+    fields, records_path = env.GetPersonalization()
+    log_path = join(
+        env.subst("$PROJECT_DIR"),
+        env.BoardConfig().get("upload.personalize_log", "personalized.log"),
+    )
+    programmed = set()
+    if isfile(log_path):
+        with open(log_path) as fp:
+            programmed = set(int(line.split(",")[0]) for line in fp if line.strip())
+
+    try:
+        base = LoadBaseImages(source)
+        for index, record in iter_records(records_path):
+            if index not in programmed:
+                break
+        else:
+            raise PersonalizeError("All records of %s are programmed" % records_path)
+        images = personalize(base, fields, record)
+    except (IOError, HexError, PersonalizeError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    unit_id = str(record[fields[0][0]])
+    print("Programming record %d (%s = %s)" % (index, fields[0][0], unit_id))
+    env.GetFlashedImages().forget(env.subst("$UPLOAD_PORT") or "usb")
+
+    if env.get("UPLOAD_NATIVE"):
+        env.ProgramSerialUpdi(images["flash"], images.get("eeprom"))
+    else:
+        # the flash image is streamed to AVRDUDE, other memories are small
+        cmd = env.subst("$UPLOADER $UPLOADERFLAGS -U flash:w:-:i")
+        for memory, suffix in (("eeprom", ".eep"), ("userrow", ".userrow.hex")):
+            if images.get(memory):
+                path = env.subst(join("$BUILD_DIR", "personalized" + suffix))
+                write_hex(path, images[memory])
+                cmd += " -U %s:w:%s:i" % (memory, path)
+        process = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=subprocess.PIPE,
+            universal_newlines=True,
+            env={key: str(value) for key, value in env["ENV"].items()},
+        )
+        try:
+            process.stdin.writelines(iter_hex_records(images["flash"]))
+            process.stdin.close()
+        except BrokenPipeError:
+            # AVRDUDE has failed and its exit code is reported below
+            pass
+        if process.wait():
+            env.Exit(1)
+
+    with open(log_path, "a") as fp:
+        fp.write("%d,%s,%s,%s\n" % (
+            index, unit_id, env.subst("$UPLOAD_PORT"), time.strftime("%Y-%m-%dT%H:%M:%S")))
+
+
+env.AddMethod(GetPersonalization)
+env.AddMethod(BuildPersonalizedImages)
+env.AddMethod(UploadPersonalized)
@@ -0,0 +1,159 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from os.path import join
+
+from SCons.Script import ARGUMENTS, Import
+
+from megaavr.elf import ElfError, format_usage, get_cached_memory_usage
+from megaavr.sizereport import (format_report, load_snapshot, make_snapshot,
+                                save_snapshot)
+
+Import("env")
+
+
+def CheckUploadSize(_, target, source, env):  # pylint: disable=W0613
+    program_max_size = int(env.BoardConfig().get("upload.maximum_size", 0))
+    data_max_size = int(env.BoardConfig().get("upload.maximum_ram_size", 0))
+    if program_max_size == 0:
+        return
+
+    try:
+        usage = get_cached_memory_usage(source[0].get_abspath())
+    except (IOError, OSError, ElfError) as exc:
+        sys.stderr.write("Warning: Couldn't calculate program size: %s\n" % exc)
+        return
+
+    print('Advanced Memory Usage is available via "PlatformIO Home > Project Inspect"')
+    if data_max_size:
+        print("RAM:   %s" % format_usage(usage["data"], data_max_size))
+    print("Flash: %s" % format_usage(usage["program"], program_max_size))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        for name, size in usage["sections"].items():
+            print("%-20s %8d" % (name, size))
+
+    if data_max_size and usage["data"] > data_max_size:
+        sys.stderr.write(
+            "Warning! The data size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (usage["data"], data_max_size)
+        )
+    if usage["program"] > program_max_size:
+        sys.stderr.write(
+            "Error: The program size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (usage["program"], program_max_size)
+        )
+        env.Exit(1)
+
+
+def PrintProgramSize(_, target, source, env):  # pylint: disable=W0613
+    try:
+        usage = get_cached_memory_usage(source[0].get_abspath(), with_symbols=True)
+    except (IOError, OSError, ElfError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+
+    board_config = env.BoardConfig()
+    print("AVR Memory Usage")
+    print("----------------")
+    print("Device: %s\n" % env.subst("$BOARD_MCU"))
+    for title, key, max_size in (
+        ("Program", "program", int(board_config.get("upload.maximum_size", 0))),
+        ("Data", "data", int(board_config.get("upload.maximum_ram_size", 0))),
+        ("EEPROM", "eeprom", 0),
+    ):
+        if key == "eeprom" and not usage[key]:
+            continue
+        print("%-8s %8d bytes%s" % (
+            title + ":",
+            usage[key],
+            " (%.1f%% Full)" % (100.0 * usage[key] / max_size) if max_size else "",
+        ))
+
+    print("\nSections:")
+    for name, size in usage["sections"].items():
+        print("  %-24s %8d" % (name, size))
+
+    symbols = usage["symbols"]
+    if not int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        symbols = symbols[:20]
+    if symbols:
+        print("\nLargest symbols:")
+        for name, section, size in symbols:
+            print("  %-40s %-16s %8d" % (name, section, size))
+
+
+def GetSizeSnapshotPath(env, name):
+    return join(
+        env.subst("$PROJECT_WORKSPACE_DIR"), "size", env.subst("$PIOENV"), name + ".json"
+    )
+
+
+def ReportSizeChanges(_, target, source, env):  # pylint: disable=W0613
+    try:
+        usage = get_cached_memory_usage(source[0].get_abspath(), with_symbols=True)
+    except (IOError, OSError, ElfError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    snapshot = make_snapshot(usage)
+
+    board_config = env.BoardConfig()
+    baseline = board_config.get("build.size_baseline", "")
+    old = load_snapshot(env.GetSizeSnapshotPath(baseline or "last"))
+    save_snapshot(env.GetSizeSnapshotPath("last"), snapshot)
+    if old is None:
+        print(
+            "No %s size snapshot, saved the current one"
+            % ("`%s`" % baseline if baseline else "previous")
+        )
+        return
+
+    print(format_report(
+        old,
+        snapshot,
+        "baseline `%s`" % baseline if baseline else "previous build",
+        None if int(ARGUMENTS.get("PIOVERBOSE", 0)) else 30,
+    ))
+
+    failed = False
+    for key, option in (("program", "size_budget"), ("data", "size_ram_budget")):
+        budget = board_config.get("build.%s" % option, "")
+        growth = snapshot[key] - old[key]
+        if budget != "" and growth > int(budget):
+            sys.stderr.write(
+                "Error: %s size grew by %d bytes, more than `board_build.%s = %s`\n"
+                % (key.capitalize(), growth, option, budget)
+            )
+            failed = True
+    if failed:
+        env.Exit(1)
+
+
+def SaveSizeBaseline(_, target, source, env):  # pylint: disable=W0613
+    try:
+        usage = get_cached_memory_usage(source[0].get_abspath(), with_symbols=True)
+    except (IOError, OSError, ElfError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    name = env.BoardConfig().get("build.size_baseline", "") or "baseline"
+    save_snapshot(env.GetSizeSnapshotPath(name), make_snapshot(usage))
+    print("Saved `%s` size baseline to %s" % (name, env.GetSizeSnapshotPath(name)))
+
+
+# in-process replacement of the "avr-size" based size checker
+env.AddMethod(CheckUploadSize)
+env.AddMethod(PrintProgramSize)
+env.AddMethod(GetSizeSnapshotPath)
+env.AddMethod(ReportSizeChanges)
+env.AddMethod(SaveSizeBaseline)
@@ -0,0 +1,70 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+from contextlib import nullcontext
+from os.path import join
+
+from SCons.Action import FunctionAction
+from SCons.Script import ARGUMENTS, Import
+
+from megaavr.trace import Tracer
+
+Import("env")
+
+
+def TraceSpan(env, name, **args):
+    """Time a block when `board_build.trace` is enabled"""
+    if env.get("TRACER") is None:
+        return nullcontext()
+    return env["TRACER"].span(name, **args)
+
+
+class TracedFunctionAction(FunctionAction):
+    """Time a function action without changing its build signature"""
+
+    def execute(self, target, source, env, *args, **kwargs):
+        # methods added with `env.AddMethod()` are wrapped by SCons
+        name = getattr(self.execfunction, "__name__", None) or getattr(
+            self.execfunction, "name", self.function_name())
+        with env["TRACER"].span(name, "action"):
+            return FunctionAction.execute(self, target, source, env, *args, **kwargs)
+
+
+def SaveTrace(tracer):
+    tracer.save()
+    print("\nTiming summary:")
+    print(tracer.format_summary())
+    print("Trace saved to %s" % tracer.path)
+
+
+env.AddMethod(TraceSpan)
+
+if env.BoardConfig().get("build.trace", "no").lower() == "yes":
+    # external commands and function actions are timed from here on
+    tracer = Tracer(env.subst(join("$BUILD_DIR", "trace.json")))
+    verbose_action = env.VerboseAction
+
+    def TracedVerboseAction(env, act, actstr):
+        # the function itself stays the action, a wrapper around it would
+        # change the signature and rebuild its targets on every run
+        if not callable(act):
+            return verbose_action(act, actstr)
+        if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+            return TracedFunctionAction(act, {})
+        return TracedFunctionAction(act, dict(cmdstr=actstr))
+
+    env.Replace(TRACER=tracer, SPAWN=tracer.wrap_spawn(env["SPAWN"]))
+    env.AddMethod(TracedVerboseAction, "VerboseAction")
+    atexit.register(SaveTrace, tracer)
@@ -0,0 +1,473 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import sys
+import time
+from os.path import join
+
+from serial import Serial, SerialException
+
+from SCons.Script import Import
+
+from platformio.public import list_serial_ports
+
+from megaavr.autobaud import (BaudrateCache, get_adapter_id, handshake,
+                              probe_baudrate, read_reference)
+from megaavr.avrdude import (build_read_flags, parse_immediate_writes,
+                             parse_read_output, strip_memory_ops)
+from megaavr.boards import get_physical_flash_size
+from megaavr.eeprom import get_changed_bytes, get_image_bytes, group_runs
+from megaavr.fuses import get_family, get_flash_page_size
+from megaavr.ihex import HexError, get_bounds, read_hex, write_hex
+from megaavr.incremental import (FlashedImages, get_changed_pages,
+                                 get_check_pages, get_pages, pages_to_segments)
+from megaavr.ports import (PortCache, get_cache_key, is_valid_port,
+                           parse_hwids, wait_for_new_port)
+from megaavr.updi import BASE_BAUDRATE, UpdiError, UpdiProgrammer
+from megaavr.verify import VerifyError, add_crcscan_checksum, verify_flash
+
+Import("env")
+
+
+def ReadDeviceMemories(env, memories, uploader_cmd):
+    """Read `memories` in one session, returns None if reading fails"""
+    result = subprocess.run(
+        "%s %s" % (env.subst(uploader_cmd), " ".join(build_read_flags(memories))),
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env={key: str(value) for key, value in env["ENV"].items()},
+    )
+    current = None
+    if result.returncode == 0:
+        current = parse_read_output(result.stdout, memories)
+    if current is None:
+        sys.stderr.write(result.stderr)
+    return current
+
+
+def FilterChangedFuses(env, fuses_flags, uploader_cmd):
+    """Read current fuses in one session and keep only flags that change them"""
+    fuses_flags = env.Flatten(fuses_flags)
+    try:
+        writes = parse_immediate_writes(fuses_flags)
+    except ValueError as exc:
+        print("Warning: %s, writing all fuses" % exc)
+        return fuses_flags
+    memories = [memory for memory, _ in writes]
+
+    current = env.ReadDeviceMemories(memories, uploader_cmd)
+    if current is None:
+        print("Warning: Couldn't read the current fuses, writing all of them")
+        return fuses_flags
+
+    return [
+        flag
+        for flag, (memory, value) in zip(fuses_flags, writes)
+        if current[memory] != value
+    ]
+
+
+def PrependChangedFuses(_, target, source, env):  # pylint: disable=W0613
+    read_cmd = "$UPLOADER %s" % " ".join(
+        strip_memory_ops(env.subst_list("$UPLOADERFLAGS")[0])
+    )
+    changed_flags = env.FilterChangedFuses(env["FUSESFLAGS"], read_cmd)
+    if not changed_flags:
+        print("Fuses are unchanged")
+        return
+    env.Prepend(UPLOADERFLAGS=changed_flags)
+
+
+def FindUploadPort(env):
+    """AutodetectUploadPort() that remembers the port found for a board"""
+    board_config = env.BoardConfig()
+    hwids = parse_hwids(board_config.get("build.hwids", []))
+    serial = board_config.get("upload.adapter_serial", "")
+    if env.subst("$UPLOAD_PORT") or not (hwids or serial):
+        env.AutodetectUploadPort()
+        return
+
+    port_cache = PortCache(join(env.GetPlatformCacheDir("ports"), "ports.json"))
+    cache_key = get_cache_key(env.subst("$BOARD"), hwids, serial)
+    port = port_cache.get(cache_key)
+    if is_valid_port(port, hwids, serial):
+        env.Replace(UPLOAD_PORT=port)
+        print("Using cached upload port: %s" % port)
+        return
+
+    if serial:
+        for item in list_serial_ports():
+            if "SER=%s" % serial in item.get("hwid", ""):
+                env.Replace(UPLOAD_PORT=item["port"])
+                break
+    env.AutodetectUploadPort()
+    port_cache.set(cache_key, env.subst("$UPLOAD_PORT"))
+
+
+def WaitForUploadPort(env, before_ports):
+    if not sys.platform.startswith("linux"):
+        return env.WaitForNewSerialPort(before_ports)
+
+    print("Waiting for the new upload port...")
+    result = wait_for_new_port(
+        [item["port"] for item in before_ports],
+        lambda: [item["port"] for item in list_serial_ports()],
+    )
+    if result is None:
+        return env.WaitForNewSerialPort(before_ports)
+    new_port, ports = result
+    if not new_port and env.subst("$UPLOAD_PORT") in ports:
+        new_port = env.subst("$UPLOAD_PORT")
+    if not new_port:
+        sys.stderr.write(
+            "Error: Couldn't find a board on the selected port. "
+            "Check that you have the correct port selected. "
+            "If it is correct, try pressing the board's reset "
+            "button after initiating the upload.\n"
+        )
+        env.Exit(1)
+
+    try:
+        Serial(new_port).close()
+    except SerialException:
+        # udev may not have applied the port permissions yet
+        time.sleep(1)
+
+    return new_port
+
+
+def GetBaudrateCache(env):
+    return BaudrateCache(join(env.GetPlatformCacheDir("ports"), "baudrates.json"))
+
+
+def GetBaudrateKey(env):
+    return "%s:%s" % (
+        get_adapter_id(env.subst("$UPLOAD_PORT"), list_serial_ports),
+        env.subst("$BOARD_MCU").lower(),
+    )
+
+
+def TuneUploadSpeed(env, retune=False):
+    """Use the rate tuned for the adapter and MCU, probe it if it's unknown"""
+    port = env.subst("$UPLOAD_PORT")
+    fallback = int(env.BoardConfig().get("upload.speed", BASE_BAUDRATE))
+    baudrate_cache = env.GetBaudrateCache()
+    key = env.GetBaudrateKey()
+    if retune:
+        baudrate_cache.forget(key)
+    baudrate = baudrate_cache.get(key)
+    try:
+        if baudrate and not handshake(port, baudrate, read_reference(port), 1):
+            print("Warning: The link doesn't work at the tuned %d baud anymore, "
+                  "falling back to %d baud" % (baudrate, fallback))
+            baudrate_cache.forget(key)
+            baudrate = fallback
+        elif not baudrate:
+            print("Tuning upload speed of %s..." % port)
+            baudrate = probe_baudrate(
+                port, fallback, progress=lambda rate, passed: print(
+                    "  %7d baud: %s" % (rate, "OK" if passed else "FAILED")))
+            baudrate_cache.set(key, baudrate)
+    except (IOError, SerialException, UpdiError) as exc:
+        print("Warning: Couldn't tune the upload speed: %s" % exc)
+        baudrate = fallback
+
+    env.Replace(UPLOAD_SPEED=str(baudrate))
+    if baudrate != fallback:
+        env.Replace(UPLOAD_SPEED_FALLBACK=str(fallback))
+    if "-b" not in env["UPLOADERFLAGS"]:
+        env.Append(UPLOADERFLAGS=["-b", "$UPLOAD_SPEED"])
+    print("Upload speed: %d baud" % baudrate)
+
+
+def FallBackUploadSpeed(env):
+    """Switch a failed tuned rate to the manifest one, returns False if
+    there is nothing to fall back to"""
+    fallback = env.get("UPLOAD_SPEED_FALLBACK")
+    if not fallback:
+        return False
+    env.GetBaudrateCache().forget(env.GetBaudrateKey())
+    env.Replace(UPLOAD_SPEED=fallback, UPLOAD_SPEED_FALLBACK="")
+    print("Warning: Upload failed at the tuned speed, retrying at %s baud" % fallback)
+    return True
+
+
+def RetuneUploadSpeed(_, target, source, env):  # pylint: disable=W0613
+    # `serialupdi_native` is switched to "serialupdi" for AVRDUDE
+    if env.subst("$UPLOAD_PROTOCOL") != "serialupdi":
+        sys.stderr.write(
+            "Error: Upload speed tuning requires `upload_protocol = serialupdi` "
+            "or `serialupdi_native`\n")
+        env.Exit(1)
+    env.FindUploadPort()
+    env.TuneUploadSpeed(retune=True)
+
+
+def UploadWithFallbackSpeed(_, target, source, env):  # pylint: disable=W0613
+    while env.Execute(env.subst("$UPLOADCMD", target=target, source=source)):
+        if not env.FallBackUploadSpeed():
+            env.Exit(1)
+
+
+def BeforeUpload(_, target, source, env):  # pylint: disable=W0613
+    upload_options = {}
+    if "BOARD" in env:
+        upload_options = env.BoardConfig().get("upload", {})
+
+    if env.subst("$UPLOAD_SPEED"):
+        env.Append(UPLOADERFLAGS=["-b", "$UPLOAD_SPEED"])
+
+    # extra upload flags
+    if "extra_flags" in upload_options:
+        env.Append(UPLOADERFLAGS=upload_options.get("extra_flags"))
+
+    verify = upload_options.get("verify", "").lower()
+    if verify == "none" and "-V" not in env["UPLOADERFLAGS"]:
+        env.Append(UPLOADERFLAGS=["-V"])
+    elif verify == "full" and "-V" in env["UPLOADERFLAGS"]:
+        env["UPLOADERFLAGS"].remove("-V")
+
+    if upload_options and not upload_options.get("require_upload_port", False):
+        # upload methods via USB
+        env.Append(UPLOADERFLAGS=["-P", "usb"])
+        return
+
+    with env.TraceSpan("Upload port detection"):
+        env.FindUploadPort()
+    env.Append(UPLOADERFLAGS=["-P", '"$UPLOAD_PORT"'])
+
+    wait_for_upload_port = upload_options.get("wait_for_upload_port", False)
+    if wait_for_upload_port:
+        before_ports = list_serial_ports()
+
+    if upload_options.get("use_1200bps_touch", False):
+        with env.TraceSpan("1200 bps touch"):
+            env.TouchSerialPort("$UPLOAD_PORT", 1200)
+
+    if wait_for_upload_port:
+        with env.TraceSpan("Waiting for upload port"):
+            env.Replace(UPLOAD_PORT=env.WaitForUploadPort(before_ports))
+
+    if env.get("UPLOAD_AUTOTUNE"):
+        with env.TraceSpan("Upload speed tuning"):
+            env.TuneUploadSpeed()
+
+
+def GetFlashPageSize(env):
+    board_config = env.BoardConfig()
+    return get_flash_page_size(
+        get_family(board_config),
+        int(board_config.get("upload.maximum_size", 0)),
+    )
+
+
+def GetFlashedImages(env):
+    return FlashedImages(env.GetPlatformCacheDir("flash"))
+
+
+def ForgetFlashedImages(_, target, source, env):  # pylint: disable=W0613
+    env.GetFlashedImages().forget(env.subst("$UPLOAD_PORT") or "usb")
+
+
+def DeviceHasPages(env, pages, uploader_cmd):
+    """Compare `pages` with the flash of the device in one session"""
+    check_path = join(env.subst("$BUILD_DIR"), "incremental-check.hex")
+    write_hex(check_path, pages_to_segments(pages))
+    result = subprocess.run(
+        "%s -U flash:v:%s:i" % (env.subst(uploader_cmd), check_path),
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env={key: str(value) for key, value in env["ENV"].items()},
+    )
+    return result.returncode == 0
+
+
+def UploadIncremental(_, target, source, env):
+    upload_cmd = env.subst("$UPLOADCMD", target=target, source=source)
+    uploader_flags = [str(flag) for flag in env.subst_list("$UPLOADERFLAGS")[0]]
+    port = env.subst("$UPLOAD_PORT") or "usb"
+    mcu = env.subst("$BOARD_MCU")
+    flashed_images = env.GetFlashedImages()
+
+    def _full_upload(device_ids, reason):
+        print("%s, uploading the whole image" % reason)
+        flashed_images.forget(port)
+        if env.Execute(upload_cmd):
+            env.Exit(1)
+        if device_ids:
+            flashed_images.save(port, mcu, device_ids, pages)
+
+    page_size = env.GetFlashPageSize()
+    try:
+        pages = get_pages(read_hex(source[0].get_abspath()), page_size)
+    except (IOError, HexError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+
+    if any(flag.startswith("-U") for flag in uploader_flags):
+        # fuses or a bootloader are written in the same session
+        return _full_upload(None, "Incremental upload isn't possible")
+
+    memories = ["signature"]
+    if env.subst("$UPLOAD_PROTOCOL") != "arduino":
+        memories.append("sernum")
+    device_ids = env.ReadDeviceMemories(
+        memories, "$UPLOADER %s" % " ".join(strip_memory_ops(uploader_flags))
+    )
+    if device_ids is None:
+        return _full_upload(None, "Couldn't identify the device")
+    device_ids = [device_ids[memory] for memory in memories]
+
+    device_pages = flashed_images.load(port, mcu, device_ids, page_size)
+    if device_pages is None:
+        return _full_upload(device_ids, "No previously flashed image")
+
+    changed = get_changed_pages(device_pages, pages)
+    if not changed:
+        print("Flash is up to date, %d pages unchanged" % len(pages))
+        return
+
+    flags = [flag for flag in uploader_flags if flag != "-e"]
+    if "-D" not in flags:
+        flags.append("-D")
+    if not env.DeviceHasPages(
+        get_check_pages(device_pages, changed, page_size),
+        "$UPLOADER %s" % " ".join(flags),
+    ):
+        return _full_upload(
+            device_ids, "Flash doesn't match the previously flashed image")
+
+    print("Writing %d of %d pages" % (len(changed), len(pages)))
+    partial_path = join(env.subst("$BUILD_DIR"), "incremental.hex")
+    write_hex(
+        partial_path,
+        pages_to_segments({address: pages[address] for address in changed}),
+    )
+    # the device contents are unknown if the upload is interrupted
+    flashed_images.forget(port)
+    if env.Execute(
+        "$UPLOADER %s -U flash:w:%s:i" % (" ".join(flags), partial_path)
+    ):
+        env.Exit(1)
+    device_pages.update({address: pages[address] for address in changed})
+    flashed_images.save(port, mcu, device_ids, device_pages)
+
+
+def ProgramSerialUpdi(env, segments, eeprom=None):
+    """Write flash and optionally EEPROM `segments` with the native uploader"""
+    board_config = env.BoardConfig()
+    page_size = env.GetFlashPageSize()
+    strategy = board_config.get("upload.verify", "full").lower()
+    max_size = int(board_config.get("upload.maximum_size", 0))
+    text_start = int(board_config.get("build.text_section_start", "0x0"), 0)
+    end = get_bounds(segments)[1] if segments else 0
+    if max_size and end > text_start + max_size:
+        sys.stderr.write(
+            "Error: The image ends at 0x%X beyond the application section "
+            "(0x%X-0x%X)\n" % (end - 1, text_start, text_start + max_size - 1))
+        env.Exit(1)
+    if strategy == "crc":
+        try:
+            segments = add_crcscan_checksum(
+                segments,
+                get_physical_flash_size(env.subst("$BOARD_MCU").lower()) or max_size,
+            )
+        except VerifyError as exc:
+            print("Warning: %s, verifying by reading back instead" % exc)
+            strategy = "full"
+    # only the session is retried, the image must stay as it is
+    while True:
+        try:
+            with UpdiProgrammer(
+                env.subst("$UPLOAD_PORT"), int(env.subst("$UPLOAD_SPEED") or 115200)
+            ) as programmer:
+                print("Connected to %s (NVM P:%d), signature %s" % (
+                    programmer.get_family(),
+                    programmer.nvm_version,
+                    programmer.read_signature().hex().upper(),
+                ))
+                start = time.time()
+                programmer.chip_erase()
+                programmer.enter_progmode()
+                pages = programmer.write_flash(segments, page_size)
+                print("Wrote %d pages in %.2fs at %s baud" % (
+                    pages, time.time() - start, env.subst("$UPLOAD_SPEED") or 115200))
+                start = time.time()
+                verified, method = verify_flash(
+                    programmer, segments, page_size, strategy)
+                if verified and eeprom:
+                    desired = get_image_bytes(eeprom)
+                    current = programmer.read_eeprom(max(desired) + 1)
+                    programmer.write_eeprom(group_runs(
+                        get_changed_bytes(current, desired),
+                        programmer.nvm["eeprom_page_size"],
+                    ))
+                    written = programmer.read_eeprom(max(desired) + 1)
+                    if get_changed_bytes(written, desired):
+                        verified, method = False, "EEPROM read-back"
+            break
+        except (IOError, SerialException, UpdiError) as exc:
+            if env.FallBackUploadSpeed():
+                continue
+            sys.stderr.write("Error: %s\n" % exc)
+            env.Exit(1)
+    if not verified:
+        sys.stderr.write("Error: Verification failed (%s)\n" % method)
+        env.Exit(1)
+    print("Verified in %.2fs (%s)" % (time.time() - start, method))
+
+
+def UploadSerialUpdi(_, target, source, env):  # pylint: disable=W0613
+    try:
+        segments = read_hex(source[0].get_abspath())
+    except (IOError, HexError) as exc:
+        sys.stderr.write("Error: %s\n" % exc)
+        env.Exit(1)
+    env.ProgramSerialUpdi(segments)
+
+
+def BeforeProgramAll(_, target, source, env):  # pylint: disable=W0613
+    eep_path = source[1].get_abspath()
+    with open(eep_path) as fp:
+        has_data = any(line.startswith(":") and line[7:9] == "00" for line in fp)
+    if not has_data:
+        print("EEPROM image %s is empty, skipping" % source[1])
+        return
+    env.Replace(EEPROMFLAGS=["-U", "eeprom:w:%s:i" % eep_path])
+
+
+env.AddMethod(ReadDeviceMemories)
+env.AddMethod(FilterChangedFuses)
+env.AddMethod(PrependChangedFuses)
+env.AddMethod(FindUploadPort)
+env.AddMethod(WaitForUploadPort)
+env.AddMethod(GetBaudrateCache)
+env.AddMethod(GetBaudrateKey)
+env.AddMethod(TuneUploadSpeed)
+env.AddMethod(FallBackUploadSpeed)
+env.AddMethod(RetuneUploadSpeed)
+env.AddMethod(UploadWithFallbackSpeed)
+env.AddMethod(BeforeUpload)
+env.AddMethod(GetFlashPageSize)
+env.AddMethod(GetFlashedImages)
+env.AddMethod(ForgetFlashedImages)
+env.AddMethod(DeviceHasPages)
+env.AddMethod(UploadIncremental)
+env.AddMethod(ProgramSerialUpdi)
+env.AddMethod(UploadSerialUpdi)
+env.AddMethod(BeforeProgramAll)
@@ -12,19 +12,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
+
 from platformio.public import PlatformBase
 
 
 class AtmelmegaavrPlatform(PlatformBase):
 
+    _board_index = None
+
+    def get_board_index(self):
+        """Capabilities of all bundled boards, loaded once on first use"""
+        if self._board_index is None:
+            sys.path.insert(0, os.path.join(self.get_dir(), "builder"))
+            from megaavr.boards import load_index  # pylint: disable=import-outside-toplevel
+
+            self._board_index = load_index(
+                os.path.join(
+                    self.config.get("platformio", "cache_dir"),
+                    "atmelmegaavr",
+                    "boards_index.json",
+                ),
+                os.path.join(self.get_dir(), "boards"),
+            )
+        return self._board_index
+
+    def query_boards(self, **criteria):
+        # loading the index puts the helper modules on `sys.path`
+        index = self.get_board_index()
+        from megaavr.boards import query_boards  # pylint: disable=import-outside-toplevel
+
+        return query_boards(index, **criteria)
+
+    def is_project_board(self, board):
+        """Whether `board` is defined in the project `boards_dir`"""
+        boards_dir = self.config.get("platformio", "boards_dir")
+        return bool(boards_dir) and os.path.isfile(
+            os.path.join(boards_dir, "%s.json" % board))
+
     def configure_default_packages(self, variables, targets):
         if not variables.get("board"):
             return super().configure_default_packages(
                 variables, targets)
 
-        build_core = variables.get(
-            "board_build.core", self.board_config(variables.get("board")).get(
-                "build.core", "arduino"))
+        board = variables.get("board")
+        build_core = variables.get("board_build.core")
+        if not build_core:
+            indexed_board = self.get_board_index()["boards"].get(board)
+            if indexed_board and not self.is_project_board(board):
+                build_core = indexed_board["core"]
+            else:
+                # custom boards from the project "boards_dir", which also
+                # override bundled boards with the same ID
+                build_core = self.board_config(board).get("build.core", "arduino")
 
         if "arduino" in variables.get("pioframework", []) and build_core != "arduino":
             framework_package = "framework-arduino-megaavr-%s" % build_core.lower()
@@ -0,0 +1,43 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+# the helper package is imported the same way as by the builder scripts
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "builder"))
+
+
+@pytest.fixture
+def simulator():
+    """Start a simulated target of a board, returns `(target, port)`"""
+    pytest.importorskip("serial")
+    if not sys.platform.startswith("linux"):
+        pytest.skip("the simulator runs on a Linux pseudo-terminal")
+    from megaavr.updisim import create_target, start_target
+
+    stops = []
+
+    def start(board):
+        _, target = create_target(board)
+        port, _, stop = start_target(target)
+        stops.append(stop)
+        return target, port
+
+    yield start
+    for stop in stops:
+        stop()
@@ -0,0 +1,50 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+from megaavr import cache
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, "api"))
+    with open(os.path.join(root, "Arduino.h"), "w") as fp:
+        fp.write("#define ARDUINO_H\n")
+    with open(os.path.join(root, "api", "Common.h"), "w") as fp:
+        fp.write("#define HIGH 1\n")
+    return root
+
+
+def test_tree_digest_is_remembered(tmp_path, monkeypatch):
+    tree = make_tree(str(tmp_path / "core"))
+    digests_path = str(tmp_path / "cache" / "trees.json")
+    digest = cache.get_tree_digest(tree, digests_path)
+    assert digest == cache.hash_tree(tree, hashlib.sha1()).hexdigest()
+
+    reads = []
+    hash_tree = cache.hash_tree
+    monkeypatch.setattr(
+        cache, "hash_tree", lambda *args: reads.append(args) or hash_tree(*args))
+    assert cache.get_tree_digest(tree, digests_path) == digest
+    assert not reads
+
+    # touching a file reads the tree again, the content still matches
+    os.utime(os.path.join(tree, "Arduino.h"), (1, 1))
+    assert cache.get_tree_digest(tree, digests_path) == digest
+    assert len(reads) == 1
+
+    with open(os.path.join(tree, "api", "Common.h"), "a") as fp:
+        fp.write("#define LOW 0\n")
+    assert cache.get_tree_digest(tree, digests_path) != digest
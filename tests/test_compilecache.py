@@ -0,0 +1,77 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+
+import pytest
+
+from megaavr.compilecache import get_cache_key, get_compiler_id
+
+
+def make_checkout(root):
+    os.makedirs(os.path.join(root, "include"))
+    os.makedirs(os.path.join(root, "src"))
+    with open(os.path.join(root, "include", "config.h"), "w") as fp:
+        fp.write("#define ANSWER 42\n")
+    with open(os.path.join(root, "src", "main.c"), "w") as fp:
+        fp.write('#include "config.h"\nint answer(void) { return ANSWER; }\n')
+    return root
+
+
+def get_key(root, flags, base_dirs):
+    source = os.path.join(root, "src", "main.c")
+    cmd = ["gcc", "-o", source + ".o", "-c"] + flags + [
+        "-I%s" % os.path.join(root, "include"), source]
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        return get_cache_key(cmd, "1.0", base_dirs)[0]
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.mark.skipif(not shutil.which("gcc"), reason="requires a host gcc")
+@pytest.mark.parametrize("flags", [["-Os"], ["-Os", "-flto"], ["-Os", "-g"]])
+def test_checkouts_share_keys(tmp_path, flags):
+    first = make_checkout(str(tmp_path / "ci" / "job1"))
+    second = make_checkout(str(tmp_path / "ci" / "job2"))
+    assert get_key(first, flags, [first]) == get_key(second, flags, [second])
+    if flags != ["-Os"]:
+        # without base directories the locations recorded in the object differ
+        assert get_key(first, flags, []) != get_key(second, flags, [])
+
+
+def test_compiler_id_survives_reinstall(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    compilers = []
+    for name in ("install1", "install2"):
+        path = tmp_path / name / "avr-gcc"
+        path.parent.mkdir()
+        path.write_bytes(b"\x7fELF compiler")
+        compilers.append(str(path))
+    os.utime(compilers[1], (1, 1))
+    assert get_compiler_id(compilers[0], cache_dir) == get_compiler_id(
+        compilers[1], cache_dir)
+
+    # the remembered hash is used while the size and mtime are unchanged
+    first_id = get_compiler_id(compilers[0], cache_dir)
+    stat = os.stat(compilers[0])
+    with open(compilers[0], "r+b") as fp:
+        fp.write(b"\x7fELF patched!")
+    os.utime(compilers[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert get_compiler_id(compilers[0], cache_dir) == first_id
+    os.utime(compilers[0], (2, 2))
+    assert get_compiler_id(compilers[0], cache_dir) != first_id
@@ -0,0 +1,56 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("serial")
+
+from megaavr import ports  # noqa: E402
+
+HWIDS = {(0x03EB, 0x2145)}
+
+
+@pytest.fixture
+def macos_port(tmp_path, monkeypatch):
+    """A port path on a host without sysfs, returns a setter of its identity"""
+    port = str(tmp_path / "cu.usbmodem1")
+    open(port, "w").close()
+    monkeypatch.setattr(ports.sys, "platform", "darwin")
+    devices = []
+    monkeypatch.setattr(ports.list_ports, "comports", lambda: devices)
+
+    def set_identity(vid=None, pid=None, serial_number=None):
+        devices[:] = [SimpleNamespace(
+            device=port, vid=vid, pid=pid, serial_number=serial_number)]
+        return port
+
+    return set_identity
+
+
+def test_port_identity_from_pyserial(macos_port):
+    port = macos_port(0x03EB, 0x2145, "ABC123")
+    assert ports.is_valid_port(port, HWIDS)
+    assert ports.is_valid_port(port, HWIDS, "ABC123")
+    assert not ports.is_valid_port(port, HWIDS, "XYZ")
+    assert not ports.is_valid_port(port, {(0x1A86, 0x7523)})
+
+
+def test_unknown_port_identity(macos_port):
+    # the path exists, but nothing confirms it is the same adapter
+    port = macos_port()
+    assert not ports.is_valid_port(port, HWIDS)
+    assert not ports.is_valid_port(port, set(), "ABC123")
+    assert ports.is_valid_port(port, set())
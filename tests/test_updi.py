@@ -0,0 +1,48 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from megaavr.fuses import get_flash_page_size
+
+# board, family id, flash size
+TARGETS = [
+    ("ATtiny1614", "tinyavr1", 16384),
+    ("ATmega4809", "megaavr0", 49152),
+    ("AVR128DA48", "avr_da", 131072),
+]
+
+
+def make_page(page_size, seed):
+    return bytearray((seed + idx * 7) & 0xFF for idx in range(page_size))
+
+
+@pytest.mark.parametrize("board,family,flash_size", TARGETS)
+def test_write_read_last_page(simulator, board, family, flash_size):
+    from megaavr.updi import UpdiProgrammer
+
+    target, port = simulator(board)
+    page_size = get_flash_page_size(family, flash_size)
+    address = flash_size - page_size
+    page = make_page(page_size, 0x5A)
+    with UpdiProgrammer(port) as programmer:
+        programmer.chip_erase()
+        programmer.enter_progmode()
+        assert programmer.write_flash([(address, page)], page_size) == 1
+        assert programmer.read_flash(address, page_size) == page
+        assert programmer.verify_flash([(address, page)]) is None
+    # the page must land at the end of the device flash, not anywhere else
+    assert target.flash[address:] == page
+    assert target.flash[:address] == b"\xff" * address
+
@@ -0,0 +1,95 @@
+# Copyright 2019-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from megaavr.fuses import get_flash_page_size
+from megaavr.verify import (STRATEGIES, VerifyError, add_crcscan_checksum,
+                            verify_flash)
+
+TARGETS = [
+    ("ATtiny1614", "tinyavr1", 16384),
+    ("ATmega4809", "megaavr0", 49152),
+    ("AVR128DA48", "avr_da", 131072),
+]
+
+
+def make_image(page_size):
+    # a few pages at the start and one page in the middle of the flash
+    return [
+        (0, bytearray(idx & 0xFF for idx in range(3 * page_size + 10))),
+        (8 * page_size, bytearray(b"\x5a" * page_size)),
+    ]
+
+
+def program(port, segments, page_size, strategy, corrupt=None):
+    from megaavr.updi import UpdiProgrammer
+
+    with UpdiProgrammer(port) as programmer:
+        programmer.chip_erase()
+        programmer.enter_progmode()
+        programmer.write_flash(segments, page_size)
+        if corrupt:
+            corrupt()
+        return verify_flash(programmer, segments, page_size, strategy)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+@pytest.mark.parametrize("board,family,flash_size", TARGETS)
+def test_strategy(simulator, board, family, flash_size, strategy):
+    target, port = simulator(board)
+    page_size = get_flash_page_size(family, flash_size)
+    segments = make_image(page_size)
+    if strategy == "crc":
+        segments = add_crcscan_checksum(segments, flash_size)
+
+    verified, method = program(port, segments, page_size, strategy)
+    assert verified, method
+    if strategy == "crc":
+        # the device check must succeed without the read-back fallback
+        assert method == "device CRCSCAN"
+        assert target.flash[-2:] != b"\xff\xff"
+
+
+@pytest.mark.parametrize("strategy", ["full", "sample", "crc"])
+@pytest.mark.parametrize("board,family,flash_size", TARGETS)
+def test_strategy_detects_corruption(simulator, board, family, flash_size, strategy):
+    target, port = simulator(board)
+    page_size = get_flash_page_size(family, flash_size)
+    segments = make_image(page_size)
+    if strategy == "crc":
+        segments = add_crcscan_checksum(segments, flash_size)
+
+    def corrupt():
+        # a bit flipped in the first page, which every strategy reads
+        target.flash[5] ^= 0x01
+
+    verified, _ = program(port, segments, page_size, strategy, corrupt)
+    assert not verified
+
+
+def test_crcscan_checksum_overlapping_image():
+    # a full 2 KB attiny202 image leaves no room for the checksum
+    with pytest.raises(VerifyError, match="0x7FE-0x7FF"):
+        add_crcscan_checksum([(0, bytearray(2048))], 2048)
+
+
+def test_crcscan_checksum_image_past_flash():
+    with pytest.raises(VerifyError, match="ends at 0x801"):
+        add_crcscan_checksum([(0x700, bytearray(0x102))], 2048)
+
+
+def test_crcscan_checksum_last_free_bytes():
+    segments = add_crcscan_checksum([(0, bytearray(2046))], 2048)
+    assert segments[-1][0] + len(segments[-1][1]) == 2048